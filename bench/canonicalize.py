@@ -0,0 +1,38 @@
+"""
+Benchmark datatypes.canonicalize per datastore type
+
+Usage:
+    canonicalize.py [--cells=N]
+
+Options:
+    --cells=N    cells to canonicalize per type [default: 200000]
+"""
+
+import sys
+import random
+from time import perf_counter
+
+from docopt import docopt
+
+from ckanext.excelforms.datatypes import canonicalize
+
+from workbooks import FIELDS, _value
+
+
+def main():
+    opts = docopt(__doc__)
+    cells = int(opts['--cells'])
+    rnd = random.Random(0)
+    for field in FIELDS:
+        values = [_value(rnd, field, i) for i in range(cells)]
+        pk = field.get('tdpkreq') == 'pk'
+        start = perf_counter()
+        for v in values:
+            canonicalize(v, field['type'], pk)
+        elapsed = perf_counter() - start
+        print('{0:<14}{1:<11}{2:14,.0f} cells/s'.format(
+            field['id'], field['type'], cells / elapsed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
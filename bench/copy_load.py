@@ -0,0 +1,115 @@
+"""
+Compare parameterized INSERTs with the COPY fast path
+
+Creates a scratch table with the benchmark fields in the given
+PostgreSQL database and loads the same canonicalized records into it
+with executemany INSERTs (what datastore_upsert method=insert runs)
+and with COPY from copy_load.CSVStream. Needs psycopg2.
+
+Usage:
+    copy_load.py [options] URL [ROWS ...]
+
+Arguments:
+    URL              postgresql:// URL of a scratch database
+    ROWS             numbers of records to load, 1000 10000 and 100000
+                     when not given
+
+Options:
+    --repeat=R       repeat timings R times and keep the best [default: 1]
+"""
+
+import sys
+import random
+from time import perf_counter
+
+import psycopg2
+from docopt import docopt
+
+from fakeckan import ensure_ckan_modules
+ensure_ckan_modules()
+
+from ckanext.excelforms.datatypes import canonicalize
+from ckanext.excelforms.copy_load import CSVStream
+from ckanext.excelforms.record_batch import RecordBatch
+
+from workbooks import FIELDS, _value
+
+DEFAULT_ROWS = [1000, 10000, 100000]
+TABLE = 'excelforms_copy_bench'
+PG_TYPES = {'_text': 'text[]', 'money': 'numeric', 'year': 'int'}
+
+
+def records(num_rows):
+    rnd = random.Random(0)
+    fields = [f for f in FIELDS if f.get('tdpkreq') != 'pk']
+    batch = RecordBatch(f['id'] for f in fields)
+    for n in range(num_rows):
+        batch.append(n, [
+            canonicalize(_value(rnd, f, n), f['type'], False)
+            for f in fields])
+    return batch
+
+
+def create_table(cursor, columns):
+    cursor.execute('DROP TABLE IF EXISTS {0}'.format(TABLE))
+    cursor.execute('CREATE TABLE {0} (_id serial, {1})'.format(
+        TABLE,
+        ', '.join('"{0}" {1}'.format(f['id'], PG_TYPES.get(f['type'], f['type']))
+            for f in FIELDS if f['id'] in columns)))
+
+
+def insert(connection, columns, recs):
+    cursor = connection.cursor()
+    cursor.executemany(
+        'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            TABLE,
+            ', '.join('"{0}"'.format(c) for c in columns),
+            ', '.join(['%s'] * len(columns))),
+        [[v or None for v in values] for values in recs.values])
+    connection.commit()
+
+
+def copy(connection, columns, recs):
+    cursor = connection.cursor()
+    cursor.copy_expert(
+        'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)'.format(
+            TABLE, ', '.join('"{0}"'.format(c) for c in columns)),
+        CSVStream(recs.value_rows()))
+    connection.commit()
+
+
+def best_of(repeat, connection, columns, fn, recs):
+    best = None
+    for i in range(repeat):
+        cursor = connection.cursor()
+        create_table(cursor, columns)
+        connection.commit()
+        start = perf_counter()
+        fn(connection, columns, recs)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    opts = docopt(__doc__)
+    sizes = [int(n) for n in opts['ROWS']] or DEFAULT_ROWS
+    repeat = int(opts['--repeat'])
+    connection = psycopg2.connect(opts['URL'])
+    try:
+        for num_rows in sizes:
+            recs = records(num_rows)
+            columns = recs.fields
+            print('rows={0}'.format(num_rows))
+            for name, fn in (('insert', insert), ('copy', copy)):
+                elapsed = best_of(repeat, connection, columns, fn, recs)
+                print('  {0:<14}{1:9.3f}s {2:12,.0f} rows/s'.format(
+                    name, elapsed, num_rows / elapsed))
+    finally:
+        connection.cursor().execute('DROP TABLE IF EXISTS {0}'.format(TABLE))
+        connection.commit()
+        connection.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
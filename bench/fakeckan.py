@@ -0,0 +1,335 @@
+"""
+In-memory stand-in for the parts of CKAN used by the excelforms blueprint
+
+make_app() mounts the real excelforms Blueprint in a bare Flask app
+with ckanapi.LocalCKAN replaced by FakeLocalCKAN, backed by a
+FakeDatastore that keeps tables in memory and can add artificial
+latency to every action call.
+
+When CKAN itself is not installed, minimal ckan.plugins.toolkit and
+ckan.logic modules are registered so the extension modules can be
+imported. Either way the toolkit names the blueprint and template
+writer use (h, g, request, _, ...) are replaced with the stand-ins
+below, since they only work inside a configured CKAN app.
+"""
+
+import importlib
+import json
+import sys
+import types
+import threading
+from copy import deepcopy
+from time import sleep
+
+import flask
+from werkzeug.local import LocalProxy
+
+
+class ValidationError(Exception):
+    def __init__(self, error_dict):
+        self.error_dict = error_dict
+
+
+class NotAuthorized(Exception):
+    pass
+
+
+class FakeDatastore(object):
+    """
+    Thread-safe in-memory tables: {resource_id: (resource, fields, records)}
+
+    latency is added (in seconds) to every action call
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tables = {}
+
+    def create(self, resource, fields, records=()):
+        self.tables[resource['id']] = {
+            'resource': resource,
+            'fields': [{'id': '_id', 'type': 'int'}] + list(fields),
+            'records': {},
+            'next_id': 1,
+        }
+        for r in records:
+            self._insert(self.tables[resource['id']], r)
+
+    def _insert(self, table, record):
+        record = dict(record, _id=table['next_id'])
+        table['records'][table['next_id']] = record
+        table['next_id'] += 1
+
+    def _table(self, resource_id):
+        sleep(self.latency)
+        try:
+            return self.tables[resource_id]
+        except KeyError:
+            raise ValidationError({'resource_id': ['Not found']})
+
+    def datastore_info(self, id):
+        return {'fields': deepcopy(self._table(id)['fields'])}
+
+    def resource_show(self, id):
+        return dict(self._table(id)['resource'])
+
+    def datastore_search(self, resource_id, filters=None, fields=None,
+            limit=100, offset=0, sort=None, records_format='objects',
+            **kwargs):
+        table = self._table(resource_id)
+        with self.lock:
+            records = list(table['records'].values())
+        for k, v in (filters or {}).items():
+            v = v if isinstance(v, list) else [v]
+            v = set(str(e) for e in v)
+            records = [r for r in records if str(r.get(k)) in v]
+        if sort:
+            column, _sp, order = sort.partition(' ')
+            records.sort(
+                key=lambda r: r.get(column),
+                reverse=order.strip().lower() == 'desc')
+        total = len(records)
+        records = records[int(offset):int(offset) + int(limit)]
+        field_ids = fields or [f['id'] for f in table['fields']]
+        if isinstance(field_ids, str):
+            field_ids = field_ids.split(',')
+        if records_format == 'lists':
+            records = [[r.get(f) for f in field_ids] for r in records]
+        else:
+            records = [{f: r.get(f) for f in field_ids} for r in records]
+        return {
+            'fields': [f for f in table['fields'] if f['id'] in field_ids],
+            'records': records,
+            'total': total,
+        }
+
+    def datastore_upsert(self, resource_id, records, method='upsert',
+            dry_run=False, **kwargs):
+        table = self._table(resource_id)
+        pk = [f['id'] for f in table['fields'] if f.get('tdpkreq') == 'pk']
+        with self.lock:
+            if dry_run:
+                return {'records': records}
+            existing = table['records']
+            if method == 'upsert' and pk:
+                by_key = {
+                    tuple(r.get(k) for k in pk): r for r in existing.values()}
+            for n, r in enumerate(records):
+                if method == 'update' or (method == 'upsert' and '_id' in r):
+                    if int(r['_id']) not in existing:
+                        raise ValidationError({
+                            'records': ['key not found'],
+                            'records_row': n})
+                    existing[int(r['_id'])].update(r)
+                elif method == 'upsert' and pk:
+                    key = tuple(r.get(k) for k in pk)
+                    if key in by_key:
+                        by_key[key].update(r)
+                    else:
+                        self._insert(table, r)
+                        by_key[key] = existing[table['next_id'] - 1]
+                else:
+                    self._insert(table, r)
+        return {'records': records}
+
+
+class FakeLocalCKAN(object):
+    """
+    Replaces ckanapi.LocalCKAN: lc.action.<name>(**kwargs) calls the
+    method of the same name on FakeDatastore.current
+    """
+    current = None
+
+    def __init__(self, username=None, context=None):
+        self.username = username
+        self.action = self.current
+
+
+class _ColumnType(object):
+    """
+    Stands in for tabledesigner column types
+    """
+    excel_formats = {
+        'int': '#,##0', 'bigint': '#,##0', 'money': '$#,##0.00',
+        'numeric': 'General', 'date': 'yyyy-mm-dd',
+        'timestamp': 'yyyy-mm-dd hh:mm:ss', 'year': '0',
+    }
+    numeric = ('int', 'bigint', 'money', 'numeric', 'year')
+
+    def __init__(self, field):
+        self.field = field
+        self.label = field['type']
+        self.excel_format = self.excel_formats.get(field['type'], '@')
+
+    def excel_validate_rule(self):
+        if self.field.get('tdchoices'):
+            return 'ISERROR(MATCH({_value_},{_choice_range_},0))'
+        if self.field['type'] in self.numeric:
+            return 'NOT(ISNUMBER({_value_}))'
+        return None
+
+    def column_constraints(self):
+        return []
+
+
+class _Helpers(object):
+    """
+    Stands in for the CKAN template helpers used by excelforms
+    """
+    def tabledesigner_column_type(self, field):
+        return _ColumnType(field)
+
+    def tabledesigner_choices(self, field):
+        return field.get('tdchoices')
+
+    def excelforms_language_text(self, f, field, lang=None):
+        return f.get(field, '')
+
+    def get_translated(self, data, key):
+        return data.get(key)
+
+    def url_for(self, *args, **kwargs):
+        return '/dataset/{id}/resource/{resource_id}'.format(**kwargs)
+
+    def lang(self):
+        return 'en'
+
+    def flash_success(self, message):
+        flask.g.excelforms_flash = ('success', message)
+
+    def flash_error(self, message):
+        flask.g.excelforms_flash = ('error', message)
+
+    def redirect_to(self, endpoint, **kwargs):
+        if endpoint.startswith('excelforms.'):
+            return flask.redirect(flask.url_for(endpoint, **kwargs))
+        result = getattr(flask.g, 'excelforms_flash', ('success', ''))
+        return flask.jsonify(result=result[0], message=result[1])
+
+
+class _Request(object):
+    """
+    Adds CKAN's request.params to the flask request
+    """
+    def __getattr__(self, name):
+        if name == 'params':
+            return flask.request.values
+        return getattr(flask.request, name)
+
+
+def _asbool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+    return bool(value)
+
+
+def _standin_modules():
+    """
+    Register minimal ckan modules so excelforms can be imported without CKAN
+    """
+    ckan = types.ModuleType('ckan')
+    plugins = types.ModuleType('ckan.plugins')
+    toolkit = types.ModuleType('ckan.plugins.toolkit')
+    logic = types.ModuleType('ckan.logic')
+    authz = types.ModuleType('ckan.authz')
+    model = types.ModuleType('ckan.model')
+    model.Session = types.SimpleNamespace(remove=lambda: None)
+    authz.is_sysadmin = lambda user: False
+    for name in (
+            '_', 'config', 'asbool', 'request', 'h', 'abort', 'g',
+            'check_access', 'render_template', 'enqueue_job',
+            'get_or_bust'):
+        setattr(toolkit, name, None)
+    logic.ValidationError = ValidationError
+    logic.NotAuthorized = NotAuthorized
+    toolkit.ValidationError = ValidationError
+    toolkit.NotAuthorized = NotAuthorized
+    ckan.plugins = plugins
+    ckan.logic = logic
+    ckan.authz = authz
+    ckan.model = model
+    plugins.toolkit = toolkit
+    sys.modules.update({
+        'ckan': ckan,
+        'ckan.plugins': plugins,
+        'ckan.plugins.toolkit': toolkit,
+        'ckan.logic': logic,
+        'ckan.authz': authz,
+        'ckan.model': model,
+    })
+
+
+def ensure_ckan_modules():
+    """
+    Register the stand-in ckan modules when CKAN is not installed
+    """
+    try:
+        importlib.import_module('ckan.plugins.toolkit')
+    except ImportError:
+        _standin_modules()
+
+
+def install(datastore, config=None):
+    """
+    Point the excelforms blueprint and template writer at the stand-ins,
+    returns the blueprint module
+    """
+    ensure_ckan_modules()
+
+    from ckanext.excelforms import (
+        blueprint, export_jobs, profiling, write_excel)
+
+    FakeLocalCKAN.current = datastore
+    import ckanapi
+    ckanapi.LocalCKAN = FakeLocalCKAN
+    # bench users may profile requests
+    profiling.authz = types.SimpleNamespace(is_sysadmin=lambda user: True)
+    helpers = _Helpers()
+    standins = {
+        '_': lambda s: s,
+        'h': helpers,
+        'g': LocalProxy(lambda: flask.g),
+        'request': _Request(),
+        'abort': flask.abort,
+        'config': config or {},
+        'asbool': _asbool,
+        'check_access': lambda action, context, data_dict: True,
+        'render_template': lambda template, **extra: json.dumps(
+            extra, default=str),
+        'enqueue_job': _enqueue_job,
+        'ValidationError': ValidationError,
+        'NotAuthorized': NotAuthorized,
+    }
+    for module in (blueprint, export_jobs, profiling, write_excel):
+        for name, value in standins.items():
+            if hasattr(module, name):
+                setattr(module, name, value)
+    return blueprint
+
+
+def _enqueue_job(fn, args=None, kwargs=None, title=None):
+    """
+    Stand-in for toolkit.enqueue_job running the job in a thread
+    """
+    thread = threading.Thread(
+        target=fn, args=args or [], kwargs=kwargs or {}, name=title)
+    thread.daemon = True
+    thread.start()
+
+
+def make_app(datastore, config=None):
+    """
+    Return a bare Flask app serving the excelforms blueprint
+    """
+    blueprint = install(datastore, config)
+    app = flask.Flask(__name__)
+    app.register_blueprint(blueprint.excelforms)
+    # background export jobs run in threads with their own request context
+    from ckanext.excelforms import export_jobs
+    export_jobs._request_context = lambda lang: app.test_request_context()
+
+    @app.before_request
+    def set_user():
+        flask.g.user = flask.request.headers.get('X-User', 'loadtest')
+
+    return app
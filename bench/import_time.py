@@ -0,0 +1,59 @@
+"""
+Time importing the modules the excelforms plugin loads at startup,
+each run in a fresh interpreter, then the prewarm hook that imports
+the rest ahead of the first request
+
+Usage:
+    import_time.py [options]
+
+Options:
+    --repeat=N    interpreters to start, reporting the median [default: 15]
+"""
+
+import os
+import subprocess
+import sys
+from statistics import median
+
+from docopt import docopt
+
+# modules plugins.py imports, flask and werkzeug are loaded by CKAN
+# before any plugin and aren't counted
+RUN = '''
+import sys
+from time import perf_counter
+import fakeckan
+fakeckan.ensure_ckan_modules()
+import flask
+start = perf_counter()
+from ckanext.excelforms import (
+    blueprint, logic, metrics, template_pool, upload_queue)
+plugin = perf_counter()
+try:
+    from ckanext.excelforms.prewarm import prewarm
+except ImportError:
+    prewarm = lambda: None
+prewarm()
+print(plugin - start, perf_counter() - plugin, len(sys.modules))
+'''
+
+
+def main():
+    opts = docopt(__doc__)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [here, os.path.dirname(here), os.environ.get('PYTHONPATH', '')]))
+    plugin, prewarm, modules = [], [], []
+    for i in range(int(opts['--repeat'])):
+        out = subprocess.check_output(
+            [sys.executable, '-c', RUN], env=env, cwd=here).split()
+        plugin.append(float(out[0]))
+        prewarm.append(float(out[1]))
+        modules.append(int(out[2]))
+    print('plugin import  {0:8.1f} ms'.format(median(plugin) * 1000))
+    print('prewarm        {0:8.1f} ms'.format(median(prewarm) * 1000))
+    print('modules loaded {0:8d}'.format(modules[-1]))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Load test the excelforms endpoints against an in-memory datastore
+
+Runs the real excelforms blueprint in a bare Flask app (see fakeckan.py)
+and drives template downloads and uploads from many concurrent workers,
+then reports throughput, latency percentiles and peak memory per worker.
+
+With --processes each worker process has its own app and datastore,
+like a preforked web server; otherwise workers are threads sharing one.
+
+Usage:
+    loadtest.py [options]
+
+Options:
+    --workers=N      concurrent workers [default: 4]
+    --processes      run workers as processes instead of threads
+    --requests=N     requests per worker [default: 20]
+    --upload-rows=N  data rows in each uploaded workbook [default: 1000]
+    --edit-rows=N    records selected for each edit template [default: 100]
+    --mix=T:E:U      ratio of blank template, edit template and upload
+                     requests [default: 1:1:2]
+    --latency=MS     artificial latency of each datastore call [default: 5]
+    --queue          serialize and coalesce uploads with the upload queue
+    --csv            upload CSV files instead of workbooks
+"""
+
+import os
+import sys
+import random
+import resource
+import tempfile
+import threading
+from io import BytesIO
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from docopt import docopt
+
+from fakeckan import FakeDatastore, make_app
+from workbooks import write_upload, write_upload_csv, FIELDS, PROVINCES, RESOURCE_ID
+
+PACKAGE_ID = 'loadtest'
+OPERATIONS = ('template', 'edit', 'upload')
+
+
+def new_datastore(latency, edit_rows):
+    fields = [dict(f) for f in FIELDS]
+    for f in fields:
+        if f['id'] == 'province':
+            f['tdchoices'] = PROVINCES
+    datastore = FakeDatastore(latency)
+    datastore.create(
+        {'id': RESOURCE_ID, 'package_id': PACKAGE_ID, 'name': 'Load test'},
+        fields,
+        [{'ref_number': 'SEED-{0:07d}'.format(i), 'province': 'ON'}
+            for i in range(edit_rows)])
+    return datastore
+
+
+def use_upload_queue():
+    # imported after make_app has made ckan importable
+    from ckanext.excelforms import upload_queue
+    upload_queue.set_queue(upload_queue.UploadQueue())
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def worker(num, app, upload_path, opts, start_barrier=None):
+    """
+    Run requests for one worker, returns ({operation: [seconds]}, maxrss_kb)
+    """
+    rnd = random.Random(num)
+    client = app.test_client()
+    weights = [int(w) for w in opts['--mix'].split(':')]
+    edit_ids = '&'.join(
+        '_id={0}'.format(i + 1) for i in range(int(opts['--edit-rows'])))
+    with open(upload_path, 'rb') as f:
+        upload_data = f.read()
+    upload_name = os.path.basename(upload_path)
+
+    latencies = {op: [] for op in OPERATIONS}
+    if start_barrier:
+        start_barrier.wait()
+    for i in range(int(opts['--requests'])):
+        op = rnd.choices(OPERATIONS, weights)[0]
+        start = perf_counter()
+        if op == 'upload':
+            response = client.post(
+                '/dataset/{0}/excelforms/{1}/upload'.format(
+                    PACKAGE_ID, RESOURCE_ID),
+                data={'xls_update': (BytesIO(upload_data), upload_name)},
+                headers={'X-User': 'worker{0}'.format(num)})
+            result = response.get_json()
+            if result and result['result'] == 'error':
+                raise RuntimeError(result['message'])
+        else:
+            url = '/dataset/{0}/excelforms/template-{1}.xlsx'.format(
+                PACKAGE_ID, RESOURCE_ID)
+            if op == 'edit':
+                url += '?' + edit_ids
+            response = client.get(url)
+            response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError('{0} returned {1}'.format(
+                op, response.status_code))
+        latencies[op].append(perf_counter() - start)
+    return latencies, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def process_worker(num, upload_path, opts):
+    """
+    worker with its own app and datastore, for --processes
+    """
+    datastore = new_datastore(
+        float(opts['--latency']) / 1000, int(opts['--edit-rows']))
+    app = make_app(datastore)
+    if opts['--queue']:
+        use_upload_queue()
+    return worker(num, app, upload_path, opts)
+
+
+def main():
+    opts = docopt(__doc__)
+    workers = int(opts['--workers'])
+    fd, upload_path = tempfile.mkstemp(
+        suffix='.csv' if opts['--csv'] else '.xlsx')
+    os.close(fd)
+    try:
+        if opts['--csv']:
+            write_upload_csv(upload_path, int(opts['--upload-rows']))
+        else:
+            write_upload(upload_path, int(opts['--upload-rows']))
+
+        start = perf_counter()
+        if opts['--processes']:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(
+                    process_worker,
+                    range(workers),
+                    [upload_path] * workers,
+                    [opts] * workers))
+        else:
+            datastore = new_datastore(
+                float(opts['--latency']) / 1000, int(opts['--edit-rows']))
+            app = make_app(datastore)
+            if opts['--queue']:
+                use_upload_queue()
+            barrier = threading.Barrier(workers)
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(
+                    lambda n: worker(n, app, upload_path, opts, barrier),
+                    range(workers)))
+        elapsed = perf_counter() - start
+    finally:
+        os.unlink(upload_path)
+
+    total = sum(len(v) for lat, rss in results for v in lat.values())
+    print('{0} requests in {1:.2f}s: {2:.2f} requests/s'.format(
+        total, elapsed, total / elapsed))
+    for op in OPERATIONS:
+        values = [v for lat, rss in results for v in lat[op]]
+        if not values:
+            continue
+        print('  {0:<10}{1:6d} requests  p50 {2:7.3f}s  p95 {3:7.3f}s  '
+            'p99 {4:7.3f}s'.format(
+                op,
+                len(values),
+                percentile(values, 50),
+                percentile(values, 95),
+                percentile(values, 99)))
+    if opts['--processes']:
+        for n, (lat, rss) in enumerate(results):
+            print('  worker {0} peak memory {1:.1f} MB'.format(n, rss / 1024.0))
+    else:
+        print('  peak memory {0:.1f} MB (all threads)'.format(
+            results[0][1] / 1024.0))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
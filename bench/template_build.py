@@ -0,0 +1,79 @@
+"""
+Time blank template builds for wide tables, building the e1 and r1
+sheets in the request or in a pool of worker processes
+
+Usage:
+    template_build.py [options] [COLUMNS ...]
+
+Arguments:
+    COLUMNS          numbers of data columns, 20 80 and 200 when not given
+
+Options:
+    --workers=N      worker processes for the pooled builds [default: 2]
+    --repeat=R       repeat timings R times and keep the best [default: 3]
+"""
+
+import multiprocessing
+import sys
+from io import BytesIO
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+from docopt import docopt
+
+from fakeckan import FakeDatastore, install, ensure_ckan_modules
+from workbooks import FIELDS, RESOURCE_ID
+
+DEFAULT_COLUMNS = [20, 80, 200]
+
+
+def wide_fields(num_columns):
+    return [
+        dict(f, id='{0}_{1}'.format(f['id'], i // len(FIELDS)),
+            tdpkreq=f.get('tdpkreq') if i < len(FIELDS) else None)
+        for i, f in zip(range(num_columns), FIELDS * num_columns)]
+
+
+def build(write_excel, resource, dd, pool):
+    book = write_excel.excel_template(resource, dd, [], pool=pool)
+    book.save(BytesIO())
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        fn(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    opts = docopt(__doc__)
+    sizes = [int(n) for n in opts['COLUMNS']] or DEFAULT_COLUMNS
+    repeat = int(opts['--repeat'])
+    install(FakeDatastore())
+    from ckanext.excelforms import write_excel
+
+    pool = ProcessPoolExecutor(
+        int(opts['--workers']),
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=ensure_ckan_modules)
+    try:
+        # start the workers before timing
+        list(pool.map(abs, range(int(opts['--workers']))))
+        for num_columns in sizes:
+            resource = {
+                'id': RESOURCE_ID, 'package_id': 'bench', 'name': 'Bench'}
+            dd = [{'id': '_id', 'type': 'int'}] + wide_fields(num_columns)
+            print('columns={0}'.format(num_columns))
+            for name, p in (('sequential', None), ('pooled', pool)):
+                elapsed = best_of(repeat, build, write_excel, resource, dd, p)
+                print('  {0:<14}{1:9.3f}s'.format(name, elapsed))
+    finally:
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""
+Benchmark the excelforms upload parse and canonicalize path
+
+Generates upload workbooks in the template layout and times each
+stage of reading them back the way blueprint._process_upload_file
+does, with the datastore_upsert call stubbed out.
+
+Usage:
+    upload_parse.py [options] [ROWS ...]
+
+Arguments:
+    ROWS             numbers of data rows to generate, 1000 10000 and
+                     100000 when not given
+
+Options:
+    --workdir=DIR    keep generated workbooks in DIR and reuse them
+                     on later runs
+    --memory         measure peak memory of the pipeline with tracemalloc
+                     (slows the measured run)
+    --repeat=R       repeat timings R times and keep the best [default: 1]
+    --streaming      read with the streaming reader, shared strings on disk
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import openpyxl
+from docopt import docopt
+
+from ckanext.excelforms.read_excel import (
+    read_excel, get_records, _filter_bumf, HEADER_ROWS_V3)
+from ckanext.excelforms.xlsx_stream import StreamingWorkbook
+
+from workbooks import write_upload, FIELDS
+
+DEFAULT_ROWS = [1000, 10000, 100000]
+
+
+def upsert_stub(records):
+    """
+    stands in for lc.action.datastore_upsert: build the records
+    argument exactly as _process_upload_file does
+    """
+    return len(records.dicts())
+
+
+def stage_times(path, streaming):
+    """
+    Return {stage: seconds} for one read of path, each stage fully
+    materialized before the next one starts
+    """
+    times = {}
+
+    start = perf_counter()
+    sheet_name, res_id, column_names, rows = next(
+        read_excel(path, streaming=streaming))
+    times['open'] = perf_counter() - start
+
+    # raw row parsing, separate from read_excel's filtering
+    start = perf_counter()
+    if streaming:
+        wb = StreamingWorkbook(path)
+        rowiter = iter(wb.rows(sheet_name))
+    else:
+        wb = openpyxl.load_workbook(path, read_only=True)
+        rowiter = wb[sheet_name].iter_rows(values_only=True)
+    for i in range(HEADER_ROWS_V3):
+        next(rowiter)
+    raw = [row[2:] for row in rowiter]
+    times['parse'] = perf_counter() - start
+    wb.close()
+
+    start = perf_counter()
+    filtered = list(_filter_bumf(iter(raw), HEADER_ROWS_V3))
+    times['filter'] = perf_counter() - start
+    del raw
+
+    start = perf_counter()
+    records = get_records(filtered, FIELDS, [], {})
+    times['canonicalize'] = perf_counter() - start
+
+    start = perf_counter()
+    upsert_stub(records)
+    times['upsert'] = perf_counter() - start
+    return times, len(records)
+
+
+def pipeline(path, streaming):
+    """
+    Streaming read the way _process_upload_file runs it, returns
+    number of records
+    """
+    sheet_name, res_id, column_names, rows = next(
+        read_excel(path, streaming=streaming))
+    records = get_records(rows, FIELDS, [], {})
+    return upsert_stub(records)
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for i in range(repeat):
+        start = perf_counter()
+        result = fn(*args)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, result)
+    return best
+
+
+def run(num_rows, workdir, memory, repeat, streaming):
+    path = os.path.join(workdir, 'upload-{0}.xlsx'.format(num_rows))
+    if not os.path.exists(path):
+        start = perf_counter()
+        write_upload(path, num_rows)
+        print('generated {0} ({1:.1f}s, {2:.1f} MB)'.format(
+            path, perf_counter() - start, os.path.getsize(path) / 2.0 ** 20))
+
+    times = None
+    for i in range(repeat):
+        t, count = stage_times(path, streaming)
+        if times is None:
+            times = t
+        else:
+            times = {k: min(v, t[k]) for k, v in times.items()}
+
+    elapsed, count = best_of(repeat, pipeline, path, streaming)
+
+    print('rows={0} records={1}'.format(num_rows, count))
+    for stage in ('open', 'parse', 'filter', 'canonicalize', 'upsert'):
+        print('  {0:<14}{1:9.3f}s {2:12,.0f} rows/s'.format(
+            stage, times[stage], num_rows / times[stage]))
+    print('  {0:<14}{1:9.3f}s {2:12,.0f} rows/s'.format(
+        'pipeline', elapsed, num_rows / elapsed))
+
+    if memory:
+        tracemalloc.start()
+        pipeline(path, streaming)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('  {0:<14}{1:9.1f} MB'.format('peak memory', peak / 2.0 ** 20))
+
+        # reading rows alone, without keeping records
+        tracemalloc.start()
+        sheet_name, res_id, column_names, rows = next(
+            read_excel(path, streaming=streaming))
+        for row in rows:
+            pass
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('  {0:<14}{1:9.1f} MB'.format('  rows only', peak / 2.0 ** 20))
+
+
+def main():
+    opts = docopt(__doc__)
+    sizes = [int(n) for n in opts['ROWS']] or DEFAULT_ROWS
+    repeat = int(opts['--repeat'])
+    workdir = opts['--workdir']
+    if workdir:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        for n in sizes:
+            run(n, workdir, opts['--memory'], repeat, opts['--streaming'])
+        return
+
+    workdir = tempfile.mkdtemp(prefix='excelforms-bench-')
+    try:
+        for n in sizes:
+            run(n, workdir, opts['--memory'], repeat, opts['--streaming'])
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
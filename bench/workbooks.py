@@ -0,0 +1,211 @@
+"""
+Synthetic excelforms uploads for benchmarking
+
+Workbooks written here follow the layout produced by
+ckanext.excelforms.write_excel.excel_template (five header rows, the
+xlf_v1 version marker and resource id on the code row, data from row 6
+column C) so read_excel accepts them as real uploads.
+"""
+
+import csv
+import os
+import re
+import random
+import zipfile
+from datetime import datetime, timedelta
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+RESOURCE_ID = '00000000-0000-0000-0000-000000000000'
+
+# data dictionary in datastore_info format
+FIELDS = [
+    {'id': 'ref_number', 'type': 'text', 'tdpkreq': 'pk'},
+    {'id': 'title', 'type': 'text'},
+    {'id': 'description', 'type': 'text'},
+    {'id': 'quantity', 'type': 'int'},
+    {'id': 'population', 'type': 'bigint'},
+    {'id': 'amount', 'type': 'money'},
+    {'id': 'ratio', 'type': 'numeric'},
+    {'id': 'start_date', 'type': 'date'},
+    {'id': 'updated', 'type': 'timestamp'},
+    {'id': 'fiscal_year', 'type': 'year'},
+    {'id': 'active', 'type': 'boolean'},
+    {'id': 'province', 'type': 'text'},
+    {'id': 'keywords', 'type': '_text'},
+]
+
+PROVINCES = ['AB', 'BC', 'MB', 'NB', 'NL', 'NS', 'NT', 'NU', 'ON', 'PE',
+    'QC', 'SK', 'YT']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+    'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+EPOCH = datetime(2018, 1, 1)
+
+
+def _noise(rnd, value):
+    """
+    Surround some values with the whitespace users paste into cells
+    """
+    r = rnd.random()
+    if r < 0.05:
+        return u'  ' + value + u'\t'
+    if r < 0.08:
+        return u'\n' + value + u' '
+    return value
+
+
+def _words(rnd, n):
+    return u' '.join(rnd.choice(WORDS) for i in range(n))
+
+
+def _value(rnd, field, i):
+    ftype = field['type']
+    if field.get('tdpkreq') == 'pk':
+        return _noise(rnd, u'REF-{0:07d}'.format(i))
+    if field['id'] == 'province':
+        return _noise(rnd, rnd.choice(PROVINCES))
+    if rnd.random() < 0.1:
+        return None  # sparse data
+    if ftype == 'text':
+        if rnd.random() < 0.05:
+            # line endings stored by excel in shared strings
+            return _words(rnd, 4) + u'_x000D_\n' + _words(rnd, 6)
+        return _noise(rnd, _words(rnd, rnd.randint(1, 12)))
+    if ftype in ('int', 'bigint'):
+        if rnd.random() < 0.2:
+            return u'{0:,}'.format(rnd.randint(0, 10 ** 6))
+        return rnd.randint(0, 10 ** 6)
+    if ftype == 'money':
+        if rnd.random() < 0.2:
+            return u'${0:,.2f}'.format(rnd.random() * 10 ** 5)
+        return round(rnd.random() * 10 ** 5, 2)
+    if ftype == 'numeric':
+        return rnd.random() * 100
+    if ftype == 'date':
+        return EPOCH + timedelta(days=rnd.randint(0, 3650))
+    if ftype == 'timestamp':
+        return EPOCH + timedelta(seconds=rnd.randint(0, 10 ** 8))
+    if ftype == 'year':
+        return rnd.randint(2000, 2030)
+    if ftype == 'boolean':
+        return rnd.choice([u'TRUE', u'FALSE', True, False])
+    if ftype == '_text':
+        return u', '.join(rnd.choice(WORDS) for i in range(rnd.randint(1, 4)))
+    return _words(rnd, 2)
+
+
+def write_upload(path, num_rows, fields=FIELDS, resource_id=RESOURCE_ID,
+        trailing_columns=3, blank_rows=0.01, seed=0, shared_strings=True):
+    """
+    Write an upload workbook with num_rows data rows of mixed types to path.
+
+    trailing_columns styled but empty cells are added after the data
+    columns on every row, the way custom styles applied by users
+    show up in real uploads. blank_rows is the fraction of data
+    rows left empty. With shared_strings text is moved to a shared
+    string table like workbooks saved by Excel, instead of the inline
+    strings openpyxl writes.
+    """
+    rnd = random.Random(seed)
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet('data')
+    font = Font(bold=True)
+
+    def trailing():
+        cells = []
+        for i in range(trailing_columns):
+            c = WriteOnlyCell(sheet)
+            c.font = font
+            cells.append(c)
+        return cells
+
+    sheet.append([None, None, u'Benchmark resource'])
+    sheet.append([None, None] + [f['id'].title() for f in fields])
+    sheet.append([u'xlf_v1', resource_id] + [f['id'] for f in fields]
+        + trailing())
+    sheet.append([])
+    sheet.append([u'e.g.'])
+
+    for i in range(num_rows):
+        if rnd.random() < blank_rows:
+            sheet.append([None, None] + trailing())
+            continue
+        sheet.append(
+            [None, None] + [_value(rnd, f, i) for f in fields] + trailing())
+
+    sheet = book.create_sheet('reference')
+    sheet.append([u'Reference'])
+    book.save(path)
+    if shared_strings:
+        _share_strings(path)
+
+
+def write_upload_csv(path, num_rows, fields=FIELDS, blank_rows=0.01, seed=0):
+    """
+    Write a CSV upload with the same records as write_upload to path
+    """
+    rnd = random.Random(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow([f['id'] for f in fields])
+        for i in range(num_rows):
+            if rnd.random() < blank_rows:
+                writer.writerow([])
+                continue
+            values = [_value(rnd, f, i) for f in fields]
+            writer.writerow([
+                v.replace(u'_x000D_', u'\r') if isinstance(v, str) else v
+                for v in values])
+
+
+INLINE_STR_RE = re.compile(
+    r't="inlineStr"><is><t(?: [^>]*)?>(.*?)</t></is>', re.S)
+SST_CONTENT_TYPE = (
+    'application/vnd.openxmlformats-officedocument.spreadsheetml'
+    '.sharedStrings+xml')
+SST_REL_TYPE = (
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    '/sharedStrings')
+
+
+def _share_strings(path):
+    """
+    Rewrite the inline strings in the worksheets of path as references
+    to a shared string table
+    """
+    strings = {}
+
+    def share(m):
+        index = strings.setdefault(m.group(1), len(strings))
+        return 't="s"><v>{0}</v>'.format(index)
+
+    tmp = path + '.tmp'
+    with zipfile.ZipFile(path) as zin, \
+            zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            data = zin.read(info.filename)
+            if info.filename.startswith('xl/worksheets/'):
+                data = INLINE_STR_RE.sub(share, data.decode('utf-8'))
+            elif info.filename == '[Content_Types].xml':
+                data = data.decode('utf-8').replace('</Types>',
+                    '<Override PartName="/xl/sharedStrings.xml" '
+                    'ContentType="{0}"/></Types>'.format(SST_CONTENT_TYPE))
+            elif info.filename == 'xl/_rels/workbook.xml.rels':
+                data = data.decode('utf-8').replace('</Relationships>',
+                    '<Relationship Id="rIdSharedStrings" Type="{0}" '
+                    'Target="sharedStrings.xml"/></Relationships>'.format(
+                        SST_REL_TYPE))
+            zout.writestr(info, data)
+        with zout.open('xl/sharedStrings.xml', 'w') as sst:
+            sst.write(
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml'
+                '/2006/main" count="{0}" uniqueCount="{0}">'.format(
+                    len(strings)).encode('utf-8'))
+            for text in strings:
+                sst.write('<si><t xml:space="preserve">{0}</t></si>'.format(
+                    text).encode('utf-8'))
+            sst.write(b'</sst>')
+    os.replace(tmp, path)
@@ -1,43 +1,104 @@
+import functools
+import hashlib
+import json
 import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 from logging import getLogger
 
-from flask import Response, Blueprint
+from flask import (
+    Response, Blueprint, copy_current_request_context, send_file
+)
 from ckan.plugins.toolkit import (
-    _, config, asbool, request, h, abort, g
+    _, config, asbool, request, h, abort, g, check_access, render_template
 )
 from ckan.logic import ValidationError, NotAuthorized
+import ckan.model as model
 
+from ckanext.excelforms.checkpoint import (
+    checkpoint_dir, checkpoint_max_age, write_checkpointed
+)
+from ckanext.excelforms.copy_load import copy_min_records, copy_records
+from ckanext.excelforms.datatypes import choice_indexes
 from ckanext.excelforms.errors import BadExcelData
-from ckanext.excelforms.read_excel import read_excel, get_records
-from ckanext.excelforms.write_excel import excel_template
+from ckanext.excelforms.export_jobs import (
+    async_export_records, enqueue_export, export_dir, export_path,
+    read_status, sendfile_header
+)
+from ckanext.excelforms.metrics import Recorder
+from ckanext.excelforms.prefetch import Prefetch
+from ckanext.excelforms.profiling import profiled
+from ckanext.excelforms.template_pool import get_pool
+from ckanext.excelforms.upload_queue import get_queue
 
 from io import BytesIO
 
-import ckanapi
-
 EXCEL_CT = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+ZIP_CT = 'application/zip'
 
 log = getLogger(__name__)
 
 excelforms = Blueprint('excelforms', __name__)
 
 
+# openpyxl, ckanapi and the modules using them are imported on first use
+# so that loading the plugin stays fast in CLI commands and workers that
+# never build or read a template, see prewarm
+
+
+def _local_ckan(username):
+    import ckanapi
+    return ckanapi.LocalCKAN(username=username)
+
+
+def _in_thread(fn):
+    """
+    Wrap fn for running in another thread with the current request
+    context, removing the thread's database session when it returns so
+    its connection goes back to the pool
+    """
+    fn = copy_current_request_context(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            model.Session.remove()
+    return wrapper
+
+
 def _get_data_dictionary(lc, resource_id):
     table = lc.action.datastore_info(id=resource_id)
     return table['fields']
 
 
+def _dd_fingerprint(resource_id):
+    """
+    Return a hash of the data dictionary of resource_id for tagging
+    profiles, see profiling
+    """
+    dd = _get_data_dictionary(
+        _local_ckan(g.user), resource_id)
+    return hashlib.sha1(
+        json.dumps(dd, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 @excelforms.route(
     '/dataset/<id>/excelforms/<resource_id>/upload', methods=['POST'])
+@profiled('upload', _dd_fingerprint)
 def upload(id, resource_id):
     """
     View for downloading Excel templates and
-    uploading packages via Excel .xls files
+    uploading packages via Excel .xls files or CSV/TSV files
     """
-    lc = ckanapi.LocalCKAN(username=g.user)
-    dd = _get_data_dictionary(lc, resource_id)
+    recorder = Recorder('upload', resource_id=resource_id)
+    lc = _local_ckan(g.user)
+    with recorder.stage('datastore_info'):
+        dd = _get_data_dictionary(lc, resource_id)
     dry_run = 'validate' in request.form
+    recorder.count('bytes', request.content_length or 0)
     try:
         if not request.files['xls_update']:
             raise BadExcelData(_('You must provide a valid file'))
@@ -47,7 +108,8 @@ def upload(id, resource_id):
             resource_id,
             request.files['xls_update'],
             dd,
-            dry_run)
+            dry_run,
+            recorder)
 
         if dry_run:
             h.flash_success(_(
@@ -59,7 +121,10 @@ def upload(id, resource_id):
                 ))
 
     except BadExcelData as e:
+        recorder.count('errors')
         h.flash_error(e.message)
+    finally:
+        recorder.report()
 
     return h.redirect_to(
         'dataset_resource.read', id=id, resource_id=resource_id)
@@ -90,6 +155,7 @@ def _xlsx_response_headers():
 
 @excelforms.route(
     '/dataset/<id>/excelforms/template-<resource_id>.xlsx', methods=['GET'])
+@profiled('template', _dd_fingerprint)
 def template(id, resource_id):
     """
     Generate excel template
@@ -98,32 +164,75 @@ def template(id, resource_id):
     to be included in the excel file
     Parameters:
         _id -> an array of strings, each string contains an _id column value
+        lite -> true for a template without formulas, validation and
+            formatting, for generating uploads programmatically
     """
 
-    lc = ckanapi.LocalCKAN(username=g.user)
-    dd = _get_data_dictionary(lc, resource_id)
-    resource = lc.action.resource_show(id=resource_id)
+    recorder = Recorder('template', resource_id=resource_id)
+    lc = _local_ckan(g.user)
+    with recorder.stage('datastore_info'):
+        dd = _get_data_dictionary(lc, resource_id)
+    with recorder.stage('resource_show'):
+        resource = lc.action.resource_show(id=resource_id)
 
     _ids = request.params.getlist('_id')
+    lite = asbool(request.params.get('lite', False))
     records = []
 
-    if _ids:
-        filters = {'_id': _ids}
-
+    async_records = async_export_records(config)
+    if async_records and len(_ids) >= async_records:
         try:
-            result = lc.action.datastore_search(
-                resource_id=resource_id,
-                filters=filters,
-            )
+            check_access(
+                'datastore_search',
+                {'user': g.user},
+                {'resource_id': resource_id})
         except NotAuthorized:
             return abort(403, _("Not authorized"))
+        export_id = enqueue_export(
+            resource, g.user, _ids, lite, h.lang(), _part_records())
+        recorder.count('background_exports')
+        recorder.report()
+        return h.redirect_to(
+            'excelforms.export',
+            id=id,
+            resource_id=resource_id,
+            export_id=export_id)
 
-        records = result['records']
+    part_records = _part_records()
+    if len(set(_ids)) > part_records:
+        blob = BytesIO()
+        try:
+            _write_template_parts(
+                blob, lc, resource, dd, _ids, lite, part_records, recorder)
+        except NotAuthorized:
+            recorder.count('errors')
+            recorder.report()
+            return abort(403, _("Not authorized"))
+        except ValueError:
+            recorder.count('errors')
+            recorder.report()
+            return abort(400, _("Invalid _id"))
+        recorder.count('bytes', blob.tell())
+        recorder.report()
+        response = Response(blob.getvalue())
+        response.content_type = ZIP_CT
+        response.headers['Content-Disposition'] = (
+            'attachment; filename="template_{0}.zip"'.format(resource_id))
+        return response
 
-    book = excel_template(resource, dd, records)
+    if _ids:
+        try:
+            records = _edit_records(lc, resource_id, dd, _ids, recorder)
+        except NotAuthorized:
+            recorder.count('errors')
+            recorder.report()
+            return abort(403, _("Not authorized"))
 
+    recorder.count('rows', len(records))
     blob = BytesIO()
-    book.save(blob)
+    _write_template(blob, resource, dd, records, lite, recorder)
+    recorder.count('bytes', blob.tell())
+    recorder.report()
     response = Response(blob.getvalue())
     content_type, disposition_type = _xlsx_response_headers()
     response.content_type = content_type
@@ -132,13 +241,224 @@ def template(id, resource_id):
     return response
 
 
-def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
+def _write_template(out, resource, dd, records, lite, recorder):
+    """
+    Build the template for resource with records and save it to out
+    """
+    from ckanext.excelforms.splice import base_template, record_rows
+    from ckanext.excelforms.write_excel import excel_template
+
+    if records and not lite and asbool(
+            config.get('ckanext.excelforms.splice_edit_templates', False)):
+        with recorder.stage('base_template'):
+            base = base_template(
+                resource,
+                dd,
+                h.lang(),
+                int(config.get('ckanext.excelforms.template_cache_size', 32)),
+                recorder)
+        with recorder.stage('splice'):
+            base.write(out, record_rows(dd, records), len(records))
+    else:
+        book = excel_template(
+            resource,
+            dd,
+            records,
+            recorder,
+            lite,
+            int(config.get('ckanext.excelforms.table_rows', 0)),
+            get_pool())
+        with recorder.stage('save'):
+            book.save(out)
+
+
+def _part_records():
+    """
+    Return the most records for one edit template, more are split
+    into parts by _write_template_parts
+    """
+    from ckanext.excelforms.write_excel import MAX_DATA_NUM_ROWS
+
+    return min(
+        int(config.get(
+            'ckanext.excelforms.edit_part_records', MAX_DATA_NUM_ROWS)),
+        MAX_DATA_NUM_ROWS)
+
+
+def _write_template_parts(
+        out, lc, resource, dd, _ids, lite, part_records, recorder,
+        progress=None):
+    """
+    Split the records _ids by _id range into edit templates of up to
+    part_records records, built concurrently in
+    ckanext.excelforms.edit_part_workers threads, and save them to out
+    as a zip file. Each part is a complete template that can be
+    uploaded on its own.
+
+    progress(n) is called with the number of records in each part
+    as it is written
+
+    raises ValueError if an _id isn't an integer
+    """
+    _ids = sorted(set(_ids), key=int)
+    parts = [
+        _ids[i:i + part_records] for i in range(0, len(_ids), part_records)]
+    recorder.count('parts', len(parts))
+
+    def build(part_ids):
+        # Recorders aren't thread safe, part stages aren't reported
+        part_recorder = Recorder()
+        blob = BytesIO()
+        records = _edit_records(
+            lc, resource['id'], dd, part_ids, part_recorder)
+        _write_template(blob, resource, dd, records, lite, part_recorder)
+        return blob.getvalue(), len(records)
+
+    workers = int(config.get('ckanext.excelforms.edit_part_workers', 2))
+    with recorder.stage('build_parts'), ThreadPoolExecutor(workers) as pool:
+        futures = [
+            pool.submit(_in_thread(build), part_ids)
+            for part_ids in parts]
+        # xlsx files are already compressed
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as z:
+            for num, future in enumerate(futures, 1):
+                xlsx, num_records = future.result()
+                z.writestr(
+                    'template_{0}_part{1}.xlsx'.format(resource['id'], num),
+                    xlsx)
+                recorder.count('rows', num_records)
+                if progress:
+                    progress(num_records)
+
+
+@excelforms.route(
+    '/dataset/<id>/excelforms/<resource_id>/export/<export_id>',
+    methods=['GET'])
+def export(id, resource_id, export_id):
+    """
+    Status page for a background edit template export, see export_jobs
+    """
+    status = _export_status(resource_id, export_id)
+    return render_template(
+        'excelforms/export.html',
+        pkg_id=id,
+        resource_id=resource_id,
+        export_id=export_id,
+        status=status)
+
+
+@excelforms.route(
+    '/dataset/<id>/excelforms/<resource_id>/export/<export_id>/download',
+    methods=['GET'])
+def export_download(id, resource_id, export_id):
+    """
+    Download the template built by a background export
+    """
+    status = _export_status(resource_id, export_id)
+    if status['state'] != 'done':
+        return abort(404, _("Export not found"))
+    ext = status.get('ext', '.xlsx')
+    if ext == '.zip':
+        content_type, disposition_type = ZIP_CT, 'attachment'
+    else:
+        content_type, disposition_type = _xlsx_response_headers()
+    header = sendfile_header(config, export_id, ext)
+    if header:
+        # the web server sends the file, with range support
+        response = Response(mimetype=content_type)
+        response.headers[header[0]] = header[1]
+    else:
+        response = send_file(
+            export_path(export_dir(config), export_id, ext),
+            mimetype=content_type,
+            conditional=True)
+    response.headers['Content-Disposition'] = (
+        '{0}; filename="template_{1}{2}"'.format(
+            disposition_type, resource_id, ext))
+    return response
+
+
+def _export_status(resource_id, export_id):
+    """
+    Return the status of export_id, aborting with 404 unless it exists
+    and was requested by the current user for resource_id
+    """
+    directory = export_dir(config)
+    status = read_status(directory, export_id) if directory else None
+    if (not status or status['resource_id'] != resource_id
+            or status['user'] != g.user):
+        return abort(404, _("Export not found"))
+    return status
+
+
+def _edit_records(lc, resource_id, dd, _ids, recorder):
+    """
+    Return the records selected for an edit template as lists of values
+    in template column order. More than
+    ckanext.excelforms.edit_page_records records are returned as a
+    RecordPages fetching pages of that many records in a background
+    thread while the workbook is written, with up to
+    ckanext.excelforms.edit_prefetch_pages pages fetched ahead, and a
+    length of the number of _ids selected.
+    """
+    from ckanext.excelforms.write_excel import RecordPages
+
+    page_size = int(config.get('ckanext.excelforms.edit_page_records', 1000))
+    depth = int(config.get('ckanext.excelforms.edit_prefetch_pages', 2))
+    _ids = list(dict.fromkeys(_ids))
+
+    def search(ids):
+        return lc.action.datastore_search(
+            resource_id=resource_id,
+            filters={'_id': ids},
+            fields=[f['id'] for f in dd],
+            records_format='lists',
+            limit=len(ids),
+            include_total=False,
+        )['records']
+
+    if len(_ids) <= page_size:
+        with recorder.stage('datastore_search'):
+            return search(_ids)
+
+    recorder.count('pages', -(-len(_ids) // page_size))
+    pages = Prefetch(
+        (search(_ids[i:i + page_size])
+            for i in range(0, len(_ids), page_size)),
+        depth,
+        _in_thread)
+    # records removed since they were selected leave empty rows at the
+    # end, see splice.record_rows. time the writer spends waiting for pages
+    return RecordPages(
+        len(_ids), recorder.timed_iter('datastore_search', pages))
+
+
+def _process_upload_file(
+        lc, resource_id, upload_file, dd, dry_run, recorder=None):
     """
     Use lc.action.datastore_upsert to load data from upload_file
 
+    recorder is a metrics.Recorder for stage timings and row/cell counts,
+    the datastore_upsert method used is added to its tags
+
     raises BadExcelData on errors.
     """
-    upload_data = read_excel(upload_file)
+    from ckanext.excelforms.read_csv import csv_delimiter
+    from ckanext.excelforms.read_excel import read_excel, get_records
+
+    recorder = recorder or Recorder()
+    delimiter = csv_delimiter(
+        getattr(upload_file, 'filename', None),
+        getattr(upload_file, 'mimetype', None))
+    if delimiter:
+        return _process_upload_csv(
+            lc, resource_id, upload_file, delimiter, dd, dry_run, recorder)
+
+    upload_data = read_excel(
+        upload_file,
+        recorder=recorder,
+        streaming=asbool(
+            config.get('ckanext.excelforms.streaming_reader', False)))
     total_records = 0
     try:
         sheet_name, res_id, column_names, rows = next(upload_data)
@@ -155,11 +475,132 @@ def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
             "version of the template and uploading again."
         ))
 
-    if resource_id != res_id:
-        raise BadExcelData(
-            _("This template is for a different resource: {0}").format(res_id)
-        )
+    try:
+        if resource_id != res_id:
+            raise BadExcelData(_(
+                "This template is for a different resource: {0}"
+            ).format(res_id))
+
+        update_action = _match_columns(column_names, dd)
+        if update_action is None:
+            raise BadExcelData(_(
+                "This template is out of date. "
+                "Please try copying your data into the latest "
+                "version of the template and uploading again."
+            ))
+
+        pk = []
+#        pk = chromo.get('datastore_primary_key', [])
+        fields, choice_fields, method = _upload_fields(dd, update_action)
+        recorder.tags['method'] = method
+
+        with recorder.stage('canonicalize'):
+            records = get_records(
+                rows,
+                fields,
+                pk,
+                choice_fields)
+    finally:
+        # release the workbook's files now, also after errors
+        rows.close()
+    recorder.count('rows', len(records))
+    recorder.count('cells', len(records) * len(fields))
+    total_records += len(records)
+    if not records:
+        raise BadExcelData(_("The template uploaded is empty"))
+    directory = checkpoint_dir(config)
+    if directory and not dry_run:
+        _write_checkpointed(
+            lc,
+            resource_id,
+            method,
+            directory,
+            records.slices(int(config.get(
+                'ckanext.excelforms.checkpoint_batch_records', 5000))),
+            recorder)
+        return
+    _write_records(lc, resource_id, method, dry_run, records, recorder)
+
+
+def _process_upload_csv(
+        lc, resource_id, upload_file, delimiter, dd, dry_run, recorder):
+    """
+    Load data from a CSV or TSV upload_file with column names on the
+    first line, writing ckanext.excelforms.csv_batch_records records
+    at a time. Batches before one with errors stay written and the
+    error says how many records were saved.
+
+    Without checkpoints a failed insert can't be resumed and uploading
+    the corrected file would insert the saved records again, so
+    tables without a primary key are written in one call instead.
+
+    raises BadExcelData on errors.
+    """
+    from ckanext.excelforms.read_csv import read_csv, batches
+    from ckanext.excelforms.read_excel import get_records
+
+    column_names, rows = read_csv(
+        getattr(upload_file, 'stream', upload_file), delimiter, recorder)
+    update_action = _match_columns(column_names, dd)
+    if update_action is None:
+        raise BadExcelData(_(
+            "The column names on the first line must match the "
+            "data dictionary: {0}"
+        ).format(u', '.join(f['id'] for f in dd if f['id'] != '_id')))
 
+    pk = []
+    fields, choice_fields, method = _upload_fields(dd, update_action)
+    recorder.tags['method'] = method
+    batch_size = int(config.get('ckanext.excelforms.csv_batch_records', 5000))
+
+    def record_batches():
+        for batch in batches(rows, batch_size):
+            with recorder.stage('canonicalize'):
+                records = get_records(batch, fields, pk, choice_fields)
+            recorder.count('rows', len(records))
+            recorder.count('cells', len(records) * len(fields))
+            yield records
+
+    directory = checkpoint_dir(config)
+    if directory and not dry_run:
+        _write_checkpointed(
+            lc, resource_id, method, directory, record_batches(), recorder)
+    elif method == 'insert' and not dry_run:
+        records = None
+        for batch in record_batches():
+            if records is None:
+                records = batch
+            else:
+                records.extend(batch)
+        if records:
+            _write_records(
+                lc, resource_id, method, dry_run, records, recorder)
+    else:
+        saved = 0
+        try:
+            for records in record_batches():
+                _write_records(
+                    lc, resource_id, method, dry_run, records, recorder)
+                if not dry_run:
+                    saved += len(records)
+        except BadExcelData as e:
+            if not saved:
+                raise
+            raise BadExcelData(
+                _(u"{0} records were saved before this error.").format(
+                    saved) + u' ' + e.message,
+                e.row)
+    if not recorder.counters.get('rows'):
+        raise BadExcelData(_("The file uploaded is empty"))
+
+
+def _match_columns(column_names, dd):
+    """
+    Return True when column_names are the fields in dd for updating
+    records (starting with _id), False when they are the fields for
+    inserting or upserting and None when they don't match
+    """
+    column_names = list(column_names)
     # custom styles or other errors cause columns to be read
     # that actually have no data. strip them here to avoid error below
     while column_names and column_names[-1] is None:
@@ -172,39 +613,114 @@ def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
         del column_names[0]
 
     if column_names != expected_columns:
-        raise BadExcelData(_(
-            "This template is out of date. "
-            "Please try copying your data into the latest "
-            "version of the template and uploading again."
-        ))
+        return None
+    return update_action
 
-    pk = []
-#    pk = chromo.get('datastore_primary_key', [])
-    choice_fields = {}
-#    choice_fields = {
-#        f['datastore_id']:
-#            'full' if f.get('excel_full_text_choices') else True
-#        for f in chromo['fields']
-#        if ('choices' in f or 'choices_file' in f)}
-
-    records = get_records(
-        rows,
-        [f for f in dd if update_action or f['id'] != '_id'],
-        pk,
-        choice_fields)
+
+def _upload_fields(dd, update_action):
+    """
+    Return (fields, choice_fields, method) for uploading records
+    matching the fields in dd
+    """
+    fields = [f for f in dd if update_action or f['id'] != '_id']
+    choice_fields = choice_indexes(fields, h.tabledesigner_choices)
     has_pk = any(f.get('tdpkreq') == 'pk' for f in dd)
     method = 'update' if update_action else 'upsert' if has_pk else 'insert'
-    total_records += len(records)
-    if not records:
-        raise BadExcelData(_("The template uploaded is empty"))
-    try:
-        lc.action.datastore_upsert(
-            method=method,
-            resource_id=resource_id,
-            records=[r[1] for r in records],
-            dry_run=dry_run,
-            force=True,
+    return fields, choice_fields, method
+
+
+def _write_records(lc, resource_id, method, dry_run, records, recorder):
+    """
+    Write records, a RecordBatch, directly or through the upload queue
+    when one is configured
+
+    raises BadExcelData on errors
+    """
+    queue = get_queue()
+    if queue is None:
+        _datastore_upsert(lc, resource_id, method, dry_run, records, recorder)
+        return
+
+    _check_upsert_access(lc, resource_id)
+    with recorder.stage('upload_queue'):
+        batch_size = queue.submit(
+            resource_id,
+            lc.username,
+            method,
+            dry_run,
+            records,
+            lambda method, dry_run, records: _datastore_upsert(
+                lc, resource_id, method, dry_run, records, recorder))
+    recorder.count('coalesced_uploads', batch_size)
+
+
+def _write_checkpointed(
+        lc, resource_id, method, directory, record_batches, recorder):
+    """
+    Write RecordBatches with _write_records, continuing from the last
+    batch written by an earlier attempt, see checkpoint.py
+
+    raises BadExcelData on errors
+    """
+    def last_id():
+        with recorder.stage('datastore_search'):
+            result = lc.action.datastore_search(
+                resource_id=resource_id,
+                fields=['_id'],
+                sort='_id desc',
+                limit=1,
+                include_total=False,
             )
+        return result['records'][0]['_id'] if result['records'] else 0
+
+    write_checkpointed(
+        directory,
+        resource_id,
+        method,
+        record_batches,
+        lambda records: _write_records(
+            lc, resource_id, method, False, records, recorder),
+        last_id,
+        recorder,
+        checkpoint_max_age(config))
+
+
+def _check_upsert_access(lc, resource_id):
+    """
+    raises BadExcelData if lc's user may not write to resource_id
+    """
+    try:
+        check_access(
+            'datastore_upsert',
+            {'user': lc.username},
+            {'resource_id': resource_id})
+    except NotAuthorized:
+        raise BadExcelData(_("Not authorized to update this resource"))
+
+
+def _datastore_upsert(lc, resource_id, method, dry_run, records, recorder):
+    """
+    Write records, a RecordBatch, with
+    lc.action.datastore_upsert, or COPY for large inserts
+
+    raises BadExcelData on errors, with the row number when known
+    """
+    min_records = copy_min_records(config)
+    if method == 'insert' and min_records and len(records) >= min_records:
+        _check_upsert_access(lc, resource_id)
+        with recorder.stage('datastore_copy'):
+            copy_records(resource_id, records, dry_run, _clean_pgerror)
+        return
+
+    try:
+        with recorder.stage('datastore_upsert'):
+            lc.action.datastore_upsert(
+                method=method,
+                resource_id=resource_id,
+                records=records.dicts(),
+                dry_run=dry_run,
+                force=True,
+                )
     except ValidationError as e:
         if 'info' in e.error_dict:
             # because, where else would you put the error text?
@@ -219,20 +735,28 @@ def _process_upload_file(lc, resource_id, upload_file, dd, dry_run):
                 k + u': ' + u', '.join(v)
                 for k, v in pgerror.items())
         else:
-            # remove some postgres-isms that won't help the user
-            # when we render this as an error in the form
-            pgerror = re.sub(r'\nLINE \d+:', '', pgerror)
-            pgerror = re.sub(r'\n *\^\n$', '', pgerror)
-        head, sep, rerr = pgerror.partition('\t')
-        if head == 'TAB-DELIMITED' and sep:
-            it = iter(rerr.split('\t'))
-            pgerror = '; '.join(k + ': ' + e for (k, e) in zip(it, it))
+            pgerror = _clean_pgerror(pgerror)
         row = e.error_dict.get('records_row', e.error_dict.get('_records_row'))
         if row is not None:
             raise BadExcelData(
-                _(u'Data row {0}:').format(records[row][0])
-                + u' ' + pgerror
+                _(u'Data row {0}:').format(records.row_numbers[row])
+                + u' ' + pgerror,
+                records.row_numbers[row]
             )
         raise BadExcelData(
             _(u"Error while importing data: {0}").format(
                 pgerror))
+
+
+def _clean_pgerror(pgerror):
+    """
+    Remove some postgres-isms that won't help the user when we render
+    this as an error in the form
+    """
+    pgerror = re.sub(r'\nLINE \d+:', '', pgerror)
+    pgerror = re.sub(r'\n *\^\n$', '', pgerror)
+    head, sep, rerr = pgerror.partition('\t')
+    if head == 'TAB-DELIMITED' and sep:
+        it = iter(rerr.split('\t'))
+        pgerror = '; '.join(k + ': ' + e for (k, e) in zip(it, it))
+    return pgerror
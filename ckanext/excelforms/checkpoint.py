@@ -0,0 +1,250 @@
+"""
+Resumable uploads
+
+With ckanext.excelforms.checkpoint_dir set, uploads are written in
+batches and each batch written is recorded in a checkpoint file as a
+hash chained over the canonicalized records of the batches before it.
+When an upload fails part way, uploading the same file again, or a
+copy with the failing rows corrected, skips the batches already
+written and continues from the first one that wasn't. The checkpoint
+is removed once every batch is written. Checkpoints of uploads that
+aren't continued are removed after
+ckanext.excelforms.checkpoint_max_age seconds.
+
+A batch is marked pending while it is written. When a write is
+interrupted by anything other than a data error the pending batch may
+or may not have been committed, so the next attempt rewrites it for
+upsert and update methods, and for inserts checks the highest _id in
+the table to avoid inserting the same rows twice.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from ckan.plugins.toolkit import _
+
+from ckanext.excelforms.errors import BadExcelData
+
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+
+def checkpoint_dir(config):
+    """
+    Return the checkpoint directory, None when disabled
+    """
+    return config.get('ckanext.excelforms.checkpoint_dir') or None
+
+
+def checkpoint_max_age(config):
+    """
+    Return the number of seconds after which checkpoints of abandoned
+    uploads are removed, 0 to keep them
+    """
+    return int(config.get(
+        'ckanext.excelforms.checkpoint_max_age', DEFAULT_MAX_AGE))
+
+
+def remove_expired(directory, max_age, now=None):
+    """
+    Remove checkpoints and lock files last written more than max_age
+    seconds ago, except those of uploads still running
+    """
+    now = time.time() if now is None else now
+    for name in os.listdir(directory):
+        if not name.endswith('.json.lock'):
+            continue
+        path = os.path.join(directory, name[:-len('.lock')])
+        if now - max(_mtime(path), _mtime(path + '.lock')) < max_age:
+            continue
+        try:
+            lock = open(path + '.lock', 'a')
+        except (IOError, OSError):
+            continue
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            continue
+        for p in (path, path + '.tmp', path + '.lock'):
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+        lock.close()
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def batch_hash(previous, records):
+    """
+    Return the chain hash for a RecordBatch following the batch with
+    hash previous. Row numbers aren't included so removing blank rows
+    from a corrected file doesn't change the hashes.
+    """
+    h = hashlib.sha256(previous.encode('ascii'))
+    h.update(json.dumps(records.fields).encode('utf-8'))
+    for values in records.values:
+        h.update(json.dumps(values, ensure_ascii=False).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    Batches written by one upload, locked while open so the same file
+    can't be uploaded twice at once
+    """
+    def __init__(self, directory, resource_id, first_hash):
+        self.path = os.path.join(
+            directory, u'{0}-{1}.json'.format(resource_id, first_hash[:32]))
+        self._lock = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            self._lock.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise BadExcelData(_(
+                "This file is already being uploaded. Please wait for "
+                "that upload to finish."))
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+        self.committed = set(state.get('committed', ()))
+        self.pending = state.get('pending')
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'committed': sorted(self.committed),
+                'pending': self.pending,
+                }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def begin(self, h, records, last_id=None):
+        """
+        Mark batch h pending before writing it, with the highest _id
+        in the table for inserts
+        """
+        self.pending = {
+            'hash': h,
+            'rows': [records.row_numbers[0], records.row_numbers[-1]],
+            'count': len(records),
+            'last_id': last_id,
+            }
+        self._save()
+
+    def commit(self, h):
+        self.committed.add(h)
+        self.pending = None
+        self._save()
+
+    def abort(self):
+        """
+        Clear the pending batch after a write that was rolled back
+        """
+        self.pending = None
+        self._save()
+
+    def remove(self):
+        for path in (self.path, self.path + '.lock'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def close(self):
+        self._lock.close()
+
+
+def write_checkpointed(
+        directory, resource_id, method, batches, write, last_id, recorder,
+        max_age=0):
+    """
+    Write each RecordBatch in batches with write(records), skipping
+    batches written by an earlier attempt to upload the same records.
+
+    last_id() returns the highest _id in the table, checked before
+    inserting a batch that was pending when an earlier attempt stopped.
+
+    Checkpoints older than max_age seconds are removed first, unless
+    max_age is 0.
+
+    raises BadExcelData on errors, and when an interrupted insert can't
+    be safely resumed
+    """
+    previous = hashlib.sha256(
+        json.dumps([resource_id, method]).encode('utf-8')).hexdigest()
+    if max_age:
+        with recorder.stage('checkpoint'):
+            remove_expired(directory, max_age)
+    checkpoint = None
+    try:
+        for records in batches:
+            with recorder.stage('checkpoint'):
+                h = batch_hash(previous, records)
+                previous = h
+                if checkpoint is None:
+                    checkpoint = Checkpoint(directory, resource_id, h)
+                if h in checkpoint.committed:
+                    recorder.count('checkpoint_skipped', len(records))
+                    continue
+                pending = checkpoint.pending
+                if pending and method == 'insert' and _resume_insert(
+                        checkpoint, pending, h, last_id()):
+                    recorder.count('checkpoint_skipped', len(records))
+                    continue
+                checkpoint.begin(
+                    h, records, last_id() if method == 'insert' else None)
+            try:
+                write(records)
+            except BadExcelData:
+                # datastore rejected the records, nothing was written
+                checkpoint.abort()
+                raise
+            with recorder.stage('checkpoint'):
+                checkpoint.commit(h)
+        if checkpoint is not None:
+            checkpoint.remove()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def _resume_insert(checkpoint, pending, h, last_id):
+    """
+    Return True if the rows of the pending insert are batch h and were
+    written, False if they weren't written.
+
+    raises BadExcelData if they were written and batch h is different
+    or if the table changed in some other way since. The pending
+    batch is cleared so that the file can be uploaded again once the
+    rows are removed.
+    """
+    if last_id == pending['last_id']:
+        return False
+    if last_id == (pending['last_id'] or 0) + pending['count']:
+        checkpoint.commit(pending['hash'])
+        if pending['hash'] == h:
+            return True
+    else:
+        checkpoint.abort()
+    raise BadExcelData(_(
+        "An earlier upload of this file was interrupted while writing "
+        "rows {0}-{1}. Please check whether these rows were loaded and "
+        "remove them from the file before uploading it again."
+        ).format(*pending['rows']))
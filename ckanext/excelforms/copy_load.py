@@ -0,0 +1,126 @@
+"""
+COPY fast path for insert-only uploads
+
+Large uploads to resources without a primary key are streamed as CSV
+into PostgreSQL COPY on the datastore write engine instead of being
+sent to datastore_upsert as JSON records. Datastore triggers, including
+the full text trigger, still run for every row.
+
+Enabled for uploads of at least ckanext.excelforms.copy_min_records
+records.
+"""
+
+import re
+
+from six import text_type
+
+from ckan.plugins.toolkit import _
+
+from ckanext.excelforms.errors import BadExcelData
+
+# context of errors raised while copying, e.g.
+# 'COPY "3f3e...", line 12, column amount: "abc"'
+COPY_LINE_RE = re.compile(r'\bCOPY [^\n]*?, line (\d+)')
+CSV_CHUNK_RECORDS = 1000
+
+
+def copy_min_records(config):
+    """
+    Return the minimum number of records for the COPY fast path,
+    0 when disabled
+    """
+    return int(config.get('ckanext.excelforms.copy_min_records', 0))
+
+
+def csv_value(value):
+    """
+    Return value as a CSV field for COPY: None is NULL, other values
+    are always quoted text so empty strings are kept, lists are arrays
+    """
+    if value is None:
+        return u''
+    if isinstance(value, list):
+        value = u'{' + u','.join(
+            u'"' + text_type(v).replace(u'\\', u'\\\\').replace(
+                u'"', u'\\"') + u'"'
+            for v in value) + u'}'
+    return u'"' + text_type(value).replace(u'"', u'""') + u'"'
+
+
+class CSVStream(object):
+    """
+    File-like object producing CSV lines on read() for rows, pairs of
+    (row number, values), so copy_expert can stream without holding
+    the whole CSV in memory
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = u''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            lines = []
+            for n, values in self.rows:
+                lines.append(u','.join(csv_value(v) for v in values))
+                if len(lines) >= CSV_CHUNK_RECORDS:
+                    break
+            if not lines:
+                break
+            self.buffer += u'\n'.join(lines) + u'\n'
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def copy_error_row(context):
+    """
+    Return the 0-based record index from the context of an error raised
+    while copying, or None
+    """
+    m = COPY_LINE_RE.search(context or u'')
+    if m:
+        return int(m.group(1)) - 1
+
+
+def copy_records(resource_id, records, dry_run, clean_error):
+    """
+    Insert records, a RecordBatch, into the datastore table for
+    resource_id with COPY.
+
+    The caller is responsible for checking access. clean_error(message)
+    makes database error text presentable.
+
+    raises BadExcelData on errors, with the row number when known
+    """
+    from ckanext.datastore.backend.postgres import (
+        get_write_engine, identifier)
+    import psycopg2
+
+    sql = u'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)'.format(
+        table=identifier(resource_id),
+        columns=u', '.join(identifier(c) for c in records.fields))
+
+    connection = get_write_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, CSVStream(records.value_rows()))
+        if dry_run:
+            connection.rollback()
+        else:
+            connection.commit()
+    except psycopg2.Error as e:
+        connection.rollback()
+        message = clean_error(
+            e.diag.message_primary or e.pgerror or str(e))
+        row = copy_error_row(e.diag.context)
+        if row is not None and row < len(records):
+            raise BadExcelData(
+                _(u'Data row {0}:').format(records.row_numbers[row])
+                + u' ' + message,
+                records.row_numbers[row]
+            )
+        raise BadExcelData(
+            _(u"Error while importing data: {0}").format(message))
+    finally:
+        connection.close()
@@ -25,13 +25,14 @@ def canonicalize(
     :param primary_key: True if this field is part of the PK
     :type primary_key: bool
     :padam choice_field: 'full' if this field is a full-text choice field,
-        True if this is a normal choice field, False otherwise
-    :type choice_field: 'full', True or False
+        True if this is a normal choice field, a ChoiceIndex to check
+        and normalize choice codes, False otherwise
+    :type choice_field: 'full', True, False or ChoiceIndex
 
     :return: Canonicalized cell input
     :rtype: unicode, None or list of unicode values (_text)
 
-    Raises BadExcelData on formula cells
+    Raises BadExcelData on formula cells and codes not in a ChoiceIndex
     """
     if dirty is None:
         # use common value for blank cells
@@ -53,14 +54,20 @@ def canonicalize(
         dirty = text_type(dirty)
         if not dirty.strip():
             return []
-        return [s.strip() for s in text_type(dirty).split(',')]
+        values = [s.strip() for s in text_type(dirty).split(',')]
+        if isinstance(choice_field, ChoiceIndex):
+            return [choice_field.code(v) for v in values if v]
+        return values
 
     if 'int' in dstore_tag:  # bigint, int4 etc.
         canon = re.sub(r'[$,\s]', '', text_type(dirty))
         try:
             d = Decimal(canon)
             if not d % 1:  # truncate trailing .00's
-                return text_type(d // 1)
+                canon = text_type(d // 1)
+                if isinstance(choice_field, ChoiceIndex):
+                    return choice_field.code(canon)
+                return canon
         except InvalidOperation:
             pass
 
@@ -84,6 +91,8 @@ def canonicalize(
         dirty = dirty.split(':')[0].strip()
     elif choice_field:
         dirty = dirty.strip()
+        if isinstance(choice_field, ChoiceIndex) and dirty:
+            dirty = choice_field.code(dirty)
 
     # accidental control characters and whitespace around primary keys
     # leads to unpleasantness
@@ -94,3 +103,55 @@ def canonicalize(
     if dstore_tag != 'text' and not primary_key and not dirty:
         return None
     return dirty
+
+
+def _normalize_choice(value):
+    return u' '.join(value.split()).casefold()
+
+
+class ChoiceIndex(object):
+    """
+    Choice codes for one field indexed for constant time lookup of
+    cell values, built once per upload from h.tabledesigner_choices
+
+    Values are matched exactly, then ignoring case and whitespace, then
+    as "code: full text" with the text removed.
+    """
+    def __init__(self, field_id, choices):
+        self.field_id = field_id
+        self.codes = frozenset(text_type(c) for c in choices)
+        self.normalized = {}
+        for c in self.codes:
+            n = _normalize_choice(c)
+            # codes that differ only by case must be matched exactly
+            self.normalized[n] = None if n in self.normalized else c
+
+    def code(self, value):
+        """
+        Return the choice code for value
+
+        Raises BadExcelData when value doesn't match a code
+        """
+        if value in self.codes:
+            return value
+        code = self.normalized.get(_normalize_choice(value))
+        if code is None and u':' in value:
+            code = self.normalized.get(
+                _normalize_choice(value.split(u':')[0]))
+        if code is None:
+            raise BadExcelData(u'Invalid choice for {0}: "{1}"'.format(
+                self.field_id, value))
+        return code
+
+
+def choice_indexes(fields, choices):
+    """
+    Return {field_id: ChoiceIndex} for fields with choices, where
+    choices(field) returns a list or dict of codes or None
+    """
+    indexes = {}
+    for f in fields:
+        codes = choices(f)
+        if codes:
+            indexes[f['id']] = ChoiceIndex(f['id'], codes)
+    return indexes
@@ -3,5 +3,7 @@ class ExcelFormsException(Exception):
     pass
 
 class BadExcelData(ExcelFormsException):
-    def __init__(self, message):
+    def __init__(self, message, row=None):
         self.message = message
+        # spreadsheet row or CSV line number, when known
+        self.row = row
@@ -0,0 +1,261 @@
+"""
+Background edit template exports
+
+Edit templates for at least ckanext.excelforms.async_export_records
+selected records are built by a CKAN background job instead of in the
+web request. The request writes a status file to
+ckanext.excelforms.export_dir and enqueues build_export, which updates
+the status with the number of rows written as it goes and saves the
+finished template next to it. The user is sent to a status page that
+refreshes until the template is ready to download.
+
+Exports are expired ckanext.excelforms.export_max_age seconds after
+their status was last updated: the template is removed and the status
+page says so. The status itself is removed after another max age.
+Expired exports are removed when an export is enqueued or finishes.
+
+Downloads are sent by the web server instead of a CKAN worker when
+ckanext.excelforms.export_sendfile is "x-sendfile" (Apache mod_xsendfile,
+lighttpd) or "x-accel-redirect" (nginx, with the internal location
+serving export_dir given by ckanext.excelforms.export_accel_location).
+"""
+
+import json
+import os
+import re
+import time
+import uuid
+
+from ckan.plugins.toolkit import config, enqueue_job
+
+from ckanext.excelforms.metrics import Recorder
+
+EXPORT_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+DEFAULT_MAX_AGE = 24 * 3600
+
+
+def export_dir(config):
+    """
+    Return the export directory, None when disabled
+    """
+    return config.get('ckanext.excelforms.export_dir') or None
+
+
+def async_export_records(config):
+    """
+    Return the minimum number of records for background exports,
+    0 when disabled
+    """
+    if not export_dir(config):
+        return 0
+    return int(config.get('ckanext.excelforms.async_export_records', 0))
+
+
+def export_max_age(config):
+    """
+    Return the number of seconds exports are kept, 0 to keep them
+    """
+    return int(config.get(
+        'ckanext.excelforms.export_max_age', DEFAULT_MAX_AGE))
+
+
+def expire_exports(directory, max_age, now=None):
+    """
+    Remove the templates of exports with a status last updated more than
+    max_age seconds ago, marking them expired, and remove the status of
+    exports expired more than max_age seconds ago
+    """
+    now = time.time() if now is None else now
+    for name in os.listdir(directory):
+        export_id, ext = os.path.splitext(name)
+        if ext != '.json' or not EXPORT_ID_RE.match(export_id):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) < max_age:
+                continue
+        except OSError:
+            continue
+        status = read_status(directory, export_id)
+        if status is None:
+            continue
+        if status['state'] == 'expired':
+            _remove(path)
+            continue
+        for suffix in ('.xlsx', '.xlsx.tmp', '.zip', '.zip.tmp'):
+            _remove(export_path(directory, export_id, suffix))
+        status['state'] = 'expired'
+        write_status(directory, export_id, status)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def export_path(directory, export_id, ext='.xlsx'):
+    return os.path.join(directory, export_id + ext)
+
+
+def sendfile_header(config, export_id, ext):
+    """
+    Return the (name, value) header handing the download of export_id
+    to the web server, None when disabled
+    """
+    method = (config.get('ckanext.excelforms.export_sendfile') or '').lower()
+    if method == 'x-sendfile':
+        return ('X-Sendfile', os.path.abspath(
+            export_path(export_dir(config), export_id, ext)))
+    if method == 'x-accel-redirect':
+        location = config.get(
+            'ckanext.excelforms.export_accel_location',
+            '/excelforms-exports/')
+        return ('X-Accel-Redirect', location.rstrip('/') + '/' +
+            export_id + ext)
+    return None
+
+
+def read_status(directory, export_id):
+    """
+    Return the status dict for export_id, None if there is no such
+    export
+    """
+    if not EXPORT_ID_RE.match(export_id):
+        return None
+    try:
+        with open(os.path.join(directory, export_id + '.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_status(directory, export_id, status):
+    path = os.path.join(directory, export_id + '.json')
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp, path)
+
+
+def enqueue_export(resource, user, _ids, lite, lang, part_records):
+    """
+    Write the status for a new export of the records _ids of resource
+    for user and enqueue the job that builds it, return the export id.
+    Exports of more than part_records records are a zip file of parts.
+    """
+    directory = export_dir(config)
+    max_age = export_max_age(config)
+    if max_age:
+        expire_exports(directory, max_age)
+    export_id = uuid.uuid4().hex
+    write_status(directory, export_id, {
+        'state': 'queued',
+        'resource_id': resource['id'],
+        'package_id': resource['package_id'],
+        'user': user,
+        'records': len(_ids),
+        'rows': 0,
+        'ext': '.zip' if len(set(_ids)) > part_records else '.xlsx',
+        })
+    enqueue_job(
+        build_export,
+        [export_id, resource['id'], user, _ids, lite, lang, part_records],
+        title='excelforms export {0}'.format(resource['id']))
+    return export_id
+
+
+def build_export(
+        export_id, resource_id, user, _ids, lite, lang, part_records):
+    """
+    Background job building the edit template for export_id
+    """
+    from ckanext.excelforms.blueprint import (
+        _local_ckan, _get_data_dictionary, _edit_records, _write_template,
+        _write_template_parts)
+    from ckanext.excelforms.write_excel import RecordPages, record_pages
+
+    directory = export_dir(config)
+    status = read_status(directory, export_id)
+    if status is None or status['state'] == 'expired':
+        # waited in the queue for longer than export_max_age
+        return
+    status['state'] = 'running'
+    write_status(directory, export_id, status)
+
+    def progress(num_rows):
+        status['rows'] += num_rows
+        write_status(directory, export_id, status)
+
+    def page_progress(pages):
+        for page in pages:
+            yield page
+            progress(len(page))
+
+    path = export_path(directory, export_id, status['ext'])
+    recorder = Recorder('export', resource_id=resource_id)
+    try:
+        with _request_context(lang):
+            lc = _local_ckan(user)
+            with recorder.stage('datastore_info'):
+                dd = _get_data_dictionary(lc, resource_id)
+            with recorder.stage('resource_show'):
+                resource = lc.action.resource_show(id=resource_id)
+            with open(path + '.tmp', 'wb') as f:
+                if status['ext'] == '.zip':
+                    _write_template_parts(
+                        f, lc, resource, dd, _ids, lite, part_records,
+                        recorder, progress)
+                else:
+                    records = _edit_records(
+                        lc, resource_id, dd, _ids, recorder)
+                    recorder.count('rows', len(records))
+                    records = RecordPages(
+                        len(records), page_progress(record_pages(records)))
+                    _write_template(f, resource, dd, records, lite, recorder)
+                recorder.count('bytes', f.tell())
+            os.replace(path + '.tmp', path)
+    except Exception:
+        recorder.count('errors')
+        status['state'] = 'error'
+        write_status(directory, export_id, status)
+        raise
+    finally:
+        recorder.report()
+        max_age = export_max_age(config)
+        if max_age:
+            expire_exports(directory, max_age)
+    status['state'] = 'done'
+    write_status(directory, export_id, status)
+
+
+def _request_context(lang):
+    """
+    Return a request context for building templates in a job, with
+    lang for translations
+    """
+    return _flask_app().test_request_context(
+        environ_overrides={'CKAN_LANG': lang} if lang else None)
+
+
+_app = None
+
+
+def _flask_app():
+    """
+    Return the CKAN Flask app set up by the ckan command running the
+    job worker, or one built on first use and kept for the life of the
+    process when there is none
+    """
+    global _app
+    if _app is None:
+        import click
+        ctx = click.get_current_context(silent=True)
+        app = ctx.meta.get('flask_app') if ctx is not None else None
+        if app is None:
+            from ckan.config.middleware.flask_app import make_flask_stack
+            # the Flask app inside the middleware, like ckan.cli uses
+            app = make_flask_stack(config)._wsgi_app
+        _app = app
+    return _app
@@ -0,0 +1,76 @@
+"""
+Action API for loading Excel template, CSV and TSV uploads
+"""
+
+from ckan.plugins.toolkit import (
+    _, get_or_bust, asbool, check_access, ValidationError
+)
+import ckan.authz as authz
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.metrics import Recorder
+
+
+def excelforms_upload(context, data_dict):
+    """
+    Load records from an Excel template, CSV or TSV file into a
+    resource, the same as the upload form on the resource page.
+
+    :param resource_id: the resource to load records into
+    :type resource_id: string
+    :param upload: the file uploaded (multipart/form-data)
+    :type upload: file
+    :param dry_run: true to check the records and roll back
+        (optional, default: false)
+    :type dry_run: bool
+
+    :returns: ``method`` datastore_upsert method used (or ``None`` if
+        the file was refused before records were read), ``dry_run``,
+        number of ``records`` read, per-stage ``timings`` in seconds,
+        ``counters`` and ``errors``, a list of ``{"row", "message"}``
+        where row is the spreadsheet row or CSV line number or ``None``.
+        Loading stops at the first error, so ``errors`` holds at most
+        one.
+    :rtype: dictionary
+    """
+    # imported here so the action module doesn't load the blueprint
+    from ckanext.excelforms.blueprint import (
+        _local_ckan, _get_data_dictionary, _process_upload_file)
+
+    resource_id, upload = get_or_bust(data_dict, ['resource_id', 'upload'])
+    if not hasattr(upload, 'read'):
+        raise ValidationError({'upload': [_('You must provide a valid file')]})
+    dry_run = asbool(data_dict.get('dry_run', False))
+    check_access('excelforms_upload', context, data_dict)
+
+    recorder = Recorder('upload', resource_id=resource_id)
+    lc = _local_ckan(context.get('user'))
+    with recorder.stage('datastore_info'):
+        dd = _get_data_dictionary(lc, resource_id)
+    errors = []
+    try:
+        _process_upload_file(lc, resource_id, upload, dd, dry_run, recorder)
+    except BadExcelData as e:
+        recorder.count('errors')
+        errors.append({'row': e.row, 'message': e.message})
+    finally:
+        recorder.report()
+
+    return {
+        'method': recorder.tags.get('method'),
+        'dry_run': dry_run,
+        'records': recorder.counters.get('rows', 0),
+        'timings': dict(recorder.timings, total=recorder.total()),
+        'counters': recorder.counters,
+        'errors': errors,
+    }
+
+
+def excelforms_upload_auth(context, data_dict):
+    """
+    Users that may upsert records into the resource may upload
+    """
+    return authz.is_authorized(
+        'datastore_upsert',
+        context,
+        {'resource_id': data_dict.get('resource_id')})
@@ -0,0 +1,189 @@
+"""
+Stage timings and counters for template and upload requests
+
+A Recorder collects named stage timings and counters for one
+operation. report() writes them as one structured log line and
+passes them to the configured metrics sink.
+
+The sink is chosen with ckanext.excelforms.metrics_sink:
+
+    statsd
+        send to statsd, see ckanext.excelforms.statsd_host,
+        ckanext.excelforms.statsd_port and ckanext.excelforms.statsd_prefix
+    package.module:factory
+        call factory(config) and use the object returned
+
+Sinks implement timing(name, seconds, tags) and incr(name, value, tags).
+"""
+
+import importlib
+import socket
+from contextlib import contextmanager
+from logging import getLogger
+from time import perf_counter
+
+log = getLogger(__name__)
+
+METRIC_PREFIX = 'excelforms'
+
+
+class MetricsSink(object):
+    """
+    Sink that discards everything, base class for other sinks
+    """
+    def timing(self, name, seconds, tags):
+        pass
+
+    def incr(self, name, value, tags):
+        pass
+
+
+class InMemorySink(MetricsSink):
+    """
+    Sink that keeps everything it receives, for tests
+    """
+    def __init__(self):
+        self.timings = []
+        self.counters = {}
+
+    def timing(self, name, seconds, tags):
+        self.timings.append((name, seconds, tags))
+
+    def incr(self, name, value, tags):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+class StatsdSink(MetricsSink):
+    """
+    Send timings and counters to statsd over UDP, tags are ignored
+    """
+    def __init__(self, host='localhost', port=8125, prefix=''):
+        self.address = (host, int(port))
+        self.prefix = prefix + '.' if prefix else ''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except (socket.error, OSError):
+            pass  # metrics must never break a request
+
+    def timing(self, name, seconds, tags):
+        self._send('{0}{1}:{2:.3f}|ms'.format(
+            self.prefix, name, seconds * 1000))
+
+    def incr(self, name, value, tags):
+        self._send('{0}{1}:{2}|c'.format(self.prefix, name, value))
+
+
+_sink = MetricsSink()
+
+
+def set_sink(sink):
+    global _sink
+    _sink = sink
+
+
+def get_sink():
+    return _sink
+
+
+def sink_from_config(config):
+    """
+    Return the metrics sink selected by ckanext.excelforms.metrics_sink
+    """
+    name = config.get('ckanext.excelforms.metrics_sink')
+    if not name:
+        return MetricsSink()
+    if name == 'statsd':
+        return StatsdSink(
+            config.get('ckanext.excelforms.statsd_host', 'localhost'),
+            config.get('ckanext.excelforms.statsd_port', 8125),
+            config.get('ckanext.excelforms.statsd_prefix', ''))
+    module_name, sep, factory = name.partition(':')
+    return getattr(importlib.import_module(module_name), factory)(config)
+
+
+class Recorder(object):
+    """
+    Named stage timings and counters for one operation.
+
+    Stages nest: time spent in an inner stage is not counted in the
+    enclosing one, so stage times never add up to more than the total.
+    Recorders created without an operation name are never reported.
+    clock returns the current time in seconds.
+    """
+    def __init__(self, operation=None, clock=perf_counter, **tags):
+        self.operation = operation
+        self.tags = tags
+        self.timings = {}
+        self.counters = {}
+        self._clock = clock
+        self._stack = []
+        self._start = clock()
+
+    @contextmanager
+    def stage(self, name):
+        now = self._clock()
+        if self._stack:
+            parent = self._stack[-1]
+            self._add_time(parent[0], now - parent[1])
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            name, started = self._stack.pop()
+            now = self._clock()
+            self._add_time(name, now - started)
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def timed_iter(self, name, iterable):
+        """
+        Yield from iterable, counting time spent producing each item
+        as stage name
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def total(self):
+        return self._clock() - self._start
+
+    def log_line(self):
+        """
+        Return timings (in seconds) and counters as key=value pairs
+        """
+        parts = ['{0}={1}'.format(k, v) for k, v in sorted(self.tags.items())]
+        parts.append('total={0:.4f}'.format(self.total()))
+        parts.extend(
+            '{0}={1:.4f}'.format(k, v) for k, v in sorted(self.timings.items()))
+        parts.extend(
+            '{0}={1}'.format(k, v) for k, v in sorted(self.counters.items()))
+        return ' '.join(parts)
+
+    def report(self):
+        if not self.operation:
+            return
+        log.info('%s %s', self.operation, self.log_line())
+        name = METRIC_PREFIX + '.' + self.operation
+        sink = get_sink()
+        try:
+            sink.timing(name + '.total', self.total(), self.tags)
+            for stage, seconds in self.timings.items():
+                sink.timing(name + '.' + stage, seconds, self.tags)
+            for counter, value in self.counters.items():
+                sink.incr(name + '.' + counter, value, self.tags)
+        except Exception:
+            log.exception('metrics sink failed')
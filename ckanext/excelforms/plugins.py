@@ -6,7 +6,9 @@ from ckan.plugins.toolkit import _, h, asbool
 import ckan.plugins as p
 from ckan.lib.plugins import DefaultDatasetForm, DefaultTranslation
 
-from ckanext.excelforms import blueprint
+from ckanext.excelforms import (
+    blueprint, logic, metrics, prewarm, template_pool, upload_queue
+)
 
 def excelforms_language_text(f, field, lang=None):
     if not lang:
@@ -16,7 +18,10 @@ def excelforms_language_text(f, field, lang=None):
 
 class ExcelFormsPlugin(p.SingletonPlugin, DefaultTranslation):
     p.implements(p.IConfigurer)
+    p.implements(p.IConfigurable)
     p.implements(p.IBlueprint)
+    p.implements(p.IActions)
+    p.implements(p.IAuthFunctions)
     p.implements(p.ITemplateHelpers, inherit=True)
     p.implements(p.ITranslation)
 
@@ -25,9 +30,26 @@ class ExcelFormsPlugin(p.SingletonPlugin, DefaultTranslation):
         p.toolkit.add_template_directory(config, 'templates')
         p.toolkit.add_resource('assets', 'ckanext-excelforms')
 
+    def configure(self, config):
+        metrics.set_sink(metrics.sink_from_config(config))
+        upload_queue.set_queue(upload_queue.queue_from_config(config))
+        template_pool.set_pool(template_pool.pool_from_config(config))
+        if asbool(config.get('ckanext.excelforms.prewarm', False)):
+            prewarm.prewarm()
+
     def get_blueprint(self):
         return blueprint.excelforms
 
+    def get_actions(self):
+        return {
+            'excelforms_upload': logic.excelforms_upload,
+            }
+
+    def get_auth_functions(self):
+        return {
+            'excelforms_upload': logic.excelforms_upload_auth,
+            }
+
     def get_helpers(self):
         return {
             'excelforms_language_text': excelforms_language_text,
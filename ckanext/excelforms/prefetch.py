@@ -0,0 +1,79 @@
+"""
+Background prefetch for paged datastore reads
+
+Edit templates for many records fetch them from the datastore a page
+at a time. A Prefetch runs the page fetches in a background thread,
+at most depth pages ahead of the worksheet writer, so fetching the
+next page overlaps writing the current one while no more than depth
+pages wait in memory.
+"""
+
+import threading
+from queue import Queue, Full
+
+_DONE = object()
+# how often a producer blocked on a full queue checks for a consumer
+# that went away
+_PUT_WAIT = 0.1
+
+
+class Prefetch(object):
+    """
+    Iterable producing the items of iterable, which is iterated in a
+    background thread started immediately. Exceptions raised by
+    iterable are raised to the consumer.
+
+    wrap, e.g. flask.copy_current_request_context, is applied to the
+    function run in the background thread. The thread stops when the
+    consumer stops iterating early or this object is garbage collected.
+    """
+    def __init__(self, iterable, depth=2, wrap=None):
+        self._queue = Queue(depth)
+        self._stop = threading.Event()
+        target = _producer(iterable, self._queue, self._stop)
+        if wrap is not None:
+            target = wrap(target)
+        thread = threading.Thread(
+            target=target, name='excelforms-prefetch')
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self._queue.get()
+                if item is _DONE:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+
+    __del__ = close
+
+
+def _producer(iterable, queue, stop):
+    # doesn't reference the Prefetch so that it can be collected
+    def put(item, error=None):
+        while not stop.is_set():
+            try:
+                queue.put((item, error), timeout=_PUT_WAIT)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_DONE, e)
+            return
+        put(_DONE)
+    return produce
@@ -0,0 +1,32 @@
+"""
+Import the modules used for templates and uploads ahead of time
+
+openpyxl, ckanapi and the excelforms modules using them are imported
+the first time a template is built or an upload is read, so CLI
+commands and background workers that never do either don't pay for
+them. With ckanext.excelforms.prewarm set they are imported when the
+plugin is configured instead. Under a preforking web server that
+loads the application before forking (e.g. uwsgi without lazy-apps,
+gunicorn --preload) this keeps the import time off the first request
+of each worker and shares the imported modules between workers.
+"""
+
+import importlib
+
+MODULES = (
+    'ckanapi',
+    'openpyxl',
+    'ckanext.excelforms.read_csv',
+    'ckanext.excelforms.read_excel',
+    'ckanext.excelforms.splice',
+    'ckanext.excelforms.write_excel',
+    'ckanext.excelforms.xlsx_stream',
+)
+
+
+def prewarm():
+    """
+    Import MODULES
+    """
+    for name in MODULES:
+        importlib.import_module(name)
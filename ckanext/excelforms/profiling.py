@@ -0,0 +1,170 @@
+"""
+On-demand profiling of template and upload requests
+
+With ckanext.excelforms.profile_dir set, requests from sysadmins to
+the template and upload views are profiled when they send an
+X-Excelforms-Profile header or ckanext.excelforms.profile is set.
+Either may be "cpu" for cProfile, "memory" for tracemalloc or "all"
+(or "true") for both.
+
+Each profiled request writes <name>.prof, a cProfile dump for
+pstats or snakeviz, and <name>.txt, a summary of the top
+ckanext.excelforms.profile_top functions and allocation sites.
+The name includes the resource id and a fingerprint of its data
+dictionary and is returned in the X-Excelforms-Profile response
+header.
+
+cProfile only sees the request thread, so time spent in prefetch
+and part threads shows up as waiting. tracemalloc traces the whole
+process, so allocations by concurrent requests are included. One
+request per process is profiled at a time.
+"""
+
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+from logging import getLogger
+
+from ckan.plugins.toolkit import asbool, config, g, request
+import ckan.authz as authz
+
+log = getLogger(__name__)
+
+PROFILE_HEADER = 'X-Excelforms-Profile'
+MODES = {
+    'cpu': (True, False),
+    'memory': (False, True),
+    'all': (True, True),
+}
+
+_lock = threading.Lock()
+
+
+def profile_dir(config):
+    """
+    Return the profile directory, None when disabled
+    """
+    return config.get('ckanext.excelforms.profile_dir') or None
+
+
+def profile_modes(value):
+    """
+    Return (cpu, memory) for a profile header or config value
+    """
+    value = (value or '').strip().lower()
+    if value in MODES:
+        return MODES[value]
+    if value and asbool(value):
+        return MODES['all']
+    return (False, False)
+
+
+class Capture(object):
+    """
+    Context manager collecting a cProfile profile and/or tracemalloc
+    snapshot of the code run inside it
+    """
+    def __init__(self, cpu=True, memory=True):
+        self.profile = cProfile.Profile() if cpu else None
+        self.memory = memory
+        self.snapshot = None
+        self.peak = None
+        self.elapsed = None
+        self._tracing = False
+
+    def __enter__(self):
+        if self.memory:
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        if self.profile:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile:
+            self.profile.disable()
+        self.elapsed = time.perf_counter() - self._start
+        if self.memory:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            if self._tracing:
+                tracemalloc.stop()
+
+    def write(self, directory, name, header='', top=30):
+        """
+        Write name.prof and name.txt to directory, return the summary
+        """
+        out = io.StringIO()
+        out.write(header)
+        out.write('elapsed={0:.4f}s\n'.format(self.elapsed))
+        if self.profile:
+            self.profile.dump_stats(os.path.join(directory, name + '.prof'))
+            out.write('\n== cProfile, top {0} by cumulative time ==\n'.format(
+                top))
+            pstats.Stats(self.profile, stream=out).sort_stats(
+                'cumulative').print_stats(top)
+        if self.snapshot is not None:
+            out.write(
+                '\n== tracemalloc, peak {0:.1f} MiB, top {1} lines ==\n'
+                .format(self.peak / 1048576.0, top))
+            for stat in self.snapshot.statistics('lineno')[:top]:
+                out.write('{0}\n'.format(stat))
+        summary = out.getvalue()
+        with open(os.path.join(directory, name + '.txt'), 'w') as f:
+            f.write(summary)
+        return summary
+
+
+def profiled(operation, fingerprint):
+    """
+    Decorate a view taking a resource_id to profile it on request,
+    fingerprint(resource_id) returns the data dictionary fingerprint
+    used in file names
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            directory = profile_dir(config)
+            if not directory:
+                return view(*args, **kwargs)
+            cpu, memory = profile_modes(request.headers.get(
+                PROFILE_HEADER, config.get('ckanext.excelforms.profile')))
+            if not (cpu or memory) or not authz.is_sysadmin(g.user):
+                return view(*args, **kwargs)
+            if not _lock.acquire(False):
+                log.info('%s profile skipped, another is running', operation)
+                return view(*args, **kwargs)
+            try:
+                with Capture(cpu, memory) as capture:
+                    response = view(*args, **kwargs)
+                resource_id = kwargs.get('resource_id')
+                try:
+                    fp = fingerprint(resource_id)
+                except Exception:
+                    fp = 'unknown'
+                name = '{0}-{1}-{2}-{3}-{4}'.format(
+                    operation, resource_id, fp[:12],
+                    time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:6])
+                capture.write(
+                    directory,
+                    name,
+                    'operation={0} resource_id={1} fingerprint={2}\n'.format(
+                        operation, resource_id, fp),
+                    int(config.get('ckanext.excelforms.profile_top', 30)))
+            finally:
+                _lock.release()
+            log.info('%s profile written: %s', operation, name)
+            if hasattr(response, 'headers'):
+                response.headers[PROFILE_HEADER] = name
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,82 @@
+"""
+CSV and TSV uploads
+
+Automated submitters can upload CSV or TSV files to the same form as
+Excel templates. The first line holds the column names, the same ids
+as row 3 of the template, followed by one line per record.
+"""
+
+import csv
+import io
+import os
+from itertools import islice
+
+from ckan.plugins.toolkit import _
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.metrics import Recorder
+from ckanext.excelforms.read_excel import _is_bumf
+
+CSV_DELIMITERS = {
+    '.csv': ',',
+    '.tsv': '\t',
+    'text/csv': ',',
+    'text/tab-separated-values': '\t',
+}
+
+
+def csv_delimiter(filename, mimetype=None):
+    """
+    Return the delimiter for a CSV or TSV upload from its file name
+    extension or mimetype, None for other uploads
+    """
+    ext = os.path.splitext(filename or '')[1].lower()
+    return CSV_DELIMITERS.get(ext, CSV_DELIMITERS.get(mimetype))
+
+
+def read_csv(f, delimiter=',', recorder=None):
+    """
+    Return (column_names, rows) for the CSV file object f (bytes,
+    UTF-8 with or without a BOM) where rows is a generator producing
+    (line number, values) for lines that aren't empty
+
+    raises BadExcelData if f has no header line
+    """
+    recorder = recorder or Recorder()
+    text = io.TextIOWrapper(f, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text, delimiter=delimiter)
+    with recorder.stage('header_parse'):
+        try:
+            column_names = [c.strip() or None for c in next(reader)]
+        except StopIteration:
+            raise BadExcelData(_(u'The file uploaded is empty'))
+        except UnicodeDecodeError:
+            raise BadExcelData(_(u'CSV files must be UTF-8 encoded'))
+
+    def rows():
+        try:
+            for values in reader:
+                if not all(_is_bumf(v) for v in values):
+                    yield reader.line_num, values
+        except UnicodeDecodeError:
+            raise BadExcelData(_(
+                u'CSV files must be UTF-8 encoded, error after line {0}'
+                ).format(reader.line_num))
+        except csv.Error as e:
+            raise BadExcelData(
+                _(u'Line {0}: {1}').format(reader.line_num, e),
+                reader.line_num)
+
+    return column_names, recorder.timed_iter('row_read', rows())
+
+
+def batches(rows, size):
+    """
+    Yield lists of up to size items from rows
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
@@ -5,56 +5,103 @@ from six import text_type
 
 from ckanext.excelforms.datatypes import canonicalize
 from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.metrics import Recorder
+from ckanext.excelforms.record_batch import RecordBatch
+from ckanext.excelforms.xlsx_stream import StreamingWorkbook
 
 HEADER_ROWS_V2 = 3
 HEADER_ROWS_V3 = 5
 
-def read_excel(f, file_contents=None):
+def read_excel(f, file_contents=None, recorder=None, streaming=False):
     """
     Return a generator that opens the excel file f (name or file object)
     and then produces ((sheet-name, org-name), row1, row2, ...)
     :param: f: file name or xlsx file object
+    :param: recorder: metrics.Recorder for workbook_open, header_parse
+        and row_read stage timings
+    :param: streaming: True to read with xlsx_stream.StreamingWorkbook,
+        keeping the shared string table on disk instead of in memory
 
     :return: Generator that opens the excel file f
     and then produces:
         (sheet-name, org-name, column_names, data_rows_generator)
         ...
     :rtype: generator
-    """
-    wb = openpyxl.load_workbook(f, read_only=True)
-
-    for sheetname in wb.sheetnames:
-        if sheetname == 'reference':
-            return
-        sheet = wb[sheetname]
-        rowiter = sheet.rows
-        header_row = next(rowiter)
-
-        label_row = next(rowiter)
-        names_row = next(rowiter)
-
-        if names_row[0].value != 'xlf_v1':
-            raise BadExcelData(_('Incorrect template version: {0}').format(names_row[0].value))
-
-        cstatus_row = next(rowiter)
-        example_row = next(rowiter)
-        if example_row[0].value != 'e.g.' and example_row[0].value != 'ex.':
-            raise BadExcelData(u'Example record on row 5 is missing')
 
-        yield (
-            sheetname,
-            names_row[1].value,
-            [c.value for c in names_row[2:]],
-            _filter_bumf((row[2:] for row in rowiter), HEADER_ROWS_V3))
+    The workbook is closed when data_rows_generator is exhausted or
+    closed, so only the first sheet can be read. Close it when not
+    reading all of its rows, e.g. after an error, to release the
+    workbook's files right away.
+    """
+    recorder = recorder or Recorder()
+    with recorder.stage('workbook_open'):
+        if streaming:
+            wb = StreamingWorkbook(f)
+            sheet_rows = wb.rows
+        else:
+            wb = openpyxl.load_workbook(f, read_only=True)
+            sheet_rows = lambda name: wb[name].iter_rows(values_only=True)
+
+    try:
+        for sheetname in wb.sheetnames:
+            if sheetname == 'reference':
+                wb.close()
+                return
+            with recorder.stage('header_parse'):
+                rowiter = iter(sheet_rows(sheetname))
+                header_row = next(rowiter)
+
+                label_row = next(rowiter)
+                names_row = list(next(rowiter)) + [None, None]
+
+                if names_row[0] != 'xlf_v1':
+                    raise BadExcelData(_('Incorrect template version: {0}').format(names_row[0]))
+
+                cstatus_row = next(rowiter)
+                example_row = list(next(rowiter)) + [None]
+                if example_row[0] != 'e.g.' and example_row[0] != 'ex.':
+                    raise BadExcelData(u'Example record on row 5 is missing')
+
+                # ignore cells right of the named columns: custom styles
+                # and the check columns of data tables
+                column_names = names_row[2:-2]
+                while column_names and column_names[-1] is None:
+                    column_names.pop()
+                end = 2 + len(column_names)
+
+            yield (
+                sheetname,
+                names_row[1],
+                column_names,
+                _closing(wb, recorder.timed_iter('row_read', _filter_bumf(
+                    (row[2:end] for row in rowiter), HEADER_ROWS_V3))))
+    except Exception:
+        wb.close()
+        raise
+
+
+def _closing(wb, rows):
+    """
+    Yield rows, closing wb when done or closed
+    """
+    try:
+        for row in rows:
+            yield row
+    finally:
+        wb.close()
 
 
 def _filter_bumf(rowiter, header_rows):
+    """
+    Yield (row number, values) for rows of cell values that aren't
+    empty, unescaping strings
+    """
     i = header_rows
     for row in rowiter:
         i += 1
         values = [
-            unescape(c.value) if isinstance(c.value, text_type) else c.value
-            for c in row]
+            unescape(v) if isinstance(v, text_type) else v
+            for v in row]
         # return next non-empty row
         if not all(_is_bumf(v) for v in values):
             yield i, values
@@ -90,9 +137,13 @@ def get_records(rows, fields, primary_key_fields, choice_fields):
     :type choice_fields: dict
 
     :return: canonicalized records of specified upload data
-    :rtype: tuple of dicts
+    :rtype: RecordBatch
     """
-    records = []
+    records = RecordBatch(f['id'] for f in fields)
+    columns = [
+        (f['type'], f['id'] in primary_key_fields,
+            choice_fields.get(f['id'], False))
+        for f in fields]
     for n, row in rows:
         # trailing cells might be empty: trim row to fit
         while (row and
@@ -103,17 +154,12 @@ def get_records(rows, fields, primary_key_fields, choice_fields):
             row.append(None) # placeholder: canonicalize once only, below
 
         try:
-            records.append(
-                (n, dict((
-                    f['id'],
-                    canonicalize(
-                        v,
-                        f['type'],
-                        f['id'] in primary_key_fields,
-                        choice_fields.get(f['id'], False)))
-                for f, v in zip(fields, row))))
+            records.append(n, [
+                canonicalize(v, dstore_tag, primary_key, choice_field)
+                for (dstore_tag, primary_key, choice_field), v
+                in zip(columns, row)])
         except BadExcelData as e:
-            raise BadExcelData(u'Row {0}:'.format(n) + u' ' + e.message)
+            raise BadExcelData(u'Row {0}:'.format(n) + u' ' + e.message, n)
 
     return records
 
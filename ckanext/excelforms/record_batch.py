@@ -0,0 +1,76 @@
+"""
+Compact storage for canonicalized upload records
+"""
+
+from array import array
+
+
+class RecordBatch(object):
+    """
+    Records sharing one tuple of field ids, kept as one tuple of values
+    per record with the spreadsheet row numbers in an int array.
+
+    Iterating or indexing produces (row number, record dict) pairs, the
+    dicts are only built when asked for, see dicts().
+    """
+    __slots__ = ('fields', 'row_numbers', 'values')
+
+    def __init__(self, fields, row_numbers=(), values=()):
+        self.fields = tuple(fields)
+        self.row_numbers = array('l', row_numbers)
+        self.values = list(values)
+
+    def append(self, row_number, values):
+        self.row_numbers.append(row_number)
+        self.values.append(tuple(values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.row_numbers[i], dict(zip(self.fields, self.values[i]))
+
+    def __iter__(self):
+        fields = self.fields
+        for n, v in zip(self.row_numbers, self.values):
+            yield n, dict(zip(fields, v))
+
+    def __add__(self, other):
+        if other.fields != self.fields:
+            raise ValueError('record batches with different fields')
+        batch = RecordBatch(self.fields, self.row_numbers, self.values)
+        batch.row_numbers.extend(other.row_numbers)
+        batch.values.extend(other.values)
+        return batch
+
+    def extend(self, other):
+        """
+        Append the records of other, a RecordBatch with the same fields
+        """
+        if other.fields != self.fields:
+            raise ValueError('record batches with different fields')
+        self.row_numbers.extend(other.row_numbers)
+        self.values.extend(other.values)
+
+    def slices(self, size):
+        """
+        Yield RecordBatches of up to size records each
+        """
+        for i in range(0, len(self.values), size):
+            yield RecordBatch(
+                self.fields,
+                self.row_numbers[i:i + size],
+                self.values[i:i + size])
+
+    def value_rows(self):
+        """
+        Yield (row number, values tuple in fields order)
+        """
+        return zip(self.row_numbers, self.values)
+
+    def dicts(self):
+        """
+        Return a list of record dicts, e.g. for datastore_upsert
+        """
+        fields = self.fields
+        return [dict(zip(fields, v)) for v in self.values]
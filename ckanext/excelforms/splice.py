@@ -0,0 +1,368 @@
+"""
+Edit templates spliced from a cached base template
+
+Building an edit template with excel_template redoes every style,
+validation, reference row and formula even though only the data rows
+and row counts differ between requests for the same resource. Here a
+base template with two prototype data rows is built once per resource
+and data dictionary, serialized and cached. Each request then only
+generates the data, e1 and r1 sheet rows for its records and the
+ranges that depend on the row count, and writes them into a copy of
+the base xlsx zip.
+
+Prototype rows: row DATA_FIRST_ROW carries the first-row-only cells
+(the "type here" marker) and is reused for the first record,
+DATA_FIRST_ROW + 1 is cloned for every other record. Ranges ending on
+the second prototype row cover the whole data area and are extended to
+the last record, except ranges in data rows ending on their own row
+with a relative row number (like K$6:K7) that run from the top down to
+that row and are moved with it.
+"""
+
+import re
+import json
+import hashlib
+import threading
+import zipfile
+from io import BytesIO
+from collections import OrderedDict
+from datetime import date, datetime, time
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+from ckanext.excelforms.write_excel import (
+    excel_template, template_cols_fields, format_records, record_pages,
+    DATA_SHEET_TITLE, DATA_FIRST_ROW)
+
+PROTO_ROW = DATA_FIRST_ROW + 1
+SPLICED_SHEETS = (DATA_SHEET_TITLE, 'e1', 'r1')
+
+SHEET_RE = re.compile(r'<sheet\b[^>]*?\bname="([^"]*)"[^>]*?\br:id="([^"]*)"')
+REL_RE = re.compile(r'<Relationship\b[^>]*?/>')
+ROW_RE = re.compile(r'<row\b[^>]*?\br="(\d+)"[^>]*?(?:/>|>.*?</row>)', re.S)
+CELL_RE = re.compile(r'<c\b[^>]*?\br="([A-Z]+)(\d+)"[^>]*?(?:/>|>.*?</c>)', re.S)
+FORMULA_RE = re.compile(r'(<f\b[^>]*>)(.*?)(</f>)', re.S)
+SQREF_RE = re.compile(r'\b(sqref|ref)="([^"]*)"')
+# optional sheet, cell, optional :cell
+REF_RE = re.compile(
+    r"(?<![\w.$!])((?:'[^']*'|\w+)!)?"
+    r"(\$?[A-Z]{1,3}\$?)(\d+)(?::(\$?[A-Z]{1,3}\$?)(\d+))?(?![\w(!])")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def template_fingerprint(resource, dd, lang=''):
+    """
+    Return a hash of everything a template is built from
+    """
+    return hashlib.sha1(json.dumps(
+        [
+            lang,
+            dd,
+            {k: v for k, v in resource.items()
+                if k in ('id', 'package_id', 'name') or k.startswith('name_')
+                or k.startswith('excelforms_')},
+        ],
+        sort_keys=True,
+        default=str,
+    ).encode('utf-8')).hexdigest()
+
+
+def base_template(resource, dd, lang='', cache_size=32, recorder=None):
+    """
+    Return the BaseTemplate for resource and dd, from the cache if possible
+    """
+    key = template_fingerprint(resource, dd, lang)
+    with _cache_lock:
+        base = _cache.pop(key, None)
+        if base is not None:
+            _cache[key] = base
+            return base
+
+    proto = [None] * len(dd)
+    book = excel_template(resource, dd, [proto, proto], recorder)
+    blob = BytesIO()
+    book.save(blob)
+    base = BaseTemplate(blob.getvalue(), dd)
+
+    with _cache_lock:
+        _cache[key] = base
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return base
+
+
+def record_rows(dd, records):
+    """
+    Yield cell values for len(records) rows in template column order.
+    records are lists of values in dd order or a RecordPages, empty
+    rows follow any records that were removed before they were fetched
+    """
+    fields = [f for cn, f in template_cols_fields(dd, records)]
+    num_rows = 0
+    for page in record_pages(records):
+        for row in format_records(fields, page):
+            num_rows += 1
+            yield row
+    for i in range(num_rows, len(records)):
+        yield [None] * len(fields)
+
+
+class BaseTemplate(object):
+    """
+    A serialized edit template with two prototype data rows, split into
+    the pieces needed for splicing
+    """
+    def __init__(self, xlsx, dd):
+        self.xlsx = xlsx
+        self.columns = [
+            get_column_letter(cn) for cn, f in template_cols_fields(dd, True)]
+        with zipfile.ZipFile(BytesIO(xlsx)) as z:
+            self.parts = _sheet_parts(z)
+            self.sheets = {
+                name: _SheetPieces(
+                    z.read(self.parts[name]).decode('utf-8'), self.columns)
+                for name in SPLICED_SHEETS}
+
+    def write(self, out, rows, num_rows):
+        """
+        Write an xlsx to file object out with rows, a sequence of lists
+        of cell values in template column order. num_rows is the number
+        of rows that will be produced by rows
+        """
+        last_row = DATA_FIRST_ROW + num_rows - 1
+        spliced = {self.parts[name]: name for name in SPLICED_SHEETS}
+        with zipfile.ZipFile(BytesIO(self.xlsx)) as zin, \
+                zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                name = spliced.get(info.filename)
+                if name is None:
+                    zout.writestr(info, zin.read(info.filename))
+                    continue
+                with zout.open(info.filename, 'w') as part:
+                    self.sheets[name].write(
+                        part,
+                        last_row,
+                        rows if name == DATA_SHEET_TITLE else None)
+
+
+def _sheet_parts(z):
+    """
+    Return {sheet name: zip part name} from the workbook and its rels
+    """
+    workbook = z.read('xl/workbook.xml').decode('utf-8')
+    rels = z.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+    targets = {}
+    for rel in REL_RE.findall(rels):
+        rid = re.search(r'\bId="([^"]*)"', rel).group(1)
+        target = re.search(r'\bTarget="([^"]*)"', rel).group(1)
+        targets[rid] = target[1:] if target.startswith('/') else 'xl/' + target
+    return {name: targets[rid] for name, rid in SHEET_RE.findall(workbook)}
+
+
+class _SheetPieces(object):
+    """
+    Worksheet xml split into text before the data rows, header rows,
+    templates for the two prototype rows and the text after
+    """
+    def __init__(self, xml, columns):
+        start = xml.index('<sheetData')
+        start = xml.index('>', start) + 1
+        if xml[start - 2] == '/':
+            # no rows at all
+            self.head, self.tail = xml[:start - 2] + '>', '</sheetData>' + xml[start:]
+            rows = []
+        else:
+            end = xml.index('</sheetData>', start)
+            self.head, self.tail = xml[:start], xml[end:]
+            rows = [(int(m.group(1)), m.group(0))
+                for m in ROW_RE.finditer(xml, start, end)]
+        self.header_rows = [row for num, row in rows if num < DATA_FIRST_ROW]
+        self.first_row = self.proto = None
+        for num, row in rows:
+            if num == DATA_FIRST_ROW:
+                self.first_row = _RowTemplate(row, num, columns)
+            elif num == PROTO_ROW:
+                self.proto = _RowTemplate(row, num, columns)
+
+    def write(self, out, last_row, values):
+        out.write(_extend_ranges(self.head, last_row).encode('utf-8'))
+        for row in self.header_rows:
+            out.write(_shift_row(row, 0, 0, last_row).encode('utf-8'))
+
+        values = iter(values) if values is not None else None
+        for num in range(DATA_FIRST_ROW, last_row + 1):
+            template = self.first_row if num == DATA_FIRST_ROW else self.proto
+            if template is not None:
+                out.write(template.render(
+                    num,
+                    last_row,
+                    next(values) if values is not None else None,
+                ).encode('utf-8'))
+        out.write(_extend_ranges(self.tail, last_row).encode('utf-8'))
+
+
+# stand-ins for row numbers while compiling row templates, beyond
+# the last row excel allows
+ROW_MARK, LAST_MARK = 9900001, 9900002
+
+
+class _RowTemplate(object):
+    """
+    Prototype row compiled to format strings for fast rendering
+    """
+    def __init__(self, row, proto_num, columns):
+        xml = _shift_row(row, proto_num, ROW_MARK, LAST_MARK)
+        start = xml.index('>') + 1
+        self.head = _placeholders(xml[:start])
+        self.tail = '</row>'
+        cells = {
+            m.group(1): m.group(0)
+            for m in CELL_RE.finditer(xml, start, len(xml) - len(self.tail))}
+        self.columns_order = list(columns)
+        self.columns = set(columns)
+        self.cells = []
+        for col in sorted(
+                self.columns | set(cells), key=column_index_from_string):
+            proto = cells.get(col)
+            style = re.search(r'\bs="(\d+)"', proto) if proto else None
+            self.cells.append((
+                col,
+                _placeholders(proto) if proto else None,
+                ' s="{0}"'.format(style.group(1)) if style else ''))
+
+    def render(self, num, last_row, values=None):
+        """
+        Return row xml for row num, with cell values from values
+        (in the columns order passed to the constructor) when given
+        """
+        if values is not None:
+            values = dict(zip(self.columns_order, values))
+        out = [self.head.format(num, last_row)]
+        for col, template, style in self.cells:
+            if values is not None and col in self.columns:
+                value = values.get(col)
+                if value is not None or template is not None:
+                    out.append(_cell_xml(style, col + str(num), value))
+            elif template is not None:
+                out.append(template.format(num, last_row))
+        out.append(self.tail)
+        return ''.join(out)
+
+
+def _placeholders(xml):
+    return xml.replace('{', '{{').replace('}', '}}').replace(
+        str(ROW_MARK), '{0}').replace(str(LAST_MARK), '{1}')
+
+
+def _shift_row(row, proto_num, num, last_row):
+    """
+    Return row xml moved from row proto_num to row num with data area
+    ranges extended to last_row
+    """
+    def cell(m):
+        col = m.group(1)
+        xml = m.group(0).replace(
+            'r="{0}{1}"'.format(col, proto_num),
+            'r="{0}{1}"'.format(col, num), 1)
+        return FORMULA_RE.sub(
+            lambda f: f.group(1) + _shift_formula(
+                f.group(2), proto_num, num, last_row) + f.group(3),
+            xml)
+
+    start = row.index('>') + 1
+    head = row[:start].replace(
+        'r="{0}"'.format(proto_num), 'r="{0}"'.format(num), 1)
+    if head.endswith('/>'):
+        return head[:-2] + '></row>'
+    return head + CELL_RE.sub(cell, row[start:])
+
+
+def _cell_xml(style, ref, value):
+    """
+    Return cell xml for ref with value and style attribute text style
+    """
+    if value is None or value == '':
+        return '<c r="{0}"{1}/>'.format(ref, style)
+    if isinstance(value, bool):
+        return '<c r="{0}"{1} t="b"><v>{2}</v></c>'.format(
+            ref, style, int(value))
+    if isinstance(value, (datetime, date, time)):
+        value = to_excel(value)
+    if isinstance(value, (int, float, Decimal)):
+        return '<c r="{0}"{1} t="n"><v>{2}</v></c>'.format(ref, style, value)
+    return '<c r="{0}"{1} t="inlineStr"><is><t xml:space="preserve">{2}</t></is></c>'.format(
+        ref, style, escape(_xml_text(str(value))))
+
+
+def _xml_text(value):
+    # control characters not allowed in xml, excel stores them escaped
+    return re.sub(
+        '[\x00-\x08\x0b\x0c\x0e-\x1f]',
+        lambda m: '_x{0:04X}_'.format(ord(m.group(0))),
+        value)
+
+
+def _shift_formula(fmla, proto_num, num, last_row):
+    """
+    Move references to row proto_num to row num and extend data
+    area ranges to last_row, outside of string literals
+    """
+    parts = fmla.split('"')
+    for i in range(0, len(parts), 2):
+        parts[i] = REF_RE.sub(
+            lambda m: _shift_ref(m, proto_num, num, last_row), parts[i])
+    return '"'.join(parts)
+
+
+def _shift_ref(m, proto_num, num, last_row):
+    sheet, col1, row1, col2, row2 = m.groups()
+    if sheet and sheet.strip("'!") not in SPLICED_SHEETS:
+        return m.group(0)
+    row1 = int(row1)
+    if col2 is None:
+        if row1 == proto_num:
+            row1 = num
+        return '{0}{1}{2}'.format(sheet or '', col1, row1)
+    row2 = int(row2)
+    if row2 == proto_num and not col2.endswith('$'):
+        # top down to this row
+        if row1 == proto_num:
+            row1 = num
+        row2 = num
+    elif row2 == PROTO_ROW and row1 < PROTO_ROW:
+        row2 = last_row
+    elif row1 == row2 == proto_num:
+        row1 = row2 = num
+    return '{0}{1}{2}:{3}{4}'.format(sheet or '', col1, row1, col2, row2)
+
+
+def _extend_ranges(xml, last_row):
+    """
+    Extend data area ranges in sqref/ref attributes outside of
+    sheetData to last_row. Formulas there are left as is: conditional
+    formatting rules only reference cells relative to the top of their
+    range and validation lists point at the lists sheet.
+    """
+    def sqref(m):
+        refs = []
+        for ref in m.group(2).split():
+            start, sep, end = ref.partition(':')
+            if not sep:
+                end = start
+            col2 = end.rstrip('0123456789')
+            row2 = int(end[len(col2):])
+            row1 = int(start[len(start.rstrip('0123456789')):])
+            if row1 == row2 and sep == '':
+                refs.append(ref)
+                continue
+            if row2 == PROTO_ROW and row1 <= PROTO_ROW:
+                ref = '{0}:{1}{2}'.format(start, col2, last_row)
+            refs.append(ref)
+        return '{0}={1}'.format(m.group(1), quoteattr(' '.join(refs)))
+
+    return SQREF_RE.sub(sqref, xml)
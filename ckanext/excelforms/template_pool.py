@@ -0,0 +1,69 @@
+"""
+Worker processes for building template sheets
+
+The e1 and r1 sheets hold a formula for every checked cell of the
+data area, and building and serializing them is a large part of the
+time taken for a blank template of a wide table. They only depend on
+the column layout, so with ckanext.excelforms.template_workers set
+they are built as worksheet xml in a pool of this many worker
+processes while the request builds the reference sheet, see
+write_excel.excel_template.
+"""
+
+import os
+import threading
+
+_pool = None
+
+
+def set_pool(pool):
+    global _pool
+    _pool = pool
+
+
+def get_pool():
+    return _pool
+
+
+def pool_from_config(config):
+    """
+    Return a ProcessPool when ckanext.excelforms.template_workers
+    is set, otherwise None
+    """
+    workers = int(config.get('ckanext.excelforms.template_workers', 0))
+    if not workers:
+        return None
+    return ProcessPool(workers)
+
+
+class ProcessPool(object):
+    """
+    ProcessPoolExecutor started on first use in each process
+
+    Plugins are configured before web servers like uwsgi fork their
+    workers, and an executor inherited over a fork has no management
+    thread or working queues in the child, so each worker process
+    starts its own.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+
+    def executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # web servers run threads, so start fresh worker
+                # processes instead of forking
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor().submit(fn, *args, **kwargs)
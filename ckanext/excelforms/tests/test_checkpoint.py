@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from ckanext.excelforms.checkpoint import (
+    Checkpoint, remove_expired, write_checkpointed)
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.metrics import Recorder
+from ckanext.excelforms.record_batch import RecordBatch
+
+
+def _batches(values):
+    records = RecordBatch(['a'], range(6, 6 + len(values)), [(v,) for v in values])
+    return list(records.slices(2))
+
+
+class Table(object):
+    """
+    Inserts records, failing on the value 'bad' or with an exception
+    raised after writing a given batch
+    """
+    def __init__(self):
+        self.rows = []
+        self.crash_after = None
+
+    def write(self, records):
+        if any(v == ('bad',) for v in records.values):
+            raise BadExcelData(u'bad value', 8)
+        self.rows.extend(v[0] for v in records.values)
+        if self.crash_after == len(self.rows):
+            raise IOError('connection lost')
+
+    def last_id(self):
+        return len(self.rows)
+
+
+def _upload(tmpdir, table, values, method='insert'):
+    recorder = Recorder()
+    write_checkpointed(
+        str(tmpdir), 'res', method, _batches(values),
+        table.write, table.last_id, recorder)
+    return recorder.counters.get('checkpoint_skipped', 0)
+
+
+def test_corrected_upload_continues(tmpdir):
+    table = Table()
+    with pytest.raises(BadExcelData):
+        _upload(tmpdir, table, ['w', 'x', 'bad', 'z', 'y'])
+    assert table.rows == ['w', 'x']
+    assert _upload(tmpdir, table, ['w', 'x', 'ok', 'z', 'y']) == 2
+    assert table.rows == ['w', 'x', 'ok', 'z', 'y']
+    # finished uploads leave no checkpoint, uploading again inserts again
+    assert os.listdir(str(tmpdir)) == []
+    assert _upload(tmpdir, table, ['w', 'x']) == 0
+
+
+def test_interrupted_insert_not_duplicated(tmpdir):
+    table = Table()
+    table.crash_after = 4
+    with pytest.raises(IOError):
+        _upload(tmpdir, table, ['w', 'x', 'y', 'z', 'v'])
+    table.crash_after = None
+    # second batch was written but still pending
+    assert _upload(tmpdir, table, ['w', 'x', 'y', 'z', 'v']) == 4
+    assert table.rows == ['w', 'x', 'y', 'z', 'v']
+
+
+def test_interrupted_insert_table_changed(tmpdir):
+    table = Table()
+    table.crash_after = 2
+    with pytest.raises(IOError):
+        _upload(tmpdir, table, ['w', 'x', 'y'])
+    table.crash_after = None
+    table.rows.append('other')
+    with pytest.raises(BadExcelData) as e:
+        _upload(tmpdir, table, ['w', 'x', 'y'])
+    assert 'rows 6-7' in e.value.message
+    # after removing the rows already loaded the upload continues
+    assert _upload(tmpdir, table, ['y']) == 0
+    assert table.rows == ['w', 'x', 'other', 'y']
+
+
+def test_locked(tmpdir):
+    held = Checkpoint(str(tmpdir), 'res', 'abc')
+    try:
+        with pytest.raises(BadExcelData):
+            Checkpoint(str(tmpdir), 'res', 'abc')
+    finally:
+        held.close()
+
+
+def test_remove_expired(tmpdir):
+    directory = str(tmpdir)
+    old = Checkpoint(directory, 'res', 'old')
+    old.abort()
+    old.close()
+    held = Checkpoint(directory, 'res', 'held')
+    held.abort()
+    try:
+        week_later = os.path.getmtime(old.path) + 7 * 24 * 3600
+        remove_expired(directory, 24 * 3600, week_later)
+        # the running upload's checkpoint is kept
+        assert sorted(os.listdir(directory)) == [
+            os.path.basename(held.path), os.path.basename(held.path) + '.lock']
+        remove_expired(directory, 24 * 3600)
+        assert len(os.listdir(directory)) == 2
+    finally:
+        held.close()
+    remove_expired(directory, 24 * 3600, week_later)
+    assert os.listdir(directory) == []
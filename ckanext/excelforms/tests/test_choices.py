@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+import pytest
+
+from ckanext.excelforms.datatypes import (
+    canonicalize, ChoiceIndex, choice_indexes)
+from ckanext.excelforms.errors import BadExcelData
+
+
+def test_choice_codes():
+    ci = ChoiceIndex('province', {'ON': 'Ontario', 'QC': 'Québec'})
+    assert canonicalize('ON', 'text', False, ci) == 'ON'
+    assert canonicalize(' on ', 'text', False, ci) == 'ON'
+    assert canonicalize('QC: Québec', 'text', False, ci) == 'QC'
+    assert canonicalize('qc:Quebec', 'text', False, ci) == 'QC'
+    assert canonicalize('', 'text', False, ci) == ''
+    assert canonicalize(None, 'text', False, ci) == ''
+    with pytest.raises(BadExcelData) as e:
+        canonicalize('BC', 'text', False, ci)
+    assert e.value.message == 'Invalid choice for province: "BC"'
+
+
+def test_choice_codes_differing_by_case():
+    ci = ChoiceIndex('code', ['ab', 'AB', 'c'])
+    assert canonicalize('AB', 'text', False, ci) == 'AB'
+    assert canonicalize('C', 'text', False, ci) == 'c'
+    with pytest.raises(BadExcelData):
+        canonicalize('Ab', 'text', False, ci)
+
+
+def test_choice_codes_multiple_values():
+    ci = ChoiceIndex('colours', ['red', 'green', 'Blue'])
+    assert canonicalize('red, blue,GREEN', '_text', False, ci) == [
+        'red', 'Blue', 'green']
+    assert canonicalize('red,', '_text', False, ci) == ['red']
+    assert canonicalize('', '_text', False, ci) == []
+    with pytest.raises(BadExcelData):
+        canonicalize('red, purple', '_text', False, ci)
+
+
+def test_choice_codes_int_field():
+    ci = ChoiceIndex('rating', ['1', '2', '3'])
+    assert canonicalize(2, 'int', False, ci) == '2'
+    assert canonicalize(3.0, 'int', False, ci) == '3'
+    assert canonicalize(' 1 ', 'int', False, ci) == '1'
+    with pytest.raises(BadExcelData) as e:
+        canonicalize(7, 'int', False, ci)
+    assert e.value.message == 'Invalid choice for rating: "7"'
+    with pytest.raises(BadExcelData):
+        canonicalize('seven', 'int', False, ci)
+
+
+def test_choice_indexes():
+    fields = [
+        {'id': 'a', 'choices': ['x']},
+        {'id': 'b'},
+        {'id': 'c', 'choices': {'y': 'Y'}},
+    ]
+    indexes = choice_indexes(fields, lambda f: f.get('choices'))
+    assert sorted(indexes) == ['a', 'c']
+    assert indexes['c'].codes == frozenset(['y'])
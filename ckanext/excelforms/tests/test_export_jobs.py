@@ -0,0 +1,71 @@
+import os
+import time
+
+from ckanext.excelforms import export_jobs
+
+
+def test_status_round_trip(tmp_path):
+    export_id = 'a' * 32
+    export_jobs.write_status(str(tmp_path), export_id, {'state': 'queued'})
+    assert export_jobs.read_status(str(tmp_path), export_id) == {
+        'state': 'queued'}
+    assert export_jobs.read_status(str(tmp_path), 'b' * 32) is None
+
+
+def test_status_rejects_paths(tmp_path):
+    (tmp_path / 'secret.json').write_text('{}')
+    assert export_jobs.read_status(str(tmp_path), '../secret') is None
+    assert export_jobs.read_status(str(tmp_path), 'secret') is None
+
+
+def test_async_export_records_needs_export_dir():
+    assert export_jobs.async_export_records(
+        {'ckanext.excelforms.async_export_records': '5000'}) == 0
+    assert export_jobs.async_export_records({
+        'ckanext.excelforms.async_export_records': '5000',
+        'ckanext.excelforms.export_dir': '/tmp'}) == 5000
+
+
+def test_sendfile_header():
+    export_id = 'a' * 32
+    config = {'ckanext.excelforms.export_dir': '/srv/exports'}
+    assert export_jobs.sendfile_header(config, export_id, '.xlsx') is None
+    config['ckanext.excelforms.export_sendfile'] = 'X-Sendfile'
+    assert export_jobs.sendfile_header(config, export_id, '.zip') == (
+        'X-Sendfile', '/srv/exports/' + export_id + '.zip')
+    config['ckanext.excelforms.export_sendfile'] = 'x-accel-redirect'
+    config['ckanext.excelforms.export_accel_location'] = '/internal/'
+    assert export_jobs.sendfile_header(config, export_id, '.xlsx') == (
+        'X-Accel-Redirect', '/internal/' + export_id + '.xlsx')
+
+
+def test_flask_app_from_worker_command(monkeypatch):
+    import click
+    monkeypatch.setattr(export_jobs, '_app', None)
+    app = object()
+    with click.Context(click.Command('worker')) as ctx:
+        ctx.meta['flask_app'] = app
+        assert export_jobs._flask_app() is app
+    # kept for later jobs
+    assert export_jobs._flask_app() is app
+
+
+def test_expire_exports(tmp_path):
+    directory = str(tmp_path)
+    old, new = 'a' * 32, 'b' * 32
+    for export_id in (old, new):
+        export_jobs.write_status(directory, export_id, {'state': 'done'})
+        (tmp_path / (export_id + '.xlsx')).write_bytes(b'xlsx')
+    day_ago = time.time() - 24 * 3600
+    os.utime(str(tmp_path / (old + '.json')), (day_ago, day_ago))
+
+    export_jobs.expire_exports(directory, 3600)
+    assert export_jobs.read_status(directory, old) == {'state': 'expired'}
+    assert sorted(os.listdir(directory)) == [
+        old + '.json', new + '.json', new + '.xlsx']
+
+    # expired status is kept for another max age
+    export_jobs.expire_exports(directory, 3600)
+    assert export_jobs.read_status(directory, old) == {'state': 'expired'}
+    export_jobs.expire_exports(directory, 3600, time.time() + 3600)
+    assert sorted(os.listdir(directory)) == [new + '.json']
@@ -0,0 +1,95 @@
+from io import BytesIO
+
+import pytest
+from ckan.plugins.toolkit import NotAuthorized
+
+from ckanext.excelforms import blueprint, logic
+from ckanext.excelforms.errors import BadExcelData
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """
+    Replace the datastore calls made by excelforms_upload, return the
+    list of (resource_id, dry_run) uploads processed
+    """
+    processed = []
+
+    def process(lc, resource_id, upload, dd, dry_run, recorder):
+        processed.append((resource_id, dry_run))
+        recorder.tags['method'] = 'insert'
+        recorder.count('rows', 2)
+        if upload.getvalue() == b'bad':
+            raise BadExcelData('Data row 7: bad', 7)
+
+    monkeypatch.setattr(blueprint, '_local_ckan', lambda user: None)
+    monkeypatch.setattr(
+        blueprint, '_get_data_dictionary', lambda lc, resource_id: [])
+    monkeypatch.setattr(blueprint, '_process_upload_file', process)
+    monkeypatch.setattr(logic, 'check_access', lambda *args: True)
+    return processed
+
+
+def test_upload_dry_run(uploads):
+    result = logic.excelforms_upload({'user': 'u'}, {
+        'resource_id': 'res', 'upload': BytesIO(b'ok'), 'dry_run': 'true'})
+    assert uploads == [('res', True)]
+    assert result['dry_run'] is True
+    assert result['method'] == 'insert'
+    assert result['records'] == 2
+    assert result['errors'] == []
+
+    result = logic.excelforms_upload({'user': 'u'}, {
+        'resource_id': 'res', 'upload': BytesIO(b'ok')})
+    assert uploads == [('res', True), ('res', False)]
+    assert result['dry_run'] is False
+
+
+def test_upload_errors(uploads):
+    result = logic.excelforms_upload({'user': 'u'}, {
+        'resource_id': 'res', 'upload': BytesIO(b'bad')})
+    assert result['errors'] == [{'row': 7, 'message': 'Data row 7: bad'}]
+    assert result['counters']['errors'] == 1
+
+
+def test_upload_not_authorized(uploads, monkeypatch):
+    checked = []
+
+    def check_access(action, context, data_dict):
+        checked.append(action)
+        raise NotAuthorized()
+
+    monkeypatch.setattr(logic, 'check_access', check_access)
+    with pytest.raises(NotAuthorized):
+        logic.excelforms_upload({'user': 'u'}, {
+            'resource_id': 'res', 'upload': BytesIO(b'ok')})
+    assert checked == ['excelforms_upload']
+    assert uploads == []
+
+
+def test_upload_auth_uses_datastore_upsert(monkeypatch):
+    calls = []
+
+    def is_authorized(action, context, data_dict):
+        calls.append((action, data_dict))
+        return {'success': False}
+
+    monkeypatch.setattr(logic.authz, 'is_authorized', is_authorized)
+    assert logic.excelforms_upload_auth(
+        {'user': 'u'}, {'resource_id': 'res'}) == {'success': False}
+    assert calls == [('datastore_upsert', {'resource_id': 'res'})]
+
+
+def test_in_thread_removes_session(monkeypatch):
+    removed = []
+    monkeypatch.setattr(blueprint, 'copy_current_request_context', lambda f: f)
+    monkeypatch.setattr(blueprint.model, 'Session', type(
+        'Session', (), {'remove': staticmethod(lambda: removed.append(1))}))
+
+    def fail():
+        raise ValueError('page 2')
+
+    assert blueprint._in_thread(lambda x: x * 2)(3) == 6
+    with pytest.raises(ValueError):
+        blueprint._in_thread(fail)()
+    assert removed == [1, 1]
@@ -0,0 +1,76 @@
+from ckanext.excelforms.metrics import Recorder, InMemorySink, set_sink, get_sink
+
+
+class Clock(object):
+    """
+    Fake clock advanced by sleep()
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_nested_stages_exclusive():
+    clock = Clock()
+    r = Recorder('upload', clock=clock)
+    with r.stage('outer'):
+        clock.sleep(1)
+        with r.stage('inner'):
+            clock.sleep(2)
+        clock.sleep(4)
+    clock.sleep(8)
+    assert r.timings == {'outer': 5, 'inner': 2}
+    assert r.total() == 15
+    assert 'clock' not in r.tags
+
+
+def test_timed_iter():
+    clock = Clock()
+    r = Recorder('upload', clock=clock)
+
+    def slow():
+        for i in range(3):
+            clock.sleep(1)
+            yield i
+
+    with r.stage('canonicalize'):
+        for i in r.timed_iter('row_read', slow()):
+            clock.sleep(2)
+    assert r.timings == {'row_read': 3, 'canonicalize': 6}
+
+
+def test_report_to_sink():
+    sink = InMemorySink()
+    old = get_sink()
+    set_sink(sink)
+    try:
+        r = Recorder('template', resource_id='abc')
+        with r.stage('save'):
+            pass
+        r.count('rows', 10)
+        r.count('rows', 5)
+        r.report()
+    finally:
+        set_sink(old)
+    assert sink.counters == {'excelforms.template.rows': 15}
+    names = sorted(n for n, s, t in sink.timings)
+    assert names == ['excelforms.template.save', 'excelforms.template.total']
+    assert all(t == {'resource_id': 'abc'} for n, s, t in sink.timings)
+
+
+def test_unnamed_recorder_not_reported():
+    sink = InMemorySink()
+    old = get_sink()
+    set_sink(sink)
+    try:
+        r = Recorder()
+        r.count('rows')
+        r.report()
+    finally:
+        set_sink(old)
+    assert sink.counters == {}
@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from ckanext.excelforms.prefetch import Prefetch
+
+
+def test_prefetch_items_in_order():
+    assert list(Prefetch(iter(range(10)), depth=2)) == list(range(10))
+
+
+def test_prefetch_raises_producer_errors():
+    def pages():
+        yield 1
+        raise ValueError('page 2')
+
+    items = []
+    with pytest.raises(ValueError):
+        for item in Prefetch(pages()):
+            items.append(item)
+    assert items == [1]
+
+
+def test_prefetch_stops_with_consumer():
+    produced = []
+    stopped = threading.Event()
+
+    def pages():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+        finally:
+            stopped.set()
+
+    for item in Prefetch(pages(), depth=2):
+        break
+    assert stopped.wait(5)
+    assert len(produced) < 10
+
+
+def test_prefetch_wrap():
+    names = []
+
+    def wrap(f):
+        def wrapped():
+            names.append(threading.current_thread().name)
+            return f()
+        return wrapped
+
+    assert list(Prefetch(iter('ab'), wrap=wrap)) == ['a', 'b']
+    assert names == ['excelforms-prefetch']
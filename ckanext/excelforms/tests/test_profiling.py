@@ -0,0 +1,34 @@
+import os
+
+from ckanext.excelforms.profiling import Capture, profile_modes
+
+
+def test_profile_modes():
+    assert profile_modes('cpu') == (True, False)
+    assert profile_modes('Memory') == (False, True)
+    assert profile_modes('all') == (True, True)
+    assert profile_modes('1') == (True, True)
+    assert profile_modes('false') == (False, False)
+    assert profile_modes(None) == (False, False)
+
+
+def _work():
+    return sum(len(str(i)) for i in range(10000))
+
+
+def test_capture_writes_profile_and_summary(tmp_path):
+    with Capture(cpu=True, memory=True) as capture:
+        _work()
+    summary = capture.write(str(tmp_path), 'p', 'operation=test\n', top=5)
+    assert summary.startswith('operation=test\n')
+    assert '_work' in summary
+    assert 'tracemalloc' in summary
+    assert sorted(os.listdir(str(tmp_path))) == ['p.prof', 'p.txt']
+
+
+def test_capture_memory_only(tmp_path):
+    with Capture(cpu=False, memory=True) as capture:
+        _work()
+    summary = capture.write(str(tmp_path), 'p')
+    assert 'cProfile' not in summary
+    assert os.listdir(str(tmp_path)) == ['p.txt']
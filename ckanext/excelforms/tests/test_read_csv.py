@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+from io import BytesIO
+
+import pytest
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.read_csv import csv_delimiter, read_csv, batches
+from ckanext.excelforms.read_excel import get_records
+
+
+def test_csv_delimiter():
+    assert csv_delimiter('data.CSV') == ','
+    assert csv_delimiter('data.tsv') == '\t'
+    assert csv_delimiter('upload', 'text/csv') == ','
+    assert csv_delimiter('template.xlsx', 'application/octet-stream') is None
+    assert csv_delimiter(None) is None
+
+
+def test_read_csv_line_numbers():
+    data = (
+        u'﻿name,when,count\r\n'
+        u'"Montréal, QC",2024-02-29,42\r\n'
+        u',,\r\n'
+        u'"two\nlines",,2.5\r\n'
+        u'\r\n'
+        u'last\r\n'
+    ).encode('utf-8')
+    names, rows = read_csv(BytesIO(data))
+    assert names == ['name', 'when', 'count']
+    rows = list(rows)
+    assert rows == [
+        (2, [u'Montréal, QC', u'2024-02-29', u'42']),
+        (5, [u'two\nlines', u'', u'2.5']),
+        (7, [u'last']),
+    ]
+    fields = [
+        {'id': 'name', 'type': 'text'},
+        {'id': 'when', 'type': 'date'},
+        {'id': 'count', 'type': 'numeric'}]
+    records = get_records(rows, fields, [], {})
+    assert list(records.row_numbers) == [2, 5, 7]
+    assert records.values[2] == (u'last', None, None)
+
+
+def test_read_csv_errors():
+    with pytest.raises(BadExcelData):
+        read_csv(BytesIO(b''))
+    data = b'a\tb\n' + b'x\ty\n' * 10000 + b'x\t\xff\n'
+    names, rows = read_csv(BytesIO(data), '\t')
+    assert names == ['a', 'b']
+    with pytest.raises(BadExcelData):
+        list(rows)
+
+
+def test_batches():
+    assert list(batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batches([], 2)) == []
+
+
+def test_error_row():
+    fields = [{'id': 'name', 'type': 'text'}]
+    with pytest.raises(BadExcelData) as e:
+        get_records([(2, [u'ok']), (7, [u'=1+1'])], fields, [], {})
+    assert e.value.row == 7
@@ -0,0 +1,41 @@
+import pytest
+
+from ckanext.excelforms.record_batch import RecordBatch
+from ckanext.excelforms.read_excel import get_records
+
+
+def test_record_batch():
+    batch = RecordBatch(['a', 'b'])
+    batch.append(6, ['x', None])
+    batch.append(8, ['y', '2'])
+    assert len(batch) == 2
+    assert batch[1] == (8, {'a': 'y', 'b': '2'})
+    assert list(batch) == [(6, {'a': 'x', 'b': None}), (8, {'a': 'y', 'b': '2'})]
+    assert list(batch.value_rows()) == [(6, ('x', None)), (8, ('y', '2'))]
+    assert batch.dicts() == [{'a': 'x', 'b': None}, {'a': 'y', 'b': '2'}]
+
+
+def test_record_batch_add():
+    one = RecordBatch(['a'], [6], [('x',)])
+    two = RecordBatch(['a'], [6, 7], [('y',), ('z',)])
+    merged = one + two
+    assert list(merged.row_numbers) == [6, 6, 7]
+    assert len(one) == 1
+    with pytest.raises(ValueError):
+        one + RecordBatch(['b'])
+
+
+def test_record_batch_extend():
+    one = RecordBatch(['a'], [6], [('x',)])
+    one.extend(RecordBatch(['a'], [7], [('y',)]))
+    assert list(one) == [(6, {'a': 'x'}), (7, {'a': 'y'})]
+    with pytest.raises(ValueError):
+        one.extend(RecordBatch(['b']))
+
+
+def test_get_records_pads_and_trims_rows():
+    fields = [{'id': 'a', 'type': 'text'}, {'id': 'n', 'type': 'int'}]
+    records = get_records(
+        iter([(6, ['x']), (7, ['y', 3.0, None, ''])]), fields, [], {})
+    assert records.fields == ('a', 'n')
+    assert list(records) == [(6, {'a': 'x', 'n': None}), (7, {'a': 'y', 'n': '3'})]
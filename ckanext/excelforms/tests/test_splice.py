@@ -0,0 +1,99 @@
+from ckanext.excelforms import splice
+
+
+def test_shift_formula_same_row_and_data_ranges():
+    fmla = (
+        "IF(ISBLANK('data'!C7),\"\",MATCH(K7,K$6:K$7,0)<>ROW()-5)"
+        "&'reference'!A7&\"C7\"")
+    assert splice._shift_formula(fmla, 7, 42, 100) == (
+        "IF(ISBLANK('data'!C42),\"\",MATCH(K42,K$6:K$100,0)<>ROW()-5)"
+        "&'reference'!A7&\"C7\"")
+
+
+def test_extend_ranges_leaves_single_cells():
+    xml = '<conditionalFormatting sqref="A6 A4:I7 C6:C7"><dataValidation sqref="F1">'
+    assert splice._extend_ranges(xml, 500) == (
+        '<conditionalFormatting sqref="A6 A4:I500 C6:C500">'
+        '<dataValidation sqref="F1">')
+
+
+def test_row_template_values_and_formulas():
+    row = (
+        '<row r="7" ht="20"><c r="A7" s="3"><f>C7&amp;D7</f></c>'
+        '<c r="C7" s="4"/><c r="D7" s="5" t="n"><v>1</v></c></row>')
+    template = splice._RowTemplate(row, 7, ['B', 'C', 'D'])
+    assert template.render(9, 20, [None, 'a<b', 12]) == (
+        '<row r="9" ht="20"><c r="A9" s="3"><f>C9&amp;D9</f></c>'
+        '<c r="C9" s="4" t="inlineStr"><is><t xml:space="preserve">'
+        'a&lt;b</t></is></c>'
+        '<c r="D9" s="5" t="n"><v>12</v></c></row>')
+    # without values prototype cells are copied as they are
+    assert '<c r="D10" s="5" t="n"><v>1</v></c>' in template.render(10, 20)
+
+
+class ColumnType(object):
+    label = 'Text'
+    excel_format = 'General'
+
+    def __init__(self, field):
+        self.field = field
+
+    def excel_validate_rule(self):
+        if self.field.get('choices'):
+            return 'ISERROR(MATCH({_value_},{_choice_range_},0))'
+        if self.field['type'] == 'int':
+            return 'NOT(ISNUMBER({_value_}))'
+
+    def column_constraints(self):
+        return []
+
+
+def _sheet_contents(book):
+    """
+    Return cell values and formulas, data validations and conditional
+    formatting ranges and rules for every sheet in book
+    """
+    contents = {}
+    for sheet in book:
+        contents[sheet.title] = (
+            {c.coordinate: c.value
+                for row in sheet.iter_rows() for c in row
+                if c.value is not None},
+            sorted((str(dv.sqref), dv.formula1)
+                for dv in sheet.data_validations.dataValidation),
+            sorted((str(cf.sqref), [r.formula for r in cf.rules])
+                for cf in sheet.conditional_formatting))
+    return contents
+
+
+def test_spliced_template_matches_direct_build():
+    from io import BytesIO
+    from unittest import mock
+
+    import openpyxl
+
+    from ckanext.excelforms import write_excel
+
+    dd = [
+        {'id': 'ref', 'type': 'text', 'tdpkreq': 'pk', 'info': {}},
+        {'id': 'n', 'type': 'int', 'tdpkreq': 'req', 'info': {}},
+        {'id': 'prov', 'type': 'text', 'choices': ['ON', 'QC'], 'info': {}},
+        {'id': 'note', 'type': 'text', 'info': {}}]
+    resource = {'id': 'res-id', 'package_id': 'pkg', 'name': 'Spliced'}
+    for num_records in (1, 2, 3, 7):
+        records = [['r%d' % i, i, 'ON', None] for i in range(num_records)]
+        with mock.patch.object(write_excel, 'h') as h, \
+                mock.patch.object(write_excel, '_', lambda s: s):
+            h.tabledesigner_column_type.side_effect = ColumnType
+            h.tabledesigner_choices.side_effect = lambda f: f.get('choices')
+            h.excelforms_language_text.side_effect = (
+                lambda f, field: f.get(field, ''))
+            h.get_translated.return_value = 'Spliced'
+            h.url_for.return_value = '/dataset/pkg'
+            direct = BytesIO()
+            write_excel.excel_template(resource, dd, records).save(direct)
+            base = splice.base_template(resource, dd)
+        spliced = BytesIO()
+        base.write(spliced, splice.record_rows(dd, records), num_records)
+        assert _sheet_contents(openpyxl.load_workbook(spliced)) == (
+            _sheet_contents(openpyxl.load_workbook(direct))), num_records
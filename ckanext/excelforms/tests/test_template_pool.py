@@ -0,0 +1,33 @@
+from ckanext.excelforms import template_pool
+
+
+def test_pool_from_config():
+    assert template_pool.pool_from_config({}) is None
+    pool = template_pool.pool_from_config(
+        {'ckanext.excelforms.template_workers': '2'})
+    assert pool.workers == 2
+    # nothing is started at configure time
+    assert pool._executor is None
+
+
+def test_executor_started_per_process(monkeypatch):
+    started = []
+
+    class Executor(object):
+        def __init__(self, workers, mp_context):
+            started.append(workers)
+
+        def submit(self, fn, *args):
+            return fn(*args)
+
+    monkeypatch.setattr(
+        'concurrent.futures.ProcessPoolExecutor', Executor)
+    pool = template_pool.ProcessPool(3)
+    assert pool.submit(len, 'abc') == 3
+    assert pool.submit(len, 'ab') == 2
+    assert started == [3]
+
+    # an executor inherited by a forked process is replaced
+    monkeypatch.setattr(template_pool.os, 'getpid', lambda: -1)
+    pool.submit(len, 'a')
+    assert started == [3, 3]
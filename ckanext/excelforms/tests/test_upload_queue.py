@@ -0,0 +1,130 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from ckanext.excelforms.errors import BadExcelData
+from ckanext.excelforms.upload_queue import UploadQueue
+
+
+class Datastore(object):
+    """
+    Records upsert calls, blocking the first until released
+    """
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def upsert(self, method, dry_run, records):
+        self.calls.append((method, [n for n, r in records]))
+        if len(self.calls) == 1:
+            self.started.set()
+            self.release.wait(5)
+        for n, r in records:
+            if r.get('bad'):
+                raise BadExcelData('Data row {0}: bad'.format(n))
+
+
+def _submit_all(queue, datastore, uploads):
+    """
+    Submit the first upload, then the rest while the first is writing
+    """
+    results = {}
+
+    def submit(name, method, records, user='user'):
+        try:
+            results[name] = queue.submit(
+                'res', user, method, False, records, datastore.upsert)
+        except BadExcelData as e:
+            results[name] = e.message
+
+    threads = [threading.Thread(target=submit, args=u) for u in uploads]
+    threads[0].start()
+    datastore.started.wait(5)
+    for i, t in enumerate(threads[1:], 1):
+        t.start()
+        while len(queue._queues['res'].pending) < i:
+            time.sleep(0.001)
+    datastore.release.set()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_queued_uploads_merged():
+    datastore = Datastore()
+    queue = UploadQueue()
+    results = _submit_all(queue, datastore, [
+        ('a', 'upsert', [(6, {})]),
+        ('b', 'upsert', [(6, {}), (7, {})]),
+        ('c', 'upsert', [(8, {})]),
+        ('d', 'insert', [(9, {})]),
+    ])
+    assert datastore.calls == [
+        ('upsert', [6]),
+        ('upsert', [6, 7, 8]),
+        ('insert', [9]),
+    ]
+    assert results == {'a': 1, 'b': 2, 'c': 2, 'd': 1}
+    # per-resource state removed once nothing is waiting
+    assert not queue._queues
+
+
+def test_merged_upload_errors_attributed():
+    datastore = Datastore()
+    results = _submit_all(UploadQueue(), datastore, [
+        ('a', 'upsert', [(6, {})]),
+        ('b', 'upsert', [(6, {}), (7, {'bad': True})]),
+        ('c', 'upsert', [(6, {})]),
+    ])
+    assert datastore.calls == [
+        ('upsert', [6]),
+        ('upsert', [6, 7, 6]),
+        ('upsert', [6, 7]),
+        ('upsert', [6]),
+    ]
+    assert results == {'a': 1, 'b': 'Data row 7: bad', 'c': 1}
+
+
+def test_max_records():
+    datastore = Datastore()
+    _submit_all(UploadQueue(max_records=2), datastore, [
+        ('a', 'upsert', [(6, {})]),
+        ('b', 'upsert', [(6, {})]),
+        ('c', 'upsert', [(6, {})]),
+        ('d', 'upsert', [(6, {})]),
+    ])
+    assert [len(c[1]) for c in datastore.calls] == [1, 2, 1]
+
+
+def test_only_same_user_merged():
+    datastore = Datastore()
+    results = _submit_all(UploadQueue(), datastore, [
+        ('a', 'upsert', [(6, {})]),
+        ('b', 'upsert', [(6, {})], 'other'),
+        ('c', 'upsert', [(7, {})]),
+        ('d', 'upsert', [(8, {})]),
+    ])
+    assert datastore.calls == [
+        ('upsert', [6]),
+        ('upsert', [6]),
+        ('upsert', [7, 8]),
+    ]
+    assert results == {'a': 1, 'b': 1, 'c': 2, 'd': 2}
+
+
+def test_resource_lock_held_around_writes():
+    held = []
+
+    @contextmanager
+    def resource_lock(resource_id):
+        held.append(resource_id)
+        yield
+        held.append(None)
+
+    def upsert(method, dry_run, records):
+        assert held[-1] == 'res'
+
+    queue = UploadQueue(resource_lock=resource_lock)
+    assert queue.submit('res', 'user', 'upsert', False, [(6, {})], upsert) == 1
+    assert held == ['res', None]
@@ -0,0 +1,215 @@
+import re
+
+import openpyxl
+from unittest import mock
+
+from ckanext.excelforms import write_excel
+
+# cell or range references like A6, $C$6, 'data'!C6, K$6:K$2005
+REFERENCE_RE = re.compile(
+    r"(?:'[^']+'!|\w+!)?\$?[A-Z]{1,3}\$?\d+(?::\$?[A-Z]{1,3}\$?\d+)?")
+
+
+class ColumnType(object):
+    def __init__(self, field):
+        self.field = field
+
+    def column_constraints(self):
+        return []
+
+
+def _e_sheet(dd, records=()):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    with mock.patch.object(write_excel, 'h') as h:
+        h.tabledesigner_column_type.side_effect = ColumnType
+        write_excel._populate_excel_e_sheet(sheet, dd, {}, 'data', records)
+    return sheet
+
+
+def _references(value):
+    return REFERENCE_RE.findall(value or '')
+
+
+def test_pk_duplicate_formula_references_per_row():
+    last_row = write_excel.DATA_FIRST_ROW + write_excel.DEFAULT_DATA_NUM_ROWS - 1
+    for num_pk in (1, 2, 4):
+        dd = [{'id': 'pk%d' % i, 'type': 'text', 'tdpkreq': 'pk'}
+            for i in range(num_pk)]
+        dd.append({'id': 'value', 'type': 'text'})
+        sheet = _e_sheet(dd)
+
+        for row in (write_excel.DATA_FIRST_ROW, last_row):
+            fmla = sheet.cell(row=row, column=write_excel.DATA_FIRST_COL_NUM).value
+            # value cell, helper key cell, the helper key range for MATCH
+            # and the helper keys up to this row for keys too long for
+            # MATCH, independent of the number of rows and key columns
+            assert len(_references(fmla)) == 6, fmla
+            key = write_excel.get_column_letter(
+                write_excel.DATA_FIRST_COL_NUM + len(dd))
+            assert 'IF(LEN({key}{row})<={max_len},'.format(
+                key=key, row=row,
+                max_len=write_excel.MATCH_MAX_KEY_LEN) in fmla
+            assert 'SUMPRODUCT(--({key}${top}:{key}{row}={key}{row}))>1'.format(
+                key=key, row=row, top=write_excel.DATA_FIRST_ROW) in fmla
+
+            key_fmla = sheet.cell(
+                row=row,
+                column=write_excel.DATA_FIRST_COL_NUM + len(dd)).value
+            refs = _references(key_fmla)
+            assert len(refs) == num_pk, key_fmla
+            assert all(':' not in r for r in refs)
+
+
+def test_pk_key_column_right_of_error_columns():
+    dd = [
+        {'id': 'a', 'type': 'text', 'tdpkreq': 'pk'},
+        {'id': 'b', 'type': 'text', 'tdpkreq': 'pk'},
+    ]
+    sheet = _e_sheet(dd)
+    row = write_excel.DATA_FIRST_ROW
+    # row status only looks at the error columns C:D, not the key in E
+    assert "C{0}:D{0}".format(row) in sheet.cell(
+        row=row, column=write_excel.RSTATUS_COL_NUM).value
+    assert sheet.cell(row=row, column=5).value == (
+        "=TRIM('data'!C6)&CHAR(9)&TRIM('data'!D6)")
+
+
+def test_lists_sheet_one_column_per_list():
+    book = openpyxl.Workbook()
+    sheet = book.active
+    write_excel._populate_lists_sheet(sheet, [['ON', 'QC'], ['a', 'b', 'c']])
+    assert [[c.value for c in row] for row in sheet.iter_rows()] == [
+        ['ON', 'a'], ['QC', 'b'], [None, 'c']]
+
+
+def test_large_choice_lists_summarized_on_reference_sheet():
+    refs = []
+    choices = [('k%d' % i, 'v%d' % i)
+        for i in range(write_excel.REF_MAX_CHOICES + 50)]
+    with mock.patch.object(write_excel, '_', lambda s: s):
+        write_excel._append_field_choices_rows(refs, choices, False)
+    assert len([r for r in refs if r[0] == 'choice']) == (
+        write_excel.REF_MAX_CHOICES)
+    assert refs[1] == ('attr', ['Note', '{0} values, the first {1} are shown'
+        .format(len(choices), write_excel.REF_MAX_CHOICES)])
+
+
+class TemplateColumnType(ColumnType):
+    label = 'Text'
+    excel_format = 'General'
+
+    def excel_validate_rule(self):
+        if self.field['type'] == 'int':
+            return 'NOT(ISNUMBER({_value_}))'
+
+
+def test_data_table_template():
+    from io import BytesIO
+    from ckanext.excelforms.read_excel import read_excel
+
+    dd = [
+        {'id': 'ref', 'type': 'text', 'tdpkreq': 'pk'},
+        {'id': 'n', 'type': 'int', 'tdpkreq': 'req'},
+        {'id': 'note', 'type': 'text'}]
+    resource = {'id': 'res-id', 'package_id': 'pkg', 'name': 'Table'}
+    with mock.patch.object(write_excel, 'h') as h:
+        h.tabledesigner_column_type.side_effect = TemplateColumnType
+        h.tabledesigner_choices.return_value = None
+        h.excelforms_language_text.side_effect = (
+            lambda f, field: f.get(field, ''))
+        h.get_translated.return_value = 'Table'
+        h.url_for.return_value = '/dataset/pkg'
+        book = write_excel.excel_template(resource, dd, [], table_rows=3)
+    assert book.sheetnames == ['data', 'reference', 'lists']
+    sheet = book['data']
+    assert not sheet.protection.enabled
+    table = sheet.tables[write_excel.TABLE_NAME]
+    # status and pad, 3 fields, 3 error, 3 required, 3 row checks, pk key
+    assert table.ref == 'A6:O8'
+    names = [c.name for c in table.tableColumns]
+    assert names[:5] == ['_status', '_pad', 'ref', 'n', 'note']
+    assert names[5:11] == ['_e_ref', '_e_n', '_e_note', '_r_ref', '_r_n', '_r_note']
+    calculated = {
+        c.name: c.calculatedColumnFormula.attr_text
+        for c in table.tableColumns if c.calculatedColumnFormula}
+    assert 'ref' not in calculated
+    assert calculated['_e_n'] == (
+        'NOT(xlf_data[[#This Row],[n]]="")*'
+        '(NOT(ISNUMBER(xlf_data[[#This Row],[n]])))')
+    assert calculated['_r_n'] == (
+        'xlf_data[[#This Row],[_has_data]]*(xlf_data[[#This Row],[n]]="")')
+    assert sheet['J8'].value == '=' + calculated['_r_n']
+    # long keys are compared with the keys on the rows above
+    assert (
+        'SUMPRODUCT(--(INDEX(xlf_data[_pk],1):xlf_data[[#This Row],[_pk]]'
+        '=xlf_data[[#This Row],[_pk]]))>1') in calculated['_e_ref']
+    assert sheet.column_dimensions['F'].hidden
+
+    sheet['C7'] = 'a'
+    sheet['E7'] = 'b'
+    blob = BytesIO()
+    book.save(blob)
+    sheet_name, res_id, column_names, rows = next(read_excel(blob))
+    assert column_names == ['ref', 'n', 'note']
+    assert list(rows) == [(7, ['a', None, 'b'])]
+
+
+def test_pooled_sheets_match():
+    from io import BytesIO
+    from concurrent.futures import ThreadPoolExecutor
+    import zipfile
+
+    from ckanext.excelforms.template_pool import ProcessPool
+
+    dd = [
+        {'id': 'ref', 'type': 'text', 'tdpkreq': 'pk'},
+        {'id': 'n', 'type': 'int', 'tdpkreq': 'req'}]
+    resource = {'id': 'res-id', 'package_id': 'pkg', 'name': 'Pooled'}
+    parts = []
+    # worker processes are spawned, so the sheet arguments are pickled
+    process_pool = ProcessPool(1)
+    for pool in (None, ThreadPoolExecutor(2), process_pool):
+        with mock.patch.object(write_excel, 'h') as h:
+            h.tabledesigner_column_type.side_effect = TemplateColumnType
+            h.tabledesigner_choices.return_value = None
+            h.excelforms_language_text.side_effect = (
+                lambda f, field: f.get(field, ''))
+            h.get_translated.return_value = 'Pooled'
+            h.url_for.return_value = '/dataset/pkg'
+            book = write_excel.excel_template(resource, dd, [], pool=pool)
+        blob = BytesIO()
+        book.save(blob)
+        with zipfile.ZipFile(blob) as z:
+            parts.append([z.read(n) for n in z.namelist()
+                if n.startswith('xl/worksheets/sheet')])
+    assert isinstance(book, write_excel.PooledBook)
+    e_sheet = parts[0][3].decode('utf-8')
+    assert 'NOT(ISNUMBER(' in e_sheet and '<sheetProtection' in e_sheet
+    process_pool.executor().shutdown()
+    assert parts[0] == parts[1] == parts[2]
+
+
+def test_format_records():
+    from datetime import date, datetime
+    from decimal import Decimal
+    fields = [
+        {'id': 'd', 'type': 'date'},
+        {'id': 'ts', 'type': 'timestamp'},
+        {'id': 'n', 'type': 'numeric'},
+        {'id': 'i', 'type': 'int'},
+        {'id': 'tags', 'type': '_text'},
+        {'id': 't', 'type': 'text'},
+    ]
+    records = [
+        ['2024-02-29', '2024-02-29T13:45:01', '1.50', 7, ['a', 'b'], 'x'],
+        ['2024-02-29', '2024-02-29T13:45:01.250000', None, None, [], None],
+    ]
+    assert write_excel.format_records(fields, records) == [
+        [date(2024, 2, 29), datetime(2024, 2, 29, 13, 45, 1),
+            Decimal('1.50'), 7, 'a, b', 'x'],
+        [date(2024, 2, 29), datetime(2024, 2, 29, 13, 45, 1, 250000),
+            None, None, '', None],
+    ]
+    assert write_excel.datastore_type_format(
+        '2024-02-29 13:45:01', 'timestamp') == datetime(2024, 2, 29, 13, 45, 1)
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+from datetime import datetime, date
+from io import BytesIO
+
+import openpyxl
+
+from ckanext.excelforms.xlsx_stream import StreamingWorkbook
+from ckanext.excelforms.read_excel import read_excel
+
+
+def _workbook():
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'data'
+    sheet['A1'] = 'title'
+    sheet['A3'] = 'xlf_v1'
+    sheet['B3'] = 'res-id'
+    sheet['C3'] = 'name'
+    sheet['D3'] = 'when'
+    sheet['E3'] = 'count'
+    sheet['A5'] = 'e.g.'
+    sheet['C6'] = u'Montréal & <Québec>'
+    sheet['D6'] = date(2024, 2, 29)
+    sheet['E6'] = 42
+    sheet['C8'] = u'Montréal & <Québec>'
+    sheet['E8'] = 2.5
+    sheet['F8'] = True
+    sheet['G8'] = '=1+1'
+    sheet['D9'] = datetime(2024, 1, 2, 3, 4, 5)
+    sheet['D9'].number_format = 'yyyy-mm-dd hh:mm:ss'
+    book.create_sheet('reference')['A1'] = 'never read'
+    blob = BytesIO()
+    book.save(blob)
+    return blob
+
+
+def test_rows_match_openpyxl():
+    blob = _workbook()
+    expected = [
+        list(row) for row in openpyxl.load_workbook(
+            blob, read_only=True)['data'].iter_rows(values_only=True)]
+    wb = StreamingWorkbook(blob)
+    try:
+        assert wb.sheetnames == ['data', 'reference']
+        rows = list(wb.rows('data'))
+    finally:
+        wb.close()
+    # openpyxl pads every row to the widest one
+    assert [r + [None] * (len(e) - len(r)) for r, e in zip(rows, expected)] == expected
+    assert rows[5][3] == datetime(2024, 2, 29)
+    assert rows[7][6] == '=1+1'
+
+
+def test_read_excel_streaming():
+    sheet_name, res_id, names, rows = next(read_excel(_workbook(), streaming=True))
+    assert (sheet_name, res_id, names) == ('data', 'res-id', ['name', 'when', 'count'])
+    assert list(rows) == [
+        (6, [u'Montréal & <Québec>', datetime(2024, 2, 29), 42]),
+        # cells right of the named columns are ignored
+        (8, [u'Montréal & <Québec>', None, 2.5]),
+        (9, [None, datetime(2024, 1, 2, 3, 4, 5)]),
+    ]
+
+
+def test_read_excel_streaming_closes_workbook(monkeypatch):
+    closed = []
+    monkeypatch.setattr(
+        StreamingWorkbook, 'close', lambda self: closed.append(self))
+    sheet_name, res_id, names, rows = next(read_excel(_workbook(), streaming=True))
+    next(rows)
+    assert not closed
+    # e.g. after an error in the first row
+    rows.close()
+    assert len(closed) == 1
@@ -0,0 +1,208 @@
+"""
+Per-resource serialization and coalescing of upload writes
+
+Uploads to the same resource wait for each other instead of running
+datastore_upsert in parallel against the same table and indexes. The
+thread holding a resource's write lock also takes uploads queued
+behind it and, when they are from the same user and use the same
+method and dry_run setting, writes them in a single upsert. If that
+merged upsert fails, each upload in it is retried on its own so every
+submitter gets the error for their own rows.
+
+Within a process uploads wait in a queue per resource. Across
+processes, e.g. preforked web server workers, each write also holds a
+PostgreSQL advisory lock for the resource on the datastore write
+engine, so writes are serialized there too but there is no ordering
+or coalescing between processes.
+
+Enabled with ckanext.excelforms.upload_queue, merged upserts are
+limited to ckanext.excelforms.upload_coalesce_max_records records.
+"""
+
+import threading
+from contextlib import contextmanager, nullcontext
+from collections import deque
+
+from ckan.plugins.toolkit import asbool
+
+DEFAULT_MAX_RECORDS = 10000
+
+
+class _Upload(object):
+    def __init__(self, user, method, dry_run, records, upsert):
+        self.user = user
+        self.method = method
+        self.dry_run = dry_run
+        self.records = records
+        self.upsert = upsert
+        self.done = False
+        self.error = None
+        self.batch_size = 1
+
+
+class _ResourceQueue(object):
+    def __init__(self):
+        self.write_lock = threading.Lock()
+        self.pending = deque()
+        self.users = 0
+
+
+class UploadQueue(object):
+    """
+    Serialize writes per resource, merging queued uploads into batches
+    of up to max_records records.
+
+    resource_lock(resource_id), when given, returns a context manager
+    held around each write to serialize writes across processes.
+    """
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS, resource_lock=None):
+        self.max_records = max_records
+        self.resource_lock = resource_lock
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def submit(self, resource_id, user, method, dry_run, records, upsert):
+        """
+        Queue records (a RecordBatch) from user for writing,
+        wait until they are written and return the number of uploads
+        written with them.
+
+        upsert(method, dry_run, records) performs the write as user and
+        raises BadExcelData on errors. It may be called with records
+        merged from other uploads by the same user to the same
+        resource, possibly from another thread.
+
+        Raises the exception upsert raised for these records.
+        """
+        upload = _Upload(user, method, dry_run, records, upsert)
+        with self._lock:
+            queue = self._queues.get(resource_id)
+            if queue is None:
+                queue = self._queues[resource_id] = _ResourceQueue()
+            queue.users += 1
+            queue.pending.append(upload)
+
+        try:
+            with queue.write_lock:
+                while not upload.done:
+                    self._write(resource_id, self._take_batch(queue))
+        finally:
+            with self._lock:
+                queue.users -= 1
+                if not queue.users:
+                    del self._queues[resource_id]
+
+        if upload.error is not None:
+            raise upload.error
+        return upload.batch_size
+
+    def _take_batch(self, queue):
+        """
+        Remove and return the first pending upload and the uploads
+        following it from the same user with the same method and
+        dry_run setting, up to max_records records
+        """
+        with self._lock:
+            first = queue.pending.popleft()
+            batch = [first]
+            total = len(first.records)
+            while queue.pending:
+                upload = queue.pending[0]
+                if (upload.user != first.user
+                        or upload.method != first.method
+                        or upload.dry_run != first.dry_run
+                        or total + len(upload.records) > self.max_records):
+                    break
+                batch.append(queue.pending.popleft())
+                total += len(upload.records)
+        return batch
+
+    def _write(self, resource_id, batch):
+        """
+        Write batch holding resource_lock, with a single call to the
+        first upload's upsert, falling back to each upload's own upsert
+        on errors
+        """
+        lock = (self.resource_lock(resource_id) if self.resource_lock
+            else nullcontext())
+        try:
+            with lock:
+                self._write_batch(batch)
+        except Exception as e:
+            # failed to take the lock, raised again in every submitter
+            for upload in batch:
+                if not upload.done:
+                    upload.error = e
+                    upload.done = True
+
+    def _write_batch(self, batch):
+        if len(batch) > 1:
+            first = batch[0]
+            try:
+                records = first.records
+                for upload in batch[1:]:
+                    records = records + upload.records
+                first.upsert(first.method, first.dry_run, records)
+            except Exception:
+                pass  # retry individually below to attribute the error
+            else:
+                for upload in batch:
+                    upload.batch_size = len(batch)
+                    upload.done = True
+                return
+
+        for upload in batch:
+            try:
+                upload.upsert(upload.method, upload.dry_run, upload.records)
+            except Exception as e:
+                # raised again in the submitting thread
+                upload.error = e
+            upload.done = True
+
+
+_queue = None
+
+
+def set_queue(queue):
+    global _queue
+    _queue = queue
+
+
+def get_queue():
+    return _queue
+
+
+@contextmanager
+def advisory_lock(resource_id):
+    """
+    Hold a transaction level PostgreSQL advisory lock for resource_id on
+    its own datastore write engine connection
+    """
+    from ckanext.datastore.backend.postgres import get_write_engine
+
+    connection = get_write_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock("
+            "hashtext('ckanext.excelforms.upload'), hashtext(%s))",
+            (resource_id,))
+        yield
+    finally:
+        # ends the transaction, releasing the lock
+        connection.rollback()
+        connection.close()
+
+
+def queue_from_config(config):
+    """
+    Return an UploadQueue when ckanext.excelforms.upload_queue is
+    enabled, otherwise None
+    """
+    if not asbool(config.get('ckanext.excelforms.upload_queue', False)):
+        return None
+    return UploadQueue(
+        int(config.get(
+            'ckanext.excelforms.upload_coalesce_max_records',
+            DEFAULT_MAX_RECORDS)),
+        advisory_lock)
@@ -6,16 +6,22 @@ Excel v3 template and data-dictionary generation code
 import re
 import textwrap
 import string
+import zipfile
+from io import BytesIO
 
 import openpyxl
 from openpyxl.utils import get_column_letter
 from openpyxl.formatting.rule import FormulaRule
 from openpyxl.styles import NamedStyle
+from openpyxl.worksheet.table import Table, TableColumn, TableFormula
 
 from ckan.plugins.toolkit import _, h, asbool
 
-from datetime import datetime
+from ckanext.excelforms.metrics import Recorder
+
+from datetime import date, datetime
 from decimal import Decimal
+from itertools import zip_longest
 
 EXCEL_SHEET_NAME_MAX = 31
 EXCEL_SHEET_NAME_INVALID_RE = r'[^a-zA-Z0-9]'
@@ -31,6 +37,12 @@ EXAMPLE_MERGE = 'A5:B5'
 FREEZE_PANES = 'C5'
 DATA_FIRST_ROW, DEFAULT_DATA_HEIGHT = 6, 24
 DEFAULT_DATA_NUM_ROWS = 2000
+# data rows that fit below the header rows of a sheet
+MAX_DATA_NUM_ROWS = 1048576 - DATA_FIRST_ROW + 1
+TABLE_NAME = 'xlf_data'
+# longest primary key looked up with MATCH, which is limited to 255
+# characters after escaping wildcards, see _duplicate_key_rule
+MATCH_MAX_KEY_LEN = 127
 RSTATUS_COL, RSTATUS_COL_NUM = 'A', 1
 RSTATUS_WIDTH = 1
 RPAD_COL, RPAD_COL_NUM = 'B', 2
@@ -54,8 +66,10 @@ REF_VALUE_COL, REF_VALUE_COL_NUM = 'D', 4
 REF_VALUE_WIDTH = 114
 REF_CHOICE_HEADING_HEIGHT = 24
 REF_EDGE_RANGE = 'A1:A2'
+REF_MAX_CHOICES = 200
 
 DATA_SHEET_TITLE = 'data'
+LISTS_SHEET_TITLE = 'lists'
 
 EXTENSION_GITHUB = 'https://github.com/open-data/ckanext-excelforms'
 
@@ -96,64 +110,273 @@ TYPE_HERE_STYLE = {
     'Font': {'bold': True, 'size': 16}}
 
 
-def excel_template(resource, dd, records):
+def excel_template(resource, dd, records, recorder=None, lite=False,
+        table_rows=None, pool=None):
     """
     return an openpyxl.Workbook object containing the sheet and header fields
     for passed column definitions dd.
 
     if records is not empty add a locked "_id" column and only allow editing
-    the records passed
+    the records passed, lists of values in dd order as returned by
+    datastore_search with records_format='lists'
+
+    recorder is a metrics.Recorder for data_sheet, reference_sheet,
+    e_sheet and r_sheet stage timings
+
+    lite=True leaves out everything only useful for entering data in
+    Excel: the e1/r1 sheets, conditional formatting, data validation,
+    status formulas, styled data rows and sheet protection
+
+    table_rows for blank templates makes the data rows an Excel table
+    with this many rows, that Excel extends with its formatting,
+    validation and error checks as rows are added, see _add_data_table.
+    The data sheet isn't protected because Excel can't add rows to
+    tables on protected sheets.
+
+    pool is a concurrent.futures executor for building the e1 and r1
+    sheets in other processes while the rest of the workbook is built,
+    see template_pool. A PooledBook is returned instead of a Workbook.
     """
+    recorder = recorder or Recorder()
+    if records or lite:
+        table_rows = None
 
     book = openpyxl.Workbook()
     form_sheet = book.active
     form_sheet.title = DATA_SHEET_TITLE
     refs = []
+    choice_lists = []
+
+    with recorder.stage('data_sheet'):
+        _build_styles(book, dd)
+        cranges = _populate_excel_sheet(
+            book, form_sheet, resource, dd, refs, records, lite, choice_lists,
+            table_rows)
+        form_sheet.protection.enabled = not lite and not table_rows
+        form_sheet.protection.formatRows = False
+        form_sheet.protection.formatColumns = False
+
+    pending = {}
+    if pool is not None and not lite and not table_rows:
+        with recorder.stage('submit_sheets'):
+            # h isn't available in worker processes, and the records
+            # are only needed for their number
+            rules = {
+                f['id']: _error_rule(h.tabledesigner_column_type(f))
+                for cn, f in template_cols_fields(dd, records)}
+            num_records = range(len(records))
+            for title in ('e1', 'r1'):
+                pending[title] = pool.submit(
+                    _sheet_xml, title, resource, dd, cranges, num_records,
+                    rules)
+
+    with recorder.stage('reference_sheet'):
+        sheet = book.create_sheet()
+        _populate_reference_sheet(sheet, resource, dd, refs)
+        sheet.title = 'reference'
+        sheet.protection.enabled = True
+
+    if lite:
+        return book
+
+    with recorder.stage('lists_sheet'):
+        sheet = book.create_sheet()
+        _populate_lists_sheet(sheet, choice_lists)
+        sheet.title = LISTS_SHEET_TITLE
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    if table_rows:
+        return book  # checks are in the data table
+
+    with recorder.stage('e_sheet'):
+        sheet = book.create_sheet()
+        if not pending:
+            _populate_excel_e_sheet(
+                sheet, dd, cranges, form_sheet.title, records)
+        sheet.title = 'e1'
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    with recorder.stage('r_sheet'):
+        sheet = book.create_sheet()
+        if not pending:
+            _populate_excel_r_sheet(
+                sheet, resource, dd, form_sheet.title, records)
+        sheet.title = 'r1'
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    if pending:
+        return PooledBook(book, pending)
+    return book
 
-    _build_styles(book, dd)
-    cranges = _populate_excel_sheet(
-        book, form_sheet, resource, dd, refs, records)
-    form_sheet.protection.enabled = True
-    form_sheet.protection.formatRows = False
-    form_sheet.protection.formatColumns = False
 
-    sheet = book.create_sheet()
-    _populate_reference_sheet(sheet, resource, dd, refs)
-    sheet.title = 'reference'
+class PooledBook(object):
+    """
+    Workbook with some sheets being built in worker processes. save()
+    waits for their worksheet xml and writes it in place of the empty
+    sheets with the same titles in book.
+    """
+    def __init__(self, book, pending):
+        self.book = book
+        self.pending = pending
+
+    def save(self, f):
+        # openpyxl numbers worksheet parts in workbook order
+        parts = {
+            'xl/worksheets/sheet{0}.xml'.format(
+                self.book.sheetnames.index(title) + 1): future
+            for title, future in self.pending.items()}
+        blob = BytesIO()
+        self.book.save(blob)
+        with zipfile.ZipFile(blob) as zin, \
+                zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                future = parts.get(info.filename)
+                zout.writestr(
+                    info,
+                    zin.read(info.filename) if future is None
+                    else future.result())
+
+
+def _sheet_xml(title, resource, dd, cranges, records, rules):
+    """
+    Build the e1 or r1 sheet on its own and return its worksheet xml,
+    called in worker processes. These sheets have no strings or styles
+    so the xml doesn't depend on the rest of the workbook.
+    """
+    book = openpyxl.Workbook()
+    sheet = book.active
+    if title == 'e1':
+        _populate_excel_e_sheet(
+            sheet, dd, cranges, DATA_SHEET_TITLE, records, rules)
+    else:
+        _populate_excel_r_sheet(
+            sheet, resource, dd, DATA_SHEET_TITLE, records)
+    sheet.title = title
     sheet.protection.enabled = True
+    blob = BytesIO()
+    book.save(blob)
+    with zipfile.ZipFile(blob) as z:
+        return z.read('xl/worksheets/sheet1.xml')
 
-    sheet = book.create_sheet()
-    _populate_excel_e_sheet(sheet, dd, cranges, form_sheet.title, records)
-    sheet.title = 'e1'
-    sheet.protection.enabled = True
-    sheet.sheet_state = 'hidden'
 
-    sheet = book.create_sheet()
-    _populate_excel_r_sheet(sheet, resource, dd, form_sheet.title, records)
-    sheet.title = 'r1'
-    sheet.protection.enabled = True
-    sheet.sheet_state = 'hidden'
-    return book
+NUMERIC_TYPES = ('money', 'year', 'int', 'bigint', 'numeric')
 
 
 def datastore_type_format(value, datastore_type):
+    """
+    Return the cell value for a datastore value of datastore_type
+    """
+    return column_formatter(datastore_type)(value)
 
-    if value is None:
-        return None
 
-    numeric_types = ['money', 'year', 'int', 'bigint', 'numeric']
-    if isinstance(value, list):
-        item = u', '.join(unicode(e) for e in value)
+def column_formatter(datastore_type):
+    """
+    Return a function converting datastore values of datastore_type
+    to cell values. Date and timestamp formatters parse each distinct
+    value once, so keep one formatter per column for a page of records.
+    """
+    if datastore_type.startswith('_'):
+        convert = _format_list
     elif datastore_type == 'date':
-        item = datetime.strptime(value, "%Y-%m-%d").date()
+        convert = _cached(_parse_date)
     elif datastore_type == 'timestamp':
-        item = datetime.strptime(value, "%Y-%m-%d %H:%M:%S %Z")
-    elif datastore_type in numeric_types:
-        item = Decimal(value)
+        convert = _cached(_parse_timestamp)
+    elif datastore_type in NUMERIC_TYPES:
+        convert = _format_numeric
     else:
-        item = value
+        return _format_value
 
-    return item
+    def formatter(value):
+        if value is None:
+            return None
+        if isinstance(value, list):
+            return _format_list(value)
+        return convert(value)
+    return formatter
+
+
+def format_records(fields, records):
+    """
+    Return rows of cell values for records, lists of datastore values
+    in the order of fields, converted a column at a time
+    """
+    columns = [
+        [formatter(v) for v in column]
+        for formatter, column in zip(
+            (column_formatter(f['type']) for f in fields), zip(*records))]
+    return [list(row) for row in zip(*columns)]
+
+
+class RecordPages(object):
+    """
+    Records for an edit template fetched a page at a time: len() is
+    the number of records and pages an iterable of lists of records,
+    iterated once while the data sheet is written
+    """
+    def __init__(self, num_records, pages):
+        self.num_records = num_records
+        self.pages = pages
+
+    def __len__(self):
+        return self.num_records
+
+
+def record_pages(records):
+    """
+    Return an iterable of lists of records for records, a list or
+    RecordPages
+    """
+    if isinstance(records, RecordPages):
+        return records.pages
+    return [records]
+
+
+def _cached(parse):
+    parsed = {}
+
+    def convert(value):
+        try:
+            return parsed[value]
+        except KeyError:
+            item = parsed[value] = parse(value)
+            return item
+    return convert
+
+
+def _parse_date(value):
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return value
+
+
+def _parse_timestamp(value):
+    # datastore_search returns ISO 8601 timestamps without a time zone
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _format_numeric(value):
+    if isinstance(value, (int, float)):
+        return value
+    return Decimal(value)
+
+
+def _format_list(value):
+    if isinstance(value, list):
+        return u', '.join(str(e) for e in value)
+    return value
+
+
+def _format_value(value):
+    if isinstance(value, list):
+        return _format_list(value)
+    return value
 
 
 def estimate_width_from_length(length):
@@ -191,18 +414,29 @@ def _build_styles(book, geno):
     build_named_style(book, 'xlf_ref_value', REF_VALUE_STYLE)
 
 
-def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
+def _populate_excel_sheet(book, sheet, resource, dd, refs, records, lite=False,
+        choice_lists=None, table_rows=None):
     """
     Format openpyxl sheet for the resource excel form
 
     refs - list of rows to add to reference sheet, modified
         in place from this function
+    lite - only header rows, column names and records, see excel_template
+    choice_lists - list of distinct lists of choice keys for the lists
+        sheet, modified in place from this function
+    table_rows - number of rows for an Excel table, see excel_template
 
     returns cranges dict of {datastore_id: reference_key_range}
     """
     resource_num = 1  # only one supported for now
 
     cranges = {}
+    if choice_lists is None:
+        choice_lists = []
+    # {tuple of choice keys: (choice_range, first field label)}
+    list_ranges = {}
+    # {formula: shared DataValidation}
+    validations = {}
     if records:
         data_num_rows = len(records)
     else:
@@ -232,6 +466,14 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
         **resource.get('excelforms_example_style', {})
     )
 
+    if lite:
+        data_num_rows = len(records)
+    elif table_rows:
+        data_num_rows = table_rows
+    # table columns with the error and required checks for each field
+    # follow the data columns, see _add_data_table
+    num_cols = sum(1 for f in template_cols_fields(dd, records))
+
     # create rows so we can set all heights
     for i in range(1, DATA_FIRST_ROW + data_num_rows):
         sheet.cell(row=i, column=1).value = None
@@ -240,15 +482,16 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
     sheet.merge_cells(EXAMPLE_MERGE)
     fill_cell(sheet, EXAMPLE_ROW, 1, _('e.g.'), 'xlf_example')
 
-    fill_cell(
-        sheet,
-        DATA_FIRST_ROW,
-        RPAD_COL_NUM,
-        u'=IF(r{rnum}!{col}{row},"","▶")'.format(
-            rnum=resource_num,
-            col=RPAD_COL,
-            row=DATA_FIRST_ROW),
-        TYPE_HERE_STYLE)
+    if not lite and not table_rows:
+        fill_cell(
+            sheet,
+            DATA_FIRST_ROW,
+            RPAD_COL_NUM,
+            u'=IF(r{rnum}!{col}{row},"","▶")'.format(
+                rnum=resource_num,
+                col=RPAD_COL,
+                row=DATA_FIRST_ROW),
+            TYPE_HERE_STYLE)
 
     fill_cell(
         sheet,
@@ -329,14 +572,23 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
         col_letter = get_column_letter(col_num)
 
         # jump to first error/required cell in column
-        fill_cell(
-            sheet,
-            CSTATUS_ROW,
-            col_num,
-            '=IF(e{rnum}!{col}{row}>0,HYPERLINK("#{col}"&e{rnum}!{col}{row},"")'
+        if lite:
+            cstatus = None
+        elif table_rows:
+            cstatus = (
+                '=IF({ecol}{row}>0,HYPERLINK("#{col}"&{ecol}{row},"")'
+                ',IF({rcol}{row}>0,HYPERLINK("#{col}"&{rcol}{row},""),""))'
+                .format(
+                    col=col_letter,
+                    ecol=get_column_letter(col_num + num_cols),
+                    rcol=get_column_letter(col_num + 2 * num_cols),
+                    row=CSTATUS_ROW))
+        else:
+            cstatus = (
+                '=IF(e{rnum}!{col}{row}>0,HYPERLINK("#{col}"&e{rnum}!{col}{row},"")'
                 ',IF(r{rnum}!{col}{row}>0,HYPERLINK("#{col}"&r{rnum}!{col}{row},""),""))'
-                .format(rnum=resource_num, col=col_letter, row=CSTATUS_ROW),
-            col_heading_style)
+                .format(rnum=resource_num, col=col_letter, row=CSTATUS_ROW))
+        fill_cell(sheet, CSTATUS_ROW, col_num, cstatus, col_heading_style)
 
         col = sheet.column_dimensions[col_letter]
         if 'excel_column_width' in field:
@@ -352,7 +604,7 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
         ct = h.tabledesigner_column_type(field)
         xl_format = ct.excel_format
         alignment = openpyxl.styles.Alignment(wrap_text=True)
-        if field['id'] != '_id':
+        if field['id'] != '_id' and not lite:
             col_style = NamedStyle(
                 name='xlf_{0}{1}'.format(resource_num, col_letter),
                 number_format=xl_format,
@@ -374,12 +626,29 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
             #full_text_choices = (
             #    field['type'] != '_text' and field['info'].get(
             #    'excel_full_text_choices', False))
+            choices = [c[0] for c in choice_fields[field['id']]]
+            same_as = list_ranges.get(tuple(choices))
             ref1 = len(refs) + REF_FIRST_ROW
-            max_choice_width = _append_field_choices_rows(
-                refs,
-                choice_fields[field['id']],
-                full_text_choices)
+            if same_as:
+                choice_range, same_label = same_as
+                refs.append(('attr', [
+                    _('Values'),
+                    _('Same values as "{0}"').format(same_label)]))
+                max_choice_width = 0
+            else:
+                max_choice_width = _append_field_choices_rows(
+                    refs,
+                    choice_fields[field['id']],
+                    full_text_choices)
+                choice_lists.append(choices)
+                choice_range = '{sheet}!${col}$1:${col}${num}'.format(
+                    sheet=LISTS_SHEET_TITLE,
+                    col=get_column_letter(len(choice_lists)),
+                    num=len(choices))
+                list_ranges[tuple(choices)] = (choice_range, field_heading)
             refN = len(refs) + REF_FIRST_ROW - 2
+            if not same_as:
+                ref1 = refN - min(len(choices), REF_MAX_CHOICES) + 1
 
             if full_text_choices:
                 if 'excel_column_width' not in field:
@@ -390,8 +659,6 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
                         ex_cell.value = u"{0}: {1}".format(ck, cv)
                         break
 
-            choice_range = 'reference!${col}${ref1}:${col}${refN}'.format(
-                col=REF_KEY_COL, ref1=ref1, refN=refN)
             user_choice_range = field.get('excel_choice_range_formula')
             if user_choice_range:
                 choice_keys = set(
@@ -411,21 +678,24 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
                     **choice_values)
             cranges[field['id']] = choice_range
 
-            choices = [c[0] for c in choice_fields[field['id']]]
-            if field['type'] != '_text':
-                v = openpyxl.worksheet.datavalidation.DataValidation(
-                    type="list",
-                    formula1=user_choice_range or choice_range,
-                    allow_blank=True)
-                v.errorTitle = u'Invalid choice'
-                valid_keys = u', '.join(choices)
-                if len(valid_keys) < 40:
-                    v.error = (u'Please enter one of the valid choices: '
-                        + valid_keys)
-                else:
-                    v.error = (u'Please enter one of the valid choices shown on '
-                        'sheet "reference" rows {0}-{1}'.format(ref1, refN))
-                sheet.add_data_validation(v)
+            if field['type'] != '_text' and not lite:
+                formula = user_choice_range or choice_range
+                v = validations.get(formula)
+                if v is None:
+                    v = openpyxl.worksheet.datavalidation.DataValidation(
+                        type="list",
+                        formula1=formula,
+                        allow_blank=True)
+                    v.errorTitle = u'Invalid choice'
+                    valid_keys = u', '.join(choices)
+                    if len(valid_keys) < 40:
+                        v.error = (u'Please enter one of the valid choices: '
+                            + valid_keys)
+                    else:
+                        v.error = (u'Please enter one of the valid choices shown on '
+                            'sheet "reference" rows {0}-{1}'.format(ref1, refN))
+                    sheet.add_data_validation(v)
+                    validations[formula] = v
                 v.add(validation_range)
 
         if field['id'] != '_id':
@@ -436,13 +706,22 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
                     colZ=REF_VALUE_COL,
                     rowN=len(refs) + REF_FIRST_ROW - 2))
 
-    _add_conditional_formatting(
-        sheet,
-        col_letter,
-        resource_num,
-        error_style,
-        required_style,
-        data_num_rows)
+    if table_rows:
+        _add_data_table(
+            sheet,
+            dd,
+            cranges,
+            error_style,
+            required_style,
+            data_num_rows)
+    elif not lite:
+        _add_conditional_formatting(
+            sheet,
+            col_letter,
+            resource_num,
+            error_style,
+            required_style,
+            data_num_rows)
 
     sheet.row_dimensions[HEADER_ROW].height = HEADER_HEIGHT
     sheet.row_dimensions[CODE_ROW].hidden = True
@@ -454,17 +733,20 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
         )
     else:
         sheet.row_dimensions[EXAMPLE_ROW].hidden = True
-    for i in range(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-        sheet.row_dimensions[i].height = field['info'].get(
-            'excelforms_data_height', DEFAULT_DATA_HEIGHT)
+    if not lite:
+        for i in range(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
+            sheet.row_dimensions[i].height = field['info'].get(
+                'excelforms_data_height', DEFAULT_DATA_HEIGHT)
+            if table_rows:
+                continue
 
-        # jump to first error/required cell in row
-        sheet.cell(row=i, column=RSTATUS_COL_NUM).value = (
-            '=IF(e{rnum}!{col}{row}>0,'
-                'HYPERLINK("#"&ADDRESS({row},e{rnum}!{col}{row}),""),'
-                'IF(r{rnum}!{col}{row}>0,'
-                    'HYPERLINK("#"&ADDRESS({row},r{rnum}!{col}{row}),""),""))'
-            .format(rnum=resource_num, col=RSTATUS_COL, row=i))
+            # jump to first error/required cell in row
+            sheet.cell(row=i, column=RSTATUS_COL_NUM).value = (
+                '=IF(e{rnum}!{col}{row}>0,'
+                    'HYPERLINK("#"&ADDRESS(ROW(),e{rnum}!{col}{row}),""),'
+                    'IF(r{rnum}!{col}{row}>0,'
+                        'HYPERLINK("#"&ADDRESS(ROW(),r{rnum}!{col}{row}),""),""))'
+                .format(rnum=resource_num, col=RSTATUS_COL, row=i))
 
     sheet.column_dimensions[RSTATUS_COL].width = RSTATUS_WIDTH
     sheet.column_dimensions[RPAD_COL].width = RPAD_WIDTH
@@ -484,12 +766,14 @@ def _populate_excel_sheet(book, sheet, resource, dd, refs, records):
     sheet.sheet_view.selection[0].sqref = select
 
     # fill in existing records for editing
+    record_cols = list(template_cols_fields(dd, records))
+    fields = [f for cn, f in record_cols]
     current_row = DATA_FIRST_ROW
-    for record in records:
-        for col_num, field in template_cols_fields(dd, records):
-            item = datastore_type_format(record[field['id']], field['type'])
-            sheet.cell(row=current_row, column=col_num).value = item
-        current_row += 1
+    for page in record_pages(records):
+        for values in format_records(fields, page):
+            for (col_num, field), item in zip(record_cols, values):
+                sheet.cell(row=current_row, column=col_num).value = item
+            current_row += 1
 
     return cranges
 
@@ -535,8 +819,19 @@ def _append_field_ref_rows(refs, field, link):
         ]))
 
 def _append_field_choices_rows(refs, choices, full_text_choices):
+    """
+    Add choice rows to refs, lists longer than REF_MAX_CHOICES are
+    summarized
+    """
     refs.append(('choice heading', [_('Values')]))
     max_length = 0
+    choices = list(choices)
+    if len(choices) > REF_MAX_CHOICES:
+        refs.append(('attr', [
+            _('Note'),
+            _('{0} values, the first {1} are shown').format(
+                len(choices), REF_MAX_CHOICES)]))
+        choices = choices[:REF_MAX_CHOICES]
     for key, value in choices:
         if full_text_choices:
             choice = [u'{0}: {1}'.format(key, value)]
@@ -643,7 +938,73 @@ def _populate_reference_sheet(sheet, resource, dd, refs):
     sheet.column_dimensions[REF_VALUE_COL].width = REF_VALUE_WIDTH
 
 
-def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title, records):
+def _populate_lists_sheet(sheet, choice_lists):
+    """
+    Write each list of choice keys into its own column, without styles.
+    These are the ranges used for data validation and error checking.
+    """
+    for row in zip_longest(*choice_lists):
+        sheet.append(row)
+
+
+def _error_rule(ct):
+    """
+    Return the error formula for the column type ct with {_value_},
+    {_choice_range_} and {field_id} placeholders, or None
+    """
+    fmla = None
+    if hasattr(ct, 'excel_validate_rule'):
+        fmla = ct.excel_validate_rule()
+
+    for cc in ct.column_constraints():
+        if not hasattr(cc, 'excel_constraint_rule'):
+            continue
+        rule = cc.excel_constraint_rule()
+        if not rule:
+            continue
+        fmla = 'OR(' + fmla + ',' + rule + ')' if fmla else rule
+    return fmla
+
+
+def _required_rule(field):
+    """
+    Return the required formula for field with {has_data}, {cell}
+    and {field_id} placeholders, or None
+    """
+    fmla = field.get('excel_required_formula')
+    pk_field = field.get('tdpkreq') == 'pk'
+    required = field.get('tdpkreq') == 'req'
+
+    if fmla:
+        return '{has_data}*({cell}="")*(' + fmla +')'
+    elif pk_field or required:
+        return '{has_data}*({cell}="")'
+
+
+def _duplicate_key_rule(key, keys, earlier_keys, row0):
+    """
+    Return a formula true when the primary key in cell key is on an
+    earlier row of the range keys, earlier_keys being the part of keys
+    up to this row and row0 the row before keys.
+
+    MATCH can't look up values over 255 characters, and escaping its
+    wildcards may double the length, so longer keys are compared with
+    every earlier key instead.
+    """
+    return (
+        'IF(LEN({key})<={max_len},'
+        'MATCH(SUBSTITUTE(SUBSTITUTE(SUBSTITUTE({key},'
+        '"~","~~"),"*","~*"),"?","~?"),{keys},0)<>ROW()-{row0},'
+        'SUMPRODUCT(--({earlier_keys}={key}))>1)'.format(
+            key=key,
+            keys=keys,
+            earlier_keys=earlier_keys,
+            row0=row0,
+            max_len=MATCH_MAX_KEY_LEN))
+
+
+def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title, records,
+        rules=None):
     """
     Populate the "error" calculation excel worksheet
 
@@ -652,6 +1013,9 @@ def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title, records):
 
     Other cells are 1 for error, 0 or blank for no error or no value
     in the corresponding cell on the data entry sheet.
+
+    rules is {field id: error formula} from _error_rule, looked up
+    from the column types when not given
     """
     col = None
     if records:
@@ -659,23 +1023,36 @@ def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title, records):
     else:
         data_num_rows = int(DEFAULT_DATA_NUM_ROWS)
 
+    pk_key_col = None
+    pk_cols = [
+        get_column_letter(cn)
+        for cn, f in template_cols_fields(dd, records)
+        if f.get('tdpkreq') == 'pk']
+    if pk_cols:
+        # helper column right of the error columns holding the trimmed,
+        # tab-separated primary key for each row, so that finding a
+        # repeated (composite) key is one MATCH per row instead of
+        # comparing every row against every other row
+        pk_key_col_num = DATA_FIRST_COL_NUM + sum(
+            1 for f in template_cols_fields(dd, records))
+        pk_key_col = get_column_letter(pk_key_col_num)
+        pk_key_fmla = '=' + '&CHAR(9)&'.join(
+            "TRIM('{sheet}'!{col}{{num}})".format(
+                sheet=DATA_SHEET_TITLE,
+                col=col)
+            for col in pk_cols)
+        for i in range(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
+            sheet.cell(row=i, column=pk_key_col_num).value = (
+                pk_key_fmla.format(num=i))
+
     for col_num, field in template_cols_fields(dd, records):
         #pk_field = field['datastore_id'] in chromo['datastore_primary_key']
 
         crange = cranges.get(field['id'])
-        ct = h.tabledesigner_column_type(field)
-
-        fmla = None
-        if hasattr(ct, 'excel_validate_rule'):
-            fmla = ct.excel_validate_rule()
-
-        for cc in ct.column_constraints():
-            if not hasattr(cc, 'excel_constraint_rule'):
-                continue
-            rule = cc.excel_constraint_rule()
-            if not rule:
-                continue
-            fmla = 'OR(' + fmla + ',' + rule + ')' if fmla else rule
+        if rules is None:
+            fmla = _error_rule(h.tabledesigner_column_type(field))
+        else:
+            fmla = rules.get(field['id'])
 
 #        user_fmla = field['info'].get('excelforms_error_formula')
 #        if user_fmla:
@@ -688,17 +1065,19 @@ def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title, records):
 #            fmla = fmla.replace('{cell}', '(' + filter_fmla + ')')
 
 
-        if ct.field.get('tdpkreq') == 'pk':
-            # repeated primary (composite) keys are errors
-            pk_fmla = 'SUMPRODUCT(' + ','.join(
-                "--(TRIM('{sheet}'!{col}{top}:{col}{{_num_}})"
-                "=TRIM('{sheet}'!{col}{{_num_}}))".format(
-                    sheet=DATA_SHEET_TITLE,
-                    col=get_column_letter(cn),
-                    top=DATA_FIRST_ROW)
-                for cn, f in template_cols_fields(dd, records)
-                if f.get('tdpkreq') == 'pk'
-                ) +')>1'
+        if field.get('tdpkreq') == 'pk':
+            # repeated primary (composite) keys are errors: the key
+            # is first found on an earlier row
+            pk_fmla = _duplicate_key_rule(
+                '{key}{{_num_}}'.format(key=pk_key_col),
+                '{key}${top}:{key}${bottom}'.format(
+                    key=pk_key_col,
+                    top=DATA_FIRST_ROW,
+                    bottom=DATA_FIRST_ROW + data_num_rows - 1),
+                '{key}${top}:{key}{{_num_}}'.format(
+                    key=pk_key_col,
+                    top=DATA_FIRST_ROW),
+                DATA_FIRST_ROW - 1)
             fmla = ('OR(' + fmla + ',' + pk_fmla + ')') if fmla else pk_fmla
 
         if not fmla:
@@ -707,6 +1086,7 @@ def _populate_excel_e_sheet(sheet, dd, cranges, form_sheet_title, records):
         fmla_keys = set(
             key for (_i, key, _i, _i) in string.Formatter().parse(fmla)
             if key != '_value_' and key != '_choice_range_')
+        fmla_values = {}
         if fmla_keys:
             fmla_values = {
                 f['id']: "'{sheet}'!{col}{{_num_}}".format(
@@ -774,16 +1154,10 @@ def _populate_excel_r_sheet(sheet, resource, dd, form_sheet_title, records):
             resource.get('excelforms_data_num_rows', DEFAULT_DATA_NUM_ROWS))
 
     for col_num, field in template_cols_fields(dd, records):
-        fmla = field.get('excel_required_formula')
-        pk_field = field.get('tdpkreq') == 'pk'
-        required = field.get('tdpkreq') == 'req'
-
-        if fmla:
-            fmla = '={has_data}*({cell}="")*(' + fmla +')'
-        elif pk_field or required:
-            fmla = '={has_data}*({cell}="")'
-        else:
+        fmla = _required_rule(field)
+        if not fmla:
             continue
+        fmla = '=' + fmla
 
         col = get_column_letter(col_num)
         cell = "'{sheet}'!{col}{{num}}".format(
@@ -912,14 +1286,8 @@ def _add_conditional_formatting(
     '''
     Error and required cell hilighting based on e/r sheets
     '''
-    error_fill = openpyxl.styles.PatternFill(
-        bgColor=error_style['PatternFill']['fgColor'],
-        **error_style['PatternFill'])
-    error_font = openpyxl.styles.Font(**error_style['Font'])
-    required_fill = openpyxl.styles.PatternFill(
-        bgColor=required_style['PatternFill']['fgColor'],
-        **required_style['PatternFill'])
-    required_font = openpyxl.styles.Font(**required_style['Font'])
+    error_fill, error_font = _highlight(error_style)
+    required_fill, required_font = _highlight(required_style)
 
     sheet.conditional_formatting.add(
         '{col}{row1}:{col}{rowN}'.format(
@@ -964,3 +1332,188 @@ def _add_conditional_formatting(
         stopIfTrue=True,
         fill=required_fill,
         font=required_font))
+
+
+def _highlight(style):
+    '''
+    Return (fill, font) for conditional formatting with style
+    '''
+    fill = openpyxl.styles.PatternFill(
+        bgColor=style['PatternFill']['fgColor'],
+        **style['PatternFill'])
+    return fill, openpyxl.styles.Font(**style['Font'])
+
+
+def _table_name(name):
+    '''
+    Escape name for use in a structured reference
+    '''
+    return re.sub(r"([\[\]#'])", r"'\1", name)
+
+
+def _this_row(first, last=None):
+    '''
+    Structured reference to column first (to column last) on the same
+    row of the data table
+    '''
+    ref = '[' + _table_name(first) + ']'
+    if last:
+        ref += ':[' + _table_name(last) + ']'
+    return '{table}[[#This Row],{ref}]'.format(table=TABLE_NAME, ref=ref)
+
+
+def _add_data_table(
+        sheet, dd, cranges, error_style, required_style, data_num_rows):
+    '''
+    Make the data rows an Excel table, from the row status column to
+    hidden calculated columns after the data columns with the checks
+    that are on the e1/r1 sheets of other templates: an error column
+    and a required column for each field in the same order, then the
+    row checks. Excel fills in calculated columns and extends data
+    validation and conditional formatting for rows added to a table.
+
+    The table has no header row, column names are the field ids.
+    '''
+    fields = [f for cn, f in template_cols_fields(dd, [])]
+    ids = [f['id'] for f in fields]
+    num_cols = len(fields)
+    e_names = ['_e_' + i for i in ids]
+    r_names = ['_r_' + i for i in ids]
+    has_pk = any(f.get('tdpkreq') == 'pk' for f in fields)
+    columns = (
+        ['_status', '_pad'] + ids + e_names + r_names
+        + ['_has_data', '_e', '_r'] + (['_pk'] if has_pk else []))
+
+    values = {i: _this_row(i) for i in ids}
+    formulas = {
+        '_status': (
+            'IF({e}>0,HYPERLINK("#"&ADDRESS(ROW(),{e}),""),'
+            'IF({r}>0,HYPERLINK("#"&ADDRESS(ROW(),{r}),""),""))'.format(
+                e=_this_row('_e'),
+                r=_this_row('_r'))),
+        # same as the "type here" cell on other templates
+        '_pad': u'IF(AND(ROW()={row},NOT({has_data})),"▶","")'.format(
+            row=DATA_FIRST_ROW,
+            has_data=_this_row('_has_data')),
+        '_has_data': 'SUMPRODUCT(LEN({0}))>0'.format(
+            _this_row(ids[0], ids[-1])),
+        '_e': 'IFERROR(MATCH(TRUE,INDEX({0}<>0,),)+{1},0)'.format(
+            _this_row(e_names[0], e_names[-1]), DATA_FIRST_COL_NUM - 1),
+        '_r': 'IFERROR(MATCH(TRUE,INDEX({0}<>0,),)+{1},0)'.format(
+            _this_row(r_names[0], r_names[-1]), DATA_FIRST_COL_NUM - 1),
+    }
+    if has_pk:
+        formulas['_pk'] = '&CHAR(9)&'.join(
+            'TRIM({0})'.format(values[f['id']])
+            for f in fields if f.get('tdpkreq') == 'pk')
+
+    for field, e_name, r_name in zip(fields, e_names, r_names):
+        ct = h.tabledesigner_column_type(field)
+        fmla = _error_rule(ct)
+        if field.get('tdpkreq') == 'pk':
+            # repeated primary keys, see _populate_excel_e_sheet
+            pk_fmla = _duplicate_key_rule(
+                _this_row('_pk'),
+                '{table}[_pk]'.format(table=TABLE_NAME),
+                'INDEX({table}[_pk],1):{key}'.format(
+                    table=TABLE_NAME,
+                    key=_this_row('_pk')),
+                DATA_FIRST_ROW - 1)
+            fmla = ('OR(' + fmla + ',' + pk_fmla + ')') if fmla else pk_fmla
+        formulas[e_name] = ('NOT({_value_}="")*(' + fmla + ')').format(
+            _value_=values[field['id']],
+            _choice_range_=cranges.get(field['id']),
+            **values) if fmla else '0'
+
+        fmla = _required_rule(field)
+        formulas[r_name] = fmla.format(
+            has_data=_this_row('_has_data'),
+            cell=values[field['id']],
+            **values) if fmla else '0'
+
+    last_row = DATA_FIRST_ROW + data_num_rows - 1
+    for i in range(DATA_FIRST_ROW, last_row + 1):
+        for col_num, name in enumerate(columns, 1):
+            if name in formulas:
+                sheet.cell(row=i, column=col_num).value = '=' + formulas[name]
+    apply_style(
+        sheet.cell(row=DATA_FIRST_ROW, column=RPAD_COL_NUM), TYPE_HERE_STYLE)
+
+    # first error/required row in each column, for the column status row
+    first_check_col_num = DATA_FIRST_COL_NUM + num_cols
+    for col_num, name in enumerate(e_names + r_names, first_check_col_num):
+        sheet.cell(row=CSTATUS_ROW, column=col_num).value = (
+            '=IFERROR(MATCH(TRUE,INDEX({table}[{name}]<>0,),)+{row0},0)'
+            .format(
+                table=TABLE_NAME,
+                name=_table_name(name),
+                row0=DATA_FIRST_ROW - 1))
+    sheet.column_dimensions.group(
+        get_column_letter(first_check_col_num),
+        get_column_letter(len(columns)),
+        hidden=True)
+
+    table = Table(
+        displayName=TABLE_NAME,
+        ref='{colA}{row1}:{colZ}{rowN}'.format(
+            colA=RSTATUS_COL,
+            row1=DATA_FIRST_ROW,
+            colZ=get_column_letter(len(columns)),
+            rowN=last_row),
+        headerRowCount=0)
+    table.tableColumns = [
+        TableColumn(
+            id=n,
+            name=name,
+            calculatedColumnFormula=TableFormula(attr_text=formulas[name])
+                if name in formulas else None)
+        for n, name in enumerate(columns, 1)]
+    sheet.add_table(table)
+
+    # conditional formatting can't use structured references: rules
+    # refer to the check columns num_cols and 2 * num_cols to the right
+    error_fill, error_font = _highlight(error_style)
+    required_fill, required_font = _highlight(required_style)
+    ecol = get_column_letter(first_check_col_num)
+    rcol = get_column_letter(first_check_col_num + num_cols)
+    data_range = '{colA}{row1}:{colZ}{rowN}'.format(
+        colA=DATA_FIRST_COL,
+        row1=CSTATUS_ROW,
+        colZ=get_column_letter(first_check_col_num - 1),
+        rowN=last_row)
+    sheet.conditional_formatting.add(
+        data_range,
+        FormulaRule([
+            'AND(ISNUMBER({e}{row1}),{e}{row1}>0)'.format(
+                e=ecol, row1=CSTATUS_ROW)],
+        stopIfTrue=True,
+        fill=error_fill,
+        font=error_font))
+    sheet.conditional_formatting.add(
+        data_range,
+        FormulaRule([
+            'AND(ISNUMBER({r}{row1}),{e}{row1}=0,{r}{row1}>0)'.format(
+                e=ecol, r=rcol, row1=CSTATUS_ROW)],
+        stopIfTrue=True,
+        fill=required_fill,
+        font=required_font))
+
+    row_e = get_column_letter(columns.index('_e') + 1)
+    row_r = get_column_letter(columns.index('_r') + 1)
+    status_range = '{col}{row1}:{col}{rowN}'.format(
+        col=RSTATUS_COL, row1=DATA_FIRST_ROW, rowN=last_row)
+    sheet.conditional_formatting.add(
+        status_range,
+        FormulaRule([
+            '${e}{row1}>0'.format(e=row_e, row1=DATA_FIRST_ROW)],
+        stopIfTrue=True,
+        fill=error_fill,
+        font=error_font))
+    sheet.conditional_formatting.add(
+        status_range,
+        FormulaRule([
+            'AND(${e}{row1}=0,${r}{row1}>0)'.format(
+                e=row_e, r=row_r, row1=DATA_FIRST_ROW)],
+        stopIfTrue=True,
+        fill=required_fill,
+        font=required_font))
@@ -0,0 +1,275 @@
+"""
+Streaming xlsx reader with a disk-backed shared string table
+
+openpyxl keeps the whole shared string table of a workbook in memory,
+which for uploads exported from other systems can be millions of
+strings. Here the table is written once to temporary files, the
+strings and an array of their offsets, and memory-mapped so strings
+are only decoded when a row that uses them is read. Worksheet rows are
+parsed incrementally, so peak memory doesn't grow with the size of
+the workbook.
+
+Values match openpyxl's read-only mode: numbers with date formats are
+converted to datetimes and formula cells are returned as "=..." text.
+"""
+
+import mmap
+import re
+import tempfile
+import zipfile
+from array import array
+from functools import lru_cache
+from xml.etree.ElementTree import iterparse
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils import column_index_from_string
+from openpyxl.utils.datetime import (
+    from_excel, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904)
+
+# recently used shared strings kept decoded, so repeated values like
+# choice codes share one string object
+STRING_CACHE_SIZE = 4096
+
+SHEET_REL_RE = re.compile(r'<Relationship\b[^>]*?/>')
+CELL_REF_RE = re.compile(r'([A-Z]+)')
+OFFSETS_CHUNK = 4096
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _attr(elem, name):
+    """
+    Return attribute name of elem with or without a namespace
+    """
+    value = elem.get(name)
+    if value is None:
+        for k, v in elem.attrib.items():
+            if _local(k) == name:
+                return v
+    return value
+
+
+class SharedStrings(object):
+    """
+    Shared string table indexed into temporary files and memory-mapped
+    """
+    def __init__(self, source, tmpdir=None):
+        self._data = tempfile.TemporaryFile(dir=tmpdir)
+        self._offsets = tempfile.TemporaryFile(dir=tmpdir)
+        self._data_map = self._offsets_map = None
+        self.count = 0
+
+        offsets = array('q', [0])
+        position = 0
+        parent = None
+        for event, elem in iterparse(source, events=('start', 'end')):
+            tag = _local(elem.tag)
+            if event == 'start':
+                if tag == 'sst':
+                    parent = elem
+                continue
+            if tag != 'si':
+                continue
+            text = _string_item_text(elem)
+            encoded = text.encode('utf-8')
+            self._data.write(encoded)
+            position += len(encoded)
+            offsets.append(position)
+            self.count += 1
+            if len(offsets) >= OFFSETS_CHUNK:
+                offsets.tofile(self._offsets)
+                offsets = array('q')
+            parent.clear()
+        offsets.tofile(self._offsets)
+
+        self._data.flush()
+        self._offsets.flush()
+        if position:
+            self._data_map = mmap.mmap(
+                self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets_map = mmap.mmap(
+            self._offsets.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index = memoryview(self._offsets_map).cast('q')
+        self._cached = lru_cache(STRING_CACHE_SIZE)(self._decode)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self._cached(i)
+
+    def _decode(self, i):
+        start, end = self._index[i], self._index[i + 1]
+        if start == end:
+            return u''
+        return self._data_map[start:end].decode('utf-8')
+
+    def close(self):
+        self._cached.cache_clear()
+        self._index.release()
+        self._offsets_map.close()
+        if self._data_map is not None:
+            self._data_map.close()
+        self._data.close()
+        self._offsets.close()
+
+
+def _string_item_text(si):
+    """
+    Return the text of a shared string or inline string element: plain
+    text or rich text runs, ignoring phonetic runs
+    """
+    parts = []
+    for child in si:
+        tag = _local(child.tag)
+        if tag == 't':
+            parts.append(child.text or u'')
+        elif tag == 'r':
+            parts.extend(
+                t.text or u'' for t in child if _local(t.tag) == 't')
+    return u''.join(parts)
+
+
+class StreamingWorkbook(object):
+    """
+    Read-only access to the rows of each worksheet in an xlsx file
+    (name or file object)
+    """
+    def __init__(self, f, tmpdir=None):
+        self.zip = zipfile.ZipFile(f)
+        self.epoch = CALENDAR_WINDOWS_1900
+        self.sheets = self._sheet_parts()
+        self.date_styles = self._date_styles()
+        self.shared_strings = None
+        if 'xl/sharedStrings.xml' in self.zip.namelist():
+            with self.zip.open('xl/sharedStrings.xml') as source:
+                self.shared_strings = SharedStrings(source, tmpdir)
+
+    @property
+    def sheetnames(self):
+        return [name for name, part in self.sheets]
+
+    def _sheet_parts(self):
+        rels = self.zip.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+        targets = {}
+        for rel in SHEET_REL_RE.findall(rels):
+            rid = re.search(r'\bId="([^"]*)"', rel).group(1)
+            target = re.search(r'\bTarget="([^"]*)"', rel).group(1)
+            targets[rid] = (
+                target[1:] if target.startswith('/') else 'xl/' + target)
+
+        sheets = []
+        with self.zip.open('xl/workbook.xml') as source:
+            for event, elem in iterparse(source):
+                tag = _local(elem.tag)
+                if tag == 'workbookPr' and _attr(elem, 'date1904') in (
+                        '1', 'true'):
+                    self.epoch = CALENDAR_MAC_1904
+                elif tag == 'sheet':
+                    sheets.append(
+                        (_attr(elem, 'name'), targets[_attr(elem, 'id')]))
+        return sheets
+
+    def _date_styles(self):
+        """
+        Return the set of cell style indexes with date formats
+        """
+        if 'xl/styles.xml' not in self.zip.namelist():
+            return set()
+        formats = dict(BUILTIN_FORMATS)
+        date_styles = set()
+        with self.zip.open('xl/styles.xml') as source:
+            in_cell_xfs = False
+            xf_num = 0
+            for event, elem in iterparse(source, events=('start', 'end')):
+                tag = _local(elem.tag)
+                if tag == 'cellXfs':
+                    in_cell_xfs = event == 'start'
+                elif event != 'end':
+                    continue
+                elif tag == 'numFmt':
+                    formats[int(elem.get('numFmtId'))] = elem.get('formatCode')
+                elif tag == 'xf' and in_cell_xfs:
+                    fmt = formats.get(int(elem.get('numFmtId', 0)))
+                    if fmt and is_date_format(fmt):
+                        date_styles.add(xf_num)
+                    xf_num += 1
+        return date_styles
+
+    def rows(self, sheetname):
+        """
+        Yield lists of cell values for each row of sheetname, with
+        empty lists for missing rows
+        """
+        part = dict(self.sheets)[sheetname]
+        with self.zip.open(part) as source:
+            expected = 1
+            sheet_data = None
+            for event, elem in iterparse(source, events=('start', 'end')):
+                tag = _local(elem.tag)
+                if event == 'start':
+                    if tag == 'sheetData':
+                        sheet_data = elem
+                    continue
+                if tag != 'row':
+                    continue
+                num = int(elem.get('r', expected))
+                while expected < num:
+                    expected += 1
+                    yield []
+                expected += 1
+                yield self._row_values(elem)
+                sheet_data.clear()
+
+    def _row_values(self, row):
+        values = []
+        for c in row:
+            if _local(c.tag) != 'c':
+                continue
+            ref = c.get('r')
+            if ref:
+                col = column_index_from_string(CELL_REF_RE.match(ref).group(1))
+                if col > len(values) + 1:
+                    values.extend([None] * (col - len(values) - 1))
+            values.append(self._cell_value(c))
+        return values
+
+    def _cell_value(self, c):
+        value = formula = inline = None
+        for child in c:
+            tag = _local(child.tag)
+            if tag == 'v':
+                value = child.text
+            elif tag == 'f':
+                formula = child.text or u''
+            elif tag == 'is':
+                inline = _string_item_text(child)
+        if formula is not None:
+            return u'=' + formula
+        data_type = c.get('t', 'n')
+        if data_type == 'inlineStr':
+            return inline
+        if value is None:
+            return None
+        if data_type == 's':
+            return self.shared_strings[int(value)]
+        if data_type == 'n':
+            if '.' in value or 'E' in value or 'e' in value:
+                value = float(value)
+            else:
+                value = int(value)
+            if int(c.get('s', 0)) in self.date_styles:
+                return from_excel(value, self.epoch)
+            return value
+        if data_type == 'b':
+            return value == '1'
+        return value
+
+    def close(self):
+        if self.shared_strings is not None:
+            self.shared_strings.close()
+        self.zip.close()